@@ -0,0 +1,121 @@
+"""Measures how the worker threads scale with the number of threads.
+
+Each thread applies the same modlist to its own share of synthetic TCP
+packets, exactly like a `ThreadWorker` does (a `PacketList` per packet, then
+the raw bytes of the resulting packets), without NFQUEUE nor sending. The
+throughput is printed for each number of threads, with the speedup over a
+single thread.
+
+Run it with both builds of the same CPython version (with Fragscapy
+installed in both) to compare them, e.g.::
+
+    python3.13 benchmarks/worker_threads.py
+    python3.13t benchmarks/worker_threads.py
+
+With the GIL, the throughput stays flat (or drops) whatever the number of
+threads. On a free-threaded build, it should grow with the number of threads
+up to the number of CPU cores.
+"""
+
+import argparse
+import os
+import threading
+import time
+
+import scapy.layers.inet
+
+from fragscapy.modgenerator import get_mod
+from fragscapy.modlist import ModList
+from fragscapy.packetlist import PacketList
+from fragscapy.workers import gil_enabled
+
+
+# The modlist applied by default: enough work per packet to dominate the
+# cost of the threads
+DEFAULT_MODS = ["tcp_segment 128", "reorder reverse"]
+
+
+def build_modlist(mods):
+    """Returns the `ModList` of the mods given as '<mod_name> <args...>'."""
+    modlist = ModList()
+    for mod in mods:
+        name, *args = mod.split()
+        modlist.append(get_mod(name)(*args))
+    return modlist
+
+
+def build_payloads(nb_packets, size):
+    """Returns `nb_packets` raw TCP packets with `size` bytes of data."""
+    ip, tcp = scapy.layers.inet.IP, scapy.layers.inet.TCP
+    return [
+        bytes(ip(dst="192.0.2.1") / tcp(sport=1024 + i % 60000, dport=80,
+                                        seq=i) / (b"x" * size))
+        for i in range(nb_packets)
+    ]
+
+
+def process(modlist, payloads):
+    """Applies `modlist` to each packet of `payloads`."""
+    for payload in payloads:
+        packetlist = PacketList()
+        packetlist.add_raw_packet(payload, scapy.layers.inet.IP)
+        for pkt in modlist.apply(packetlist):
+            pkt.raw  # pylint: disable=pointless-statement
+
+
+def run(modlist, payloads, nb_threads):
+    """Processes `payloads` with `nb_threads` threads and returns the time
+    it took."""
+    shares = [payloads[i::nb_threads] for i in range(nb_threads)]
+    threads = [threading.Thread(target=process, args=(modlist, share))
+               for share in shares]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def main():
+    """Runs the benchmark for each number of threads."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--threads', type=int, nargs='+', default=[1, 2, 4, 8],
+        help="The numbers of threads to measure. Default is 1 2 4 8."
+    )
+    parser.add_argument(
+        '--packets', type=int, default=500,
+        help="The number of packets processed by each run. Default is 500."
+    )
+    parser.add_argument(
+        '--size', type=int, default=512,
+        help="The size of the TCP data of each packet. Default is 512."
+    )
+    parser.add_argument(
+        '--mod', action='append', metavar='"<mod_name> <args...>"',
+        help="A mod of the modlist (repeat for several mods). Default is {}."
+             .format(", ".join(DEFAULT_MODS))
+    )
+    args = parser.parse_args()
+
+    modlist = build_modlist(args.mod or DEFAULT_MODS)
+    payloads = build_payloads(args.packets, args.size)
+    print("GIL {}, {} CPUs, modlist reentrant: {}".format(
+        "enabled" if gil_enabled() else "disabled", os.cpu_count(),
+        modlist.is_reentrant()
+    ))
+    process(modlist, payloads[:100])  # Warm-up (imports, caches)
+    reference = None
+    for nb_threads in args.threads:
+        elapsed = run(modlist, payloads, nb_threads)
+        rate = len(payloads) / elapsed
+        if reference is None:
+            reference = rate
+        print("{:3d} threads: {:9.0f} packets/s (x{:.2f})".format(
+            nb_threads, rate, rate / reference
+        ))
+
+
+if __name__ == '__main__':
+    main()
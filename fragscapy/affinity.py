@@ -0,0 +1,154 @@
+"""Pins the threads and the processes consuming the queues to CPU cores.
+
+When a rule balances the packets over several queues with
+`--queue-cpu-fanout` (see `NFQueueRule`), the kernel sends a packet handled
+by the CPU `cpu` to the queue `qnum + cpu % queues`. Pinning the consumer of
+each queue to the CPUs feeding it (see `fanout_cpus()`) keeps the packets,
+the netlink socket and the thread applying the modlists on the same cores
+instead of bouncing between them with cold caches.
+
+The CPUs used can be restricted to a set given by the user (e.g. '0-7') or
+to the CPUs of a NUMA node (see `numa_cpus()`), always within the CPUs the
+process is allowed to run on.
+
+The affinity of a thread is inherited by the threads it creates: a thread
+pinned before starting its helper threads (scheduler, netlink reader of the
+`fnfqueue` connection, see `call_pinned()`) pins them as well.
+"""
+
+import os
+
+
+# The list of the CPUs of each NUMA node
+NUMA_CPULIST = "/sys/devices/system/node/node{node}/cpulist"
+
+
+class AffinityError(ValueError):
+    """Error with the CPU affinity asked for."""
+
+
+def parse_cpu_list(cpu_list):
+    """Parses a list of CPUs in the format of the kernel (e.g. '0-3,8').
+
+    Args:
+        cpu_list: The string to parse.
+
+    Returns:
+        The set of the CPU ids of the list.
+
+    Raises:
+        AffinityError: The list is malformed.
+
+    Examples:
+        >>> parse_cpu_list("0-3,8")
+        {0, 1, 2, 3, 8}
+    """
+    cpus = set()
+    for part in cpu_list.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        try:
+            first = int(first)
+            last = int(last) if last else first
+        except ValueError:
+            raise AffinityError("Malformed CPU list '{}'".format(cpu_list))
+        if first < 0 or last < first:
+            raise AffinityError("Malformed CPU list '{}'".format(cpu_list))
+        cpus.update(range(first, last + 1))
+    return cpus
+
+
+def format_cpu_list(cpus):
+    """Formats a set of CPUs in the format of the kernel (e.g. '0-3,8')."""
+    ranges = list()
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(first) if first == last
+                    else "{}-{}".format(first, last)
+                    for first, last in ranges)
+
+
+def allowed_cpus():
+    """Returns the set of the CPUs the process is allowed to run on."""
+    return set(os.sched_getaffinity(0))
+
+
+def numa_cpus(node):
+    """Returns the set of the CPUs of a NUMA node.
+
+    Raises:
+        AffinityError: The node does not exist.
+    """
+    try:
+        with open(NUMA_CPULIST.format(node=node)) as f:
+            return parse_cpu_list(f.read())
+    except OSError:
+        raise AffinityError("Unknown NUMA node {}".format(node))
+
+
+def usable_cpus(cpus=None, numa_node=None):
+    """Returns the set of the CPUs the queues and workers can be pinned to.
+
+    Args:
+        cpus: The CPUs to use, as a set or a CPU list (see
+            `parse_cpu_list()`). Default is 'None' which means all the
+            allowed CPUs.
+        numa_node: Only use the CPUs of this NUMA node. Default is 'None'
+            (no restriction).
+
+    Raises:
+        AffinityError: None of the allowed CPUs is left.
+    """
+    usable = allowed_cpus()
+    if cpus is not None:
+        if isinstance(cpus, str):
+            cpus = parse_cpu_list(cpus)
+        usable &= set(cpus)
+    if numa_node is not None:
+        usable &= numa_cpus(numa_node)
+    if not usable:
+        raise AffinityError("No allowed CPU left to pin the queues to")
+    return usable
+
+
+def fanout_cpus(index, queues, cpus):
+    """Returns the CPUs whose packets go to the `index`-th queue (between 0
+    and `queues`-1) of a rule using `--queue-cpu-fanout`, among `cpus`.
+
+    When there are less CPUs than queues, the queues fed by no CPU of `cpus`
+    share all of them.
+    """
+    fed = set(cpu for cpu in cpus if cpu % queues == index)
+    return fed or set(cpus)
+
+
+def worker_cpus(nb_workers, cpus):
+    """Returns the CPU each worker is pinned to (as a set of one CPU),
+    spreading the workers over `cpus`."""
+    cpus = sorted(cpus)
+    return [{cpus[i % len(cpus)]} for i in range(nb_workers)]
+
+
+def pin(cpus):
+    """Pins the calling thread (and the threads it creates afterwards) to
+    `cpus`. Does nothing if `cpus` is 'None'."""
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+
+
+def call_pinned(cpus, func, *args, **kwargs):
+    """Calls `func` with the calling thread pinned to `cpus`, so the threads
+    it starts are pinned as well, then restores the affinity of the
+    thread."""
+    if cpus is None:
+        return func(*args, **kwargs)
+    previous = os.sched_getaffinity(0)
+    pin(cpus)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        pin(previous)
@@ -0,0 +1,176 @@
+"""Runs the test suite from a single asyncio event loop.
+
+The `AsyncEngine` is an alternative to the `Engine`: instead of a blocking
+thread per queue (each with its scheduler thread) and a thread writing the
+pcap files, everything runs in one asyncio event loop:
+
+* each `NFQueue` signals the packets it receives on a pipe watched by the
+  loop, which processes them with the `EngineThread` objects of the engine
+  (see `EngineThread.poll()`, their threads are never started);
+* the delayed packets are sent by the timers of the loop (see
+  `AsyncDelayScheduler`);
+* the pcap files are written from the loop and flushed by a timer (see
+  `LoopPcapSink`);
+* the command of each test runs in an asyncio sub-process, so the packets are
+  processed while it runs.
+
+The `fnfqueue` connections still read their netlink socket in their own
+thread (it can not be avoided). The modifications are applied in the loop: a
+slow modlist delays the packets of the other queues (the packet budget and
+the backlog limit of the `Engine` still apply). The workers and the watchdog
+are not supported. With `cpu_affinity`, only the netlink reader of each
+queue is pinned: the loop processes all of them.
+"""
+
+import asyncio
+import functools
+import signal
+import traceback
+
+from fragscapy.engine import Engine, EngineError
+from fragscapy.netfilter import NFQueue
+from fragscapy.pcapsink import LoopPcapSink
+from fragscapy.scheduler import AsyncDelayScheduler
+
+
+class AsyncEngine(Engine):
+    """Engine driving the queues, the delayed packets, the pcap files and the
+    tests from one asyncio event loop.
+
+    It is used exactly like an `Engine` (see `.start()`). A SIGINT (Ctrl+C)
+    kills the command of the current test and the remaining tests are
+    reported as not done.
+
+    Args:
+        config (:obj:`Config`): The configuration to use.
+        **kwargs: The options of the `Engine`, except `workers`,
+            `worker_threads` and `watchdog`.
+
+    Raises:
+        EngineError: Workers or a watchdog are asked for.
+
+    Examples:
+        >>> engine = AsyncEngine(Config("config.json"), local_pcap="l.pcap")
+        >>> engine.start()
+    """
+    def __init__(self, config, **kwargs):
+        if kwargs.get("workers") or kwargs.get("worker_threads"):
+            raise EngineError("The asyncio engine can't use workers")
+        if kwargs.get("watchdog"):
+            raise EngineError("The asyncio engine can't use a watchdog")
+        self._loop = asyncio.new_event_loop()
+        # Has the user interrupted the tests (and the task of the current
+        # test, cancelled by the interruption)
+        self._interrupted = False
+        self._test_task = None
+        super(AsyncEngine, self).__init__(config, **kwargs)
+
+    def _nfqueue_factory(self, **kwargs):
+        """Returns the callable creating a `NFQueue` with `kwargs`, watched
+        by the loop."""
+        return functools.partial(NFQueue, notify=True, **kwargs)
+
+    def _new_pcap_sink(self):
+        """Returns the sink writing all the pcap files from the loop."""
+        return LoopPcapSink(self._loop)
+
+    def _new_scheduler(self):
+        """Returns the scheduler sending the delayed packets of a queue with
+        the timers of the loop."""
+        return AsyncDelayScheduler(self._new_thread_sender(), self._loop)
+
+    def _on_packets(self, i):
+        """Processes the packets received by the i-th nfqueue (called by the
+        loop when they are signaled). The packets of a batch that fails are
+        accepted unmodified and the incident is recorded."""
+        engine_thread = self._engine_threads[i]
+        try:
+            more = engine_thread.poll()
+        except Exception as e:  # pylint: disable=broad-except
+            engine_thread.error = e
+            traceback.print_exc()
+            engine_thread.fail_open()
+            self._record_incident(
+                "Queues {} failed to process a batch ({!r}), accepted "
+                "unmodified".format(
+                    "/".join(str(q) for q in self._nfqueues[i].qnums), e
+                )
+            )
+            more = True
+        if more and self._nfqueues[i].backlog():
+            # The signal has been consumed: the next batch is processed once
+            # the other queues and the tests had their turn
+            self._loop.call_soon(self._on_packets, i)
+
+    def _start_threads(self):
+        """Starts watching the nfqueues and flushing the pcap files from the
+        loop (no thread is started)."""
+        self._pcap_sink.start()
+        for i, nfqueue in enumerate(self._nfqueues):
+            self._loop.add_reader(nfqueue.fileno(), self._on_packets, i)
+
+    def _stop_threads(self):
+        """Stops watching the nfqueues and closes them. The delayed packets
+        not sent yet are discarded."""
+        for nfqueue in self._nfqueues:
+            self._loop.remove_reader(nfqueue.fileno())
+        for engine_thread in self._engine_threads:
+            # Never started: its nfqueue is closed at once
+            engine_thread.stop()
+            engine_thread.scheduler.stop()
+            engine_thread.sender.close()
+
+    def _join_threads(self):
+        """Closes the pcap files (there is no thread to wait for)."""
+        self._pcap_sink.stop()
+
+    def _interrupt(self):
+        """Stops running the tests (called by the loop on SIGINT)."""
+        self._interrupted = True
+        if self._test_task is not None:
+            self._test_task.cancel()
+
+    async def run_async(self):
+        """Runs the test suite, like `Engine.run()`, in the loop.
+
+        The packets are processed by the loop while the command of each test
+        runs. Once interrupted, the remaining tests are still generated so
+        they appear as not done in the results.
+        """
+        for repeated_test_case in self.test_suite:
+            if not self._interrupted:
+                self._update_modlists(repeated_test_case)
+            for test_case in repeated_test_case:
+                if self._interrupted:
+                    continue
+                self._update_pcap_files(test_case)
+                drops = self._queue_drops()
+                bypassed = self._bypassed()
+                self._test_task = self._loop.create_task(
+                    test_case.run_async()
+                )
+                try:
+                    await self._test_task
+                except (asyncio.CancelledError, ProcessLookupError):
+                    self._interrupted = True
+                    continue
+                finally:
+                    self._test_task = None
+                test_case.drops = self._queue_drops() - drops
+                test_case.bypassed = self._bypassed() - bypassed
+
+    def run(self):
+        """Runs the test suite in the loop (see `.run_async()`)."""
+        self._loop.add_signal_handler(signal.SIGINT, self._interrupt)
+        try:
+            self._loop.run_until_complete(self.run_async())
+        finally:
+            self._loop.remove_signal_handler(signal.SIGINT)
+
+    def start(self):
+        """Starts the test suite like `Engine.start()` and closes the loop
+        afterwards."""
+        try:
+            super(AsyncEngine, self).start()
+        finally:
+            self._loop.close()
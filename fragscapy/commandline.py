@@ -13,6 +13,7 @@ import scapy.config
 
 from fragscapy._author import __author__
 from fragscapy._version import __version__
+from fragscapy.asyncengine import AsyncEngine
 from fragscapy.config import Config
 from fragscapy.engine import Engine
 from fragscapy.modgenerator import get_all_mods, get_mod
@@ -97,6 +98,13 @@ def command():
         help=("Do not delete the result files. Instead append the new results "
               "to them.")
     )
+    parser_checkconfig.add_argument(
+        '--nf-backend',
+        choices=['iptables', 'nftables'],
+        default='iptables',
+        help=("The backend used to insert the Netfilter rules. Default is "
+              "'iptables'.")
+    )
 
     # fragscapy start
     parser_start = subparsers.add_parser('start', help="Start the tests")
@@ -180,6 +188,149 @@ def command():
               "Some tests have random behavior, they can be repeated multiple "
               "times with the same configuration. Default is 10.")
     )
+    parser_start.add_argument(
+        '--workers',
+        type=int,
+        metavar='<N>',
+        default=0,
+        help=("Apply the modifications in N worker processes instead of the "
+              "engine threads, so the processing can use multiple CPU cores. "
+              "Default is 0 (no worker processes).")
+    )
+    parser_start.add_argument(
+        '--worker-threads',
+        type=int,
+        metavar='<N>',
+        help=("Apply the modifications in N worker threads instead of the "
+              "engine threads. They only run in parallel on a free-threaded "
+              "(no-GIL) Python. Can't be used with --workers.")
+    )
+    parser_start.add_argument(
+        '--cpu-affinity',
+        action='store_true',
+        help=("Pin the thread reading each queue to the CPUs whose packets "
+              "the kernel sends to it (the rules balancing over several "
+              "queues use --queue-cpu-fanout) and each worker to its own "
+              "CPU.")
+    )
+    parser_start.add_argument(
+        '--cpus',
+        metavar='<cpu list>',
+        help=("Only pin to these CPUs, e.g. '0-3,8' (implies "
+              "--cpu-affinity). Default is all the CPUs.")
+    )
+    parser_start.add_argument(
+        '--numa-node',
+        type=int,
+        metavar='<N>',
+        help=("Only pin to the CPUs of this NUMA node (implies "
+              "--cpu-affinity).")
+    )
+    parser_start.add_argument(
+        '--nf-backend',
+        choices=['iptables', 'nftables'],
+        default='iptables',
+        help=("The backend used to insert the Netfilter rules: 'iptables' "
+              "uses ip(6)tables-restore, 'nftables' creates a dedicated nft "
+              "table with the hosts and ports in sets. Default is "
+              "'iptables'.")
+    )
+    parser_start.add_argument(
+        '--offload',
+        action='store_true',
+        help=("Mark the connections during the tests whose modifications "
+              "leave the packets unchanged so their next packets skip the "
+              "NFQUEUE (a connmark and the rules matching it are used).")
+    )
+    parser_start.add_argument(
+        '--bypass-empty',
+        action='store_true',
+        help=("Remove the NFQUEUE rules during the tests whose modifications "
+              "leave the packets unchanged, so their packets never leave "
+              "the kernel. Can't be used with --local-pcap or "
+              "--remote-pcap.")
+    )
+    parser_start.add_argument(
+        '--kernel-plans',
+        action='store_true',
+        help=("Run the tests whose modifications only drop, delay or "
+              "duplicate the packets with kernel rules instead of the "
+              "NFQUEUE. Delays and duplications use a netem qdisc on the "
+              "interface given with --iface.")
+    )
+    parser_start.add_argument(
+        '--mtu',
+        type=int,
+        metavar='<N>',
+        help=("The size the GSO packets of the OUTPUT chain (see the 'gso' "
+              "option of the NF rules) are segmented to before applying the "
+              "modifications. Default is 1500.")
+    )
+    parser_start.add_argument(
+        '--packet-budget',
+        type=float,
+        metavar='<seconds>',
+        help=("Accept unmodified the packets that waited more than this "
+              "time in the engine before being processed, so the latency of "
+              "the host stays bounded. Default is no deadline.")
+    )
+    parser_start.add_argument(
+        '--max-backlog',
+        type=int,
+        metavar='<N>',
+        help=("Accept unmodified the packets read from a queue while more "
+              "than N packets wait to be read. Default is no limit.")
+    )
+    parser_start.add_argument(
+        '--split-chains',
+        action='store_true',
+        help=("Read the OUTPUT and the INPUT queues in separate threads "
+              "(and netlink connections) so the chains are processed "
+              "concurrently.")
+    )
+    parser_start.add_argument(
+        '--asyncio',
+        action='store_true',
+        help=("Process the packets, the delayed packets, the pcap files and "
+              "the tests from a single asyncio event loop instead of "
+              "threads. Can't be used with the workers nor --watchdog.")
+    )
+    parser_start.add_argument(
+        '--watchdog',
+        action='store_true',
+        help=("Restart the engine threads that die or stall on a packet "
+              "(their packets are accepted unmodified) and report the "
+              "incidents in the results.")
+    )
+    parser_start.add_argument(
+        '--stall-timeout',
+        type=float,
+        metavar='<seconds>',
+        help=("The time a packet can be processed before the watchdog "
+              "considers its thread stalled. Default is 5 seconds.")
+    )
+    parser_start.add_argument(
+        '--sender',
+        choices=['raw', 'txring'],
+        default='raw',
+        help=("The backend used to send the packets modified on the OUTPUT "
+              "chain: 'raw' uses an AF_PACKET socket for any interface, "
+              "'txring' writes the frames in the TX ring of an AF_PACKET "
+              "socket bound to --iface. Default is 'raw'.")
+    )
+    parser_start.add_argument(
+        '--iface',
+        metavar='<iface>',
+        help=("The interface the 'txring' sender sends the frames on (and "
+              "the netem qdisc of --kernel-plans is set on). Default is "
+              "Scapy's default interface.")
+    )
+    parser_start.add_argument(
+        '--qdisc-bypass',
+        action='store_true',
+        help=("Make the 'txring' sender bypass the qdisc layer of the "
+              "interface.")
+    )
 
     args = parser.parse_args()
 
@@ -223,7 +374,11 @@ def start(args):
         config = Config(config_file)
         kwargs = _filter_kwargs(
             args,
-            ['modif_file', 'local_pcap', 'remote_pcap', 'append', 'repeat']
+            ['modif_file', 'local_pcap', 'remote_pcap', 'append', 'repeat',
+             'workers', 'worker_threads', 'sender', 'iface', 'qdisc_bypass',
+             'nf_backend', 'offload', 'kernel_plans', 'bypass_empty', 'mtu',
+             'packet_budget', 'max_backlog', 'split_chains', 'watchdog',
+             'stall_timeout', 'cpu_affinity', 'cpus', 'numa_node']
         )
         kwargs['progressbar'] = not args.no_progressbar
         kwargs['display_results'] = not args.no_results
@@ -235,7 +390,8 @@ def start(args):
         if args.stderr != 0:
             kwargs['stderr'] = args.stderr
         kwargs = _format_config_name(kwargs, i)
-        engine = Engine(config, **kwargs)
+        engine_class = AsyncEngine if args.asyncio else Engine
+        engine = engine_class(config, **kwargs)
         engine.start()
         print()
 
@@ -270,12 +426,15 @@ def checkconfig(args):
             print(">>> Loading config file")
             config = Config(config_file)
             print(">>> Loading engine")
-            kwargs = _filter_kwargs(args, ['modif_file', 'append'])
+            kwargs = _filter_kwargs(args,
+                                    ['modif_file', 'append', 'nf_backend'])
             kwargs['progressbar'] = not args.no_progressbar
             kwargs = _format_config_name(kwargs, i)
             engine = Engine(config, **kwargs)
             print(">>> Checking Netfilter rules")
             engine.check_nfrules()
+            print(">>> Checking the packets needed by the mods")
+            engine.check_packet_filters()
             print(">>> Checking mod list generation (output to '{}')"
                   .format(args.modif_file))
             engine.check_modlist_generation()
@@ -5,23 +5,63 @@ Netfilter rules, generate the mod lists, run the test suite and cleanup
 everything at the end.
 
 The `EngineThread` is a thread in charge of modifying the intercept packets
-and sending them back to the network.
+and sending them back to the network. There is one per pair of OUTPUT/INPUT
+queues, or one per queue when the chains are split. When the engine uses
+worker processes, it only reads the packets and hands them to the
+`WorkerPool` that applies the modifications. The `AsyncEngine` (see
+`fragscapy.asyncengine`) drives the same objects from an asyncio event loop
+instead of threads.
 """
 
+import collections
+import functools
+import math
+import random
 import threading
+import time
+import traceback
 import warnings
 
-import scapy.utils
+import fnfqueue
 import tqdm
 
-from fragscapy.modgenerator import ModListGenerator
-from fragscapy.netfilter import NFQueue, NFQueueRule
-from fragscapy.packetlist import PacketList
+from fragscapy.affinity import (
+    call_pinned, fanout_cpus, format_cpu_list, pin, usable_cpus, worker_cpus
+)
+from fragscapy.gso import DEFAULT_MTU, segment
+from fragscapy.modgenerator import ModListGenerator, get_mod
+from fragscapy.netfilter import (
+    INPUT, NF_BACKENDS, OUTPUT, SKB_CSUMNOTREADY, SKB_GSO, NFQueue,
+    NFQueueRule, insert_rules, read_queue_drops, remove_rules, replace_rules
+)
+from fragscapy.packetlist import MIN_TIME_DELAY, PacketList
+from fragscapy.pcapsink import PcapSink
+from fragscapy.planner import (
+    IDENTITY_PLAN, VERDICT_ONLY_MODS, NetemQdisc, is_verdict_only,
+    plan_modlists
+)
+from fragscapy.scheduler import DelayScheduler
+from fragscapy.sender import SENDERS, RawSender, new_sender
 from fragscapy.tests import TestSuite
+from fragscapy.workers import (
+    ThreadWorkerPool, WorkerPool, gil_enabled
+)
 
 
 MODIF_FILE = "modifications.txt"   # Details of each mod on this file
 
+# The time (in seconds) between 2 checks of the engine threads by the watchdog
+WATCHDOG_INTERVAL = 0.5
+# The default time (in seconds) a packet can be processed before the engine
+# thread is considered stalled by the watchdog
+DEFAULT_STALL_TIMEOUT = 5.0
+
+# The modlists used by an `EngineThread`, replaced all at once. The
+# generation is incremented each time the modlists are changed.
+ModListSnapshot = collections.namedtuple(
+    'ModListSnapshot', ['generation', 'input_modlist', 'output_modlist']
+)
+
 
 class EngineError(ValueError):
     """An Error during the execution of the engine."""
@@ -48,6 +88,77 @@ def _append_to_display_list(display_list, i, j, limit):
         display_list.append("...")
 
 
+def _packet_bytes(packet):
+    """Returns a copy of the bytes of a packet caught in NFQUEUE, without
+    dissecting it if it was not already."""
+    if packet.is_dissected():
+        return bytes(packet.scapy_pkt)
+    return bytes(packet.raw)
+
+
+def _new_packetlist(packet, mtu=DEFAULT_MTU):
+    """Returns a new `PacketList` containing the packet caught in NFQUEUE.
+    The packet is not dissected if it was not already.
+
+    A GSO packet of the OUTPUT chain is replaced by its segments of at most
+    `mtu` bytes (see `fragscapy.gso`), so the modlist acts on the packets
+    the remote host would receive."""
+    packetlist = PacketList()
+    if packet.is_dissected():
+        packetlist.add_packet(packet.scapy_pkt)
+    elif (packet.is_output
+          and packet.skb_info & (SKB_GSO | SKB_CSUMNOTREADY)):
+        for raw in segment(bytes(packet.raw), mtu):
+            packetlist.add_raw_packet(raw, packet.l3_layer)
+    else:
+        packetlist.add_raw_packet(packet.raw, packet.l3_layer)
+    return packetlist
+
+
+def _leaves_unchanged(snapshot, gso=False):
+    """Do the modlists of `snapshot` leave every packet unchanged, on both
+    chains ?
+
+    The modlists are applied to each intercepted packet on its own: they
+    leave every packet unchanged if they leave the packet list of a single
+    packet unchanged (see `ModList.passthrough_after()`). A GSO packet
+    (`gso` queues) gives a list of any number of segments, only the modlists
+    leaving every list unchanged qualify then.
+    """
+    if snapshot.input_modlist is None or snapshot.output_modlist is None:
+        return False
+    nb_packets = math.inf if gso else 1
+    for modlist in (snapshot.input_modlist, snapshot.output_modlist):
+        after = modlist.passthrough_after()
+        if after is None or after < nb_packets:
+            return False
+    return True
+
+
+def _check_queue_ranges(qnums):
+    """Checks that the queues used by the different qnums (with the number of
+    queues they balance over) do not overlap. Raises `EngineError` if they
+    do."""
+    used = dict()
+    for qnum, options in qnums.items():
+        for queue_num in range(qnum, qnum + 2*options['queues']):
+            if queue_num in used:
+                raise EngineError(
+                    "Queue {} is used by the rules of qnum {} and {}"
+                    .format(queue_num, used[queue_num], qnum)
+                )
+            used[queue_num] = qnum
+
+
+def _max_option(current, new):
+    """Returns the biggest of two optional values ('None' if both are)."""
+    if current is None:
+        return new
+    if new is None:
+        return current
+    return max(current, new)
+
+
 def mlgen_product(in_ml, out_ml):
     """Optimized equivalent of `itertools.product`.
 
@@ -67,7 +178,11 @@ class EngineThread(threading.Thread):
     `output_modlist`) to the packets caught on the INPUT chain (resp. the
     OUTPUT chain).
 
-    These two mod lists can be thread-safely replaced at any time.
+    These two mod lists can be thread-safely replaced at any time. They are
+    held together in an immutable `ModListSnapshot` that is swapped at once
+    (see `.snapshot`): each packet is processed with the snapshot current
+    when its processing started, without taking any lock, and a new snapshot
+    can be set without waiting for a slow `ModList.apply()` to finish.
 
     Args:
         nfqueue (:obj:`NFQueue`): The NF queue used to catch the packets.
@@ -83,9 +198,60 @@ class EngineThread(threading.Thread):
         remote_pcap (str, optional): A pcap file where the packets of the
             remote side should dumped to. Default is 'None' which means the
             packets are not dumped.
+        pool (:obj:`WorkerPool`, optional): The pool of worker processes (or
+            the `ThreadWorkerPool`) to hand the packets to. Default is 'None'
+            which means the packets are modified by the thread itself. If
+            set, the modlists and pcap files of the thread are not used (the
+            pool has its own).
+        sender (optional): The sender used to send the packets resulting
+            from the OUTPUT modlist (see `fragscapy.sender`). Default is a new
+            `RawSender`.
+        scheduler (:obj:`DelayScheduler`, optional): The scheduler sending
+            the delayed packets, started and stopped with the thread. Default
+            is a new `DelayScheduler` with a `RawSender`.
+        pcap_sink (:obj:`PcapSink`, optional): The sink writing the pcap
+            files, in the background. It should be started (and stopped) by
+            the caller. Default is a new `PcapSink` owned by the thread.
+        offload (bool, optional): Offload the connection of a packet to the
+            kernel (see `PacketWrapper.offload()`) when the modlists leave
+            every packet unchanged (see `Mod.passthrough_after()`). It
+            requires the offload rules (see `NFQueueRule`). Default is
+            'False'.
+        gso (bool, optional): The queue receives the GSO packets
+            unsegmented (see `NFQueueRule`). Default is 'False'.
+        mtu (int, optional): The size the GSO packets of the OUTPUT chain
+            are segmented to before applying the modlist. Default is
+            `DEFAULT_MTU`.
+        budget (float, optional): The time (in seconds) a packet can wait
+            after being read from the queue. Past this deadline, it is
+            accepted unmodified. Default is 'None' (no deadline).
+        max_backlog (int, optional): The number of packets waiting to be
+            read from the queue above which the packets are accepted
+            unmodified until the backlog is absorbed. Default is 'None' (no
+            limit).
+        cpus (set, optional): The CPUs the thread (and its scheduler) is
+            pinned to (see `fragscapy.affinity`). Default is 'None' (not
+            pinned).
         *args: The args passed to the `Thread` class.
         **kwargs: The kwargs passed to the `Thread` class.
 
+    Attributes:
+        sender: The sender used to send the packets resulting from the OUTPUT
+            modlist.
+        scheduler (:obj:`DelayScheduler`): The scheduler sending the delayed
+            packets, so the thread never sleeps.
+        pcap_sink (:obj:`PcapSink`): The sink writing the pcap files.
+        offloaded: The number of connections offloaded to the kernel.
+        bypassed: The number of packets accepted unmodified because the
+            thread was overloaded (see `budget` and `max_backlog`).
+        heartbeat: The time (`time.monotonic()`) the thread started to
+            process its current packet, 'None' before the first one.
+        busy: 'True' while the thread processes a batch (i.e. it is not
+            waiting for packets).
+        error: The exception that ended the thread, 'None' if there was
+            none.
+        cpus (set): The CPUs the thread is pinned to, 'None' if it is not.
+
     Examples:
         Assuming the nfqueue, modlist1, modlist2 and modlist3 objects exists
 
@@ -97,87 +263,180 @@ class EngineThread(threading.Thread):
 
     def __init__(self, nfqueue, *args, **kwargs):
         self._nfqueue = nfqueue
-        self._nfqueue_lock = threading.RLock()
-        self._input_modlist = kwargs.pop("input_modlist", None)
-        self._output_modlist = kwargs.pop("output_modlist", None)
-        self._input_lock = threading.Lock()
-        self._output_lock = threading.Lock()
+        self._snapshot = ModListSnapshot(
+            0, kwargs.pop("input_modlist", None),
+            kwargs.pop("output_modlist", None)
+        )
+        # Replacing a reference is atomic: the readers need no lock
         self._local_pcap = kwargs.pop("local_pcap", None)
         self._remote_pcap = kwargs.pop("remote_pcap", None)
-        self._local_pcap_lock = threading.Lock()
-        self._remote_pcap_lock = threading.Lock()
+        self._pool = kwargs.pop("pool", None)
+        self.sender = kwargs.pop("sender", None)
+        if self.sender is None:
+            self.sender = RawSender()
+        self.scheduler = kwargs.pop("scheduler", None)
+        if self.scheduler is None:
+            self.scheduler = DelayScheduler(RawSender())
+        self.pcap_sink = kwargs.pop("pcap_sink", None)
+        # Without a sink given, the thread starts and stops its own
+        self._own_pcap_sink = self.pcap_sink is None
+        if self._own_pcap_sink:
+            self.pcap_sink = PcapSink()
+        self._offload = kwargs.pop("offload", False)
+        self.offloaded = 0
+        self._gso = kwargs.pop("gso", False)
+        # The generation of the modlists the offload is decided for and
+        # whether they leave every packet unchanged
+        self._offload_generation = None
+        self._leaves_unchanged = False
+        self._mtu = kwargs.pop("mtu", DEFAULT_MTU)
+        self._budget = kwargs.pop("budget", None)
+        self._max_backlog = kwargs.pop("max_backlog", None)
+        self.cpus = kwargs.pop("cpus", None)
+        self.bypassed = 0
+        self.heartbeat = None
+        self.busy = False
+        self.error = None
+        # The batch being processed, the index of its first packet without a
+        # verdict, whether the thread is about to give it (see `._claim()`)
+        # and whether the thread has been replaced (see `.abandon()`),
+        # changed together under the lock
+        self._lock = threading.Lock()
+        self._batch = []
+        self._next = 0
+        self._claimed = False
+        self._abandoned = False
+        # The generation of the modlists the plans of the packets without
+        # payload are computed for and these plans
+        self._meta_generation = None
+        self._meta_plans = None
         super(EngineThread, self).__init__(*args, **kwargs)
 
+    @property
+    def snapshot(self):
+        """The `ModListSnapshot` (input and output modlists) used for the
+        next packets. Read/Write is thread-safe: setting it replaces both
+        modlists at once."""
+        return self._snapshot
+
+    @snapshot.setter
+    def snapshot(self, new):
+        self._snapshot = new
+
     @property
     def input_modlist(self):
         """The modlist applied to the packets on INPUT chain. Read/Write is
         thread-safe."""
-        with self._input_lock:
-            return self._input_modlist.copy()
+        return self._snapshot.input_modlist.copy()
 
     @input_modlist.setter
     def input_modlist(self, new):
-        with self._input_lock:
-            self._input_modlist = new
+        snapshot = self._snapshot
+        self._snapshot = snapshot._replace(
+            generation=snapshot.generation + 1, input_modlist=new
+        )
 
     @property
     def output_modlist(self):
         """The modlist applied to the packets on OUTPUT chain. Read/Write is
         thread-safe."""
-        with self._output_lock:
-            return self._output_modlist.copy()
+        return self._snapshot.output_modlist.copy()
 
     @output_modlist.setter
     def output_modlist(self, new):
-        with self._output_lock:
-            self._output_modlist = new
+        snapshot = self._snapshot
+        self._snapshot = snapshot._replace(
+            generation=snapshot.generation + 1, output_modlist=new
+        )
 
     @property
     def local_pcap(self):
         """A pcap file where the packets of the local side should be dumped
         to. 'None' means the packets are not dumped. Read/Write is
         thread-safe."""
-        with self._local_pcap_lock:
-            return self._local_pcap
+        return self._local_pcap
 
     @local_pcap.setter
     def local_pcap(self, new):
-        with self._local_pcap_lock:
-            self._local_pcap = new
+        self._local_pcap = new
 
     @property
     def remote_pcap(self):
         """A pcap file where the packets of the remote side should be dumped
         to. 'None' means the packets are not dumped. Read/Write is
         thread-safe."""
-        with self._remote_pcap_lock:
-            return self._remote_pcap
+        return self._remote_pcap
 
     @remote_pcap.setter
     def remote_pcap(self, new):
-        with self._remote_pcap_lock:
-            self._remote_pcap = new
+        self._remote_pcap = new
+
+    def _offload_flow(self, packet):
+        """Offloads the connection of `packet` to the kernel if the modlists
+        leave every packet unchanged.
+
+        Returns:
+            True if the packet was offloaded (its verdict is given), False if
+            it should be processed.
+        """
+        snapshot = self._snapshot
+        if snapshot.generation != self._offload_generation:
+            self._offload_generation = snapshot.generation
+            self._leaves_unchanged = _leaves_unchanged(snapshot, self._gso)
+        if not self._leaves_unchanged:
+            return False
+        if self._claim():
+            packet.offload()
+            self.offloaded += 1
+        return True
+
+    def _is_late(self, packet):
+        """Has `packet` waited more than the budget since it was read ?"""
+        return (self._budget is not None
+                and time.monotonic() - packet.arrival > self._budget)
+
+    def _process_metadata(self, packet):
+        """Accepts or drops `packet`, queued without its payload, as its
+        modlist would (i.e. with the probability of its plan)."""
+        snapshot = self._snapshot
+        if snapshot.generation != self._meta_generation:
+            self._meta_generation = snapshot.generation
+            self._meta_plans = plan_modlists(snapshot.input_modlist,
+                                             snapshot.output_modlist)
+        plan = self._meta_plans['OUTPUT' if packet.is_output else 'INPUT']
+        if not is_verdict_only(plan):
+            raise EngineError(
+                "Can't apply a modlist needing the content of the packets to "
+                "a queue copying only their metadata"
+            )
+        if not self._claim():
+            return
+        if random.random() < plan.drop_proba:
+            packet.drop()
+        else:
+            packet.accept()
 
     def _process_input(self, packet):
         """Applies the input modifications on `packet`."""
         # Dump the packet before anything else
-        if self.remote_pcap is not None:
-            scapy.utils.wrpcap(self.remote_pcap, packet.scapy_pkt,
-                               append=True)
+        if self._remote_pcap is not None:
+            self.pcap_sink.dump(self._remote_pcap, [_packet_bytes(packet)])
+
+        # A single load: the modlist can not change during the processing
+        modlist = self._snapshot.input_modlist
 
         # Checks that the INPUT modlist is populated
-        with self._input_lock:
-            if self._input_modlist is None:
-                raise EngineError(
-                    "Can't run the engine with no INPUT modlist"
-                )
+        if modlist is None:
+            raise EngineError(
+                "Can't run the engine with no INPUT modlist"
+            )
 
         # Put the packet in a packet list
-        packetlist = PacketList()
-        packetlist.add_packet(packet.scapy_pkt)
+        packetlist = _new_packetlist(packet, self._mtu)
 
-        with self._input_lock:
-            packetlist = self._input_modlist.apply(packetlist)
+        packetlist = modlist.apply(packetlist)
+        if not self._claim():
+            return
 
         pl_len = len(packetlist)
 
@@ -196,12 +455,13 @@ class EngineThread(threading.Thread):
             packet.drop()
         else:
             # If there is at least 1 packet in the result, send it
-            # Modify the initial packet with the new content
-            packet.scapy_pkt = packetlist[0].pkt
+            # Modify the initial packet with the new content (unless no mod
+            # looked at it, it is then still the original payload)
+            if packetlist[0].is_dissected():
+                packet.scapy_pkt = packetlist[0].pkt
             # Dump the packet just before sending it
-            if self.local_pcap is not None:
-                scapy.utils.wrpcap(self.local_pcap, packet.scapy_pkt,
-                                   append=True)
+            if self._local_pcap is not None:
+                self.pcap_sink.dump(self._local_pcap, [_packet_bytes(packet)])
             # Mangle the packet to the NFQUEUE (so it is sent
             # correctly to the local application)
             packet.mangle()
@@ -209,35 +469,42 @@ class EngineThread(threading.Thread):
     def _process_output(self, packet):
         """Applies the output modifications on `packet`."""
         # Dump the packet before anything else
-        if self.local_pcap is not None:
-            scapy.utils.wrpcap(self.local_pcap, packet.scapy_pkt,
-                               append=True)
+        if self._local_pcap is not None:
+            self.pcap_sink.dump(self._local_pcap, [_packet_bytes(packet)])
+
+        # A single load: the modlist can not change during the processing
+        modlist = self._snapshot.output_modlist
 
         # Checks that the OUTPUT modlist is populated
-        with self._output_lock:
-            if self._output_modlist is None:
-                raise EngineError(
-                    "Can't run the engine with no OUTPUT modlist"
-                )
+        if modlist is None:
+            raise EngineError(
+                "Can't run the engine with no OUTPUT modlist"
+            )
 
         # Put the packet in a packet list
-        packetlist = PacketList()
-        packetlist.add_packet(packet.scapy_pkt)
+        packetlist = _new_packetlist(packet, self._mtu)
 
-        with self._output_lock:
-            packetlist = self._output_modlist.apply(packetlist)
+        packetlist = modlist.apply(packetlist)
+        # Nothing is sent if the packet was accepted meanwhile
+        if not self._claim():
+            return
 
         # Dump the packets just before sending it
-        if self.remote_pcap is not None:
-            scapy.utils.wrpcap(
-                self.remote_pcap,
-                [pkt.pkt for pkt in packetlist],
-                append=True
-            )
-        # Send all the packets resulting
-        packetlist.send_all()
-        # Drop the old packet in NFQUEUE
-        packet.drop()
+        if self._remote_pcap is not None:
+            self.pcap_sink.dump(self._remote_pcap,
+                                [pkt.raw for pkt in packetlist])
+        if (len(packetlist) == 1 and not packetlist[0].is_dissected()
+                and packetlist[0].delay <= MIN_TIME_DELAY):
+            # The packet is still the original one, let it through as is
+            packet.accept()
+            return
+        try:
+            # Send all the packets resulting (the delayed ones are sent later
+            # by the scheduler, so the next packets are not blocked)
+            self.scheduler.dispatch(packetlist, packet.arrival, self.sender)
+        finally:
+            # Drop the old packet in NFQUEUE
+            packet.drop()
 
     def run(self):
         """Runs the main loop of the thread.
@@ -248,26 +515,203 @@ class EngineThread(threading.Thread):
         Raises:
             EngineError: There is a modlist (input or output) missing.
         """
-        # Process the queue infinitely
-        if not self.is_stopped():
-            for packet in self._nfqueue:
-                with self._nfqueue_lock:
-                    if self.is_stopped():
-                        break
-                    if packet.is_input:
-                        self._process_input(packet)
-                    else:
-                        self._process_output(packet)
+        # Before starting the scheduler, which inherits the affinity
+        pin(self.cpus)
+        self.scheduler.start()
+        if self._own_pcap_sink:
+            self.pcap_sink.start()
+        try:
+            self._process_batches()
+        except Exception as e:  # pylint: disable=broad-except
+            # The queue is left open for the thread restarting in place of
+            # this one (see `Watchdog`)
+            self.error = e
+            traceback.print_exc()
+            self.fail_open()
+        else:
+            if not self._abandoned:
+                # Closed by the thread itself so no verdict is sent on a
+                # closed connection
+                self._nfqueue.close()
+        finally:
+            self.busy = False
+            self.scheduler.stop()
+            self.scheduler.join()
+            self.sender.close()
+            if self._own_pcap_sink:
+                self.pcap_sink.stop()
+                self.pcap_sink.join()
+
+    def _process_batches(self):
+        """Processes the queue until it is stopped, batch by batch (the
+        verdicts of a batch are sent by the nfqueue before reading the next
+        one). A stop only ends the loop once the current batch is
+        processed."""
+        for batch in self._nfqueue.batches():
+            self.process_batch(batch)
+            if self._abandoned:
+                return
+
+    def process_batch(self, batch):
+        """Processes the packets of a batch read from the nfqueue. Their
+        verdicts are sent by `NFQueue.flush_verdicts()`."""
+        with self._lock:
+            if self._abandoned:
+                return
+            self._batch, self._next = batch, 0
+        self.heartbeat = time.monotonic()
+        self.busy = True
+        # Fail open on the whole batch if the next ones pile up
+        overloaded = (self._max_backlog is not None
+                      and self._nfqueue.backlog() > self._max_backlog)
+        for i, packet in enumerate(batch):
+            with self._lock:
+                if self._abandoned:
+                    return  # The verdicts are given by the watchdog
+                self._next, self._claimed = i, False
+            self.heartbeat = time.monotonic()
+            try:
+                self._process_packet(packet, overloaded)
+            except fnfqueue.PacketInvalidException:
+                if not self._abandoned:
+                    raise
+                return  # Accepted by the watchdog meanwhile
+        with self._lock:
+            self._next = len(batch)
+        self.busy = False
+
+    def poll(self):
+        """Processes the packets already received by the nfqueue (at most
+        a batch), without waiting for more, and sends their verdicts. It is
+        used when an event loop reads the nfqueue instead of the thread (see
+        `fragscapy.asyncengine`), the thread is then never started.
+
+        Returns:
+            'True' if packets were processed (more may be waiting), 'False'
+            if there was none.
+        """
+        try:
+            batch = self._nfqueue.poll_batch()
+        except StopIteration:
+            return False
+        if not batch:
+            return False
+        self.process_batch(batch)
+        self._nfqueue.flush_verdicts()
+        return True
+
+    def _process_packet(self, packet, overloaded=False):
+        """Gives the verdict of `packet` (or hands it to the pool)."""
+        if not packet.has_payload:
+            self._process_metadata(packet)
+        elif overloaded or self._is_late(packet):
+            if self._claim():
+                packet.accept()
+                self.bypassed += 1
+        elif self._offload and self._offload_flow(packet):
+            pass
+        elif self._pool is not None:
+            # The verdict is given by the pool
+            if self._claim():
+                self._pool.submit(packet)
+        elif packet.is_input:
+            self._process_input(packet)
+        else:
+            self._process_output(packet)
+
+    def is_stalled(self, timeout, now=None):
+        """Has the thread been processing the same packet for more than
+        `timeout` seconds ?"""
+        if now is None:
+            now = time.monotonic()
+        return self.busy and now - self.heartbeat > timeout
+
+    def _claim(self):
+        """Keeps the watchdog from accepting the current packet (see
+        `.abandon()`), before the thread gives its verdict or sends the
+        resulting packets.
+
+        Returns:
+            'False' if the thread was abandoned: the packet is accepted by
+            the watchdog, the thread must neither give its verdict nor send
+            anything. 'True' otherwise.
+        """
+        with self._lock:
+            if self._abandoned:
+                return False
+            self._claimed = True
+            return True
+
+    def fail_open(self):
+        """Accepts unmodified the packets of the current batch that have no
+        verdict yet and sends the verdicts of the batch (see
+        `NFQueue.fail_open()`)."""
+        with self._lock:
+            pending = self._batch[self._next:]
+            self._next = len(self._batch)
+        self._nfqueue.fail_open(pending)
+
+    def abandon(self):
+        """Gives up on a stalled thread: the packets of its batch without a
+        verdict, including the one it is stuck on, are accepted unmodified.
+        The thread gives no other verdict, sends nothing more and ends
+        whenever that packet is done. Its nfqueue is left open, for a new
+        thread to read it.
+
+        The packet the thread is giving its verdict for (see `._claim()`) is
+        left to the thread."""
+        with self._lock:
+            self._abandoned = True
+            start = self._next + 1 if self._claimed else self._next
+            pending = self._batch[start:]
+            self._next = len(self._batch)
+        self._nfqueue.fail_open(pending)
 
     def is_stopped(self):
         """Has the thread been stopped ?"""
-        with self._nfqueue_lock:
-            return self._nfqueue.is_stopped()
+        return self._nfqueue.is_stopped()
+
+    def stop(self):
+        """Stops the thread by stopping the nfqueue processing. It returns at
+        once, the thread ends once its current batch is processed."""
+        self._nfqueue.stop()
+        if self.ident is None:
+            # Never started: no thread will close the nfqueue
+            self._nfqueue.close()
+
+
+class Watchdog(threading.Thread):
+    """Thread supervising the engine threads.
+
+    Every `interval` seconds, it asks the engine to check the heartbeat of
+    its threads (see `Engine.check_engine_threads()`): the threads that died
+    (e.g. a mod raised an exception) or stalled on a packet are replaced.
+
+    Args:
+        engine (:obj:`Engine`): The engine whose threads are supervised.
+        interval (float, optional): The time (in seconds) between 2 checks.
+            Default is `WATCHDOG_INTERVAL`.
+
+    Examples:
+        >>> watchdog = Watchdog(engine)
+        >>> watchdog.start()
+        >>> watchdog.stop()
+        >>> watchdog.join()
+    """
+    def __init__(self, engine, interval=WATCHDOG_INTERVAL):
+        super(Watchdog, self).__init__(daemon=True)
+        self._engine = engine
+        self._interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        """Checks the engine threads until the watchdog is stopped."""
+        while not self._stop_event.wait(self._interval):
+            self._engine.check_engine_threads()
 
     def stop(self):
-        """Stops the thread by stopping the nfqueue processing."""
-        with self._nfqueue_lock:
-            self._nfqueue.stop()
+        """Stops the watchdog."""
+        self._stop_event.set()
 
 
 # pylint: disable=too-many-instance-attributes
@@ -328,6 +772,72 @@ class Engine(object):
         append (bool, optional): If 'True', do not erase the existing files
             (modif, stdout and stderr), append the results to them instead.
             Default is 'False'
+        workers (int, optional): The number of worker processes that apply
+            the modifications. Default is '0' which means the modifications
+            are applied by the engine threads themselves (i.e. limited to
+            1 CPU core by the GIL).
+        worker_threads (int, optional): The number of worker threads that
+            apply the modifications, shared by all the queues. They only run
+            in parallel on a free-threaded (no-GIL) build of CPython. Can't
+            be used with `workers`. Default is '0' (no worker threads).
+        sender (str, optional): The backend used to send the packets
+            resulting from the OUTPUT modlist: 'raw' (an AF_PACKET socket
+            for any interface) or 'txring' (the TX ring of an AF_PACKET
+            socket bound to `iface`). Default is 'raw'.
+        iface (str, optional): The interface the 'txring' sender sends the
+            frames on. Default is 'None' which means Scapy's default
+            interface.
+        qdisc_bypass (bool, optional): Make the 'txring' sender bypass the
+            qdisc layer of the interface. Default is 'False'.
+        nf_backend (str, optional): The backend used to insert the NF rules:
+            'iptables' (ip(6)tables-restore) or 'nftables' (a dedicated
+            table using sets). Default is 'iptables'.
+        offload (bool, optional): Insert the offload rules and offload the
+            connections to the kernel during the tests whose modlists leave
+            every packet unchanged (see `Mod.passthrough_after()`). The
+            offloaded packets are not dumped in the pcap files. Default is
+            'False'.
+        kernel_plans (bool, optional): For each test, replace the NFQUEUE
+            rules of the chains whose modlist only drops, delays or
+            duplicates the packets by kernel rules (see `fragscapy.planner`).
+            The delays and duplications need `iface` (a netem qdisc replaces
+            its root qdisc during the test). Default is 'False'.
+        bypass_empty (bool, optional): For each test, remove the NFQUEUE
+            rules of the chains whose modlist leaves the packets unchanged
+            (e.g. all its mods are optional and not used), so the packets
+            of the baseline tests never leave the kernel. Can't be used
+            with `local_pcap` or `remote_pcap`. Default is 'False'.
+        mtu (int, optional): The size the GSO packets of the OUTPUT chain
+            (see the `gso` option of the NF rules) are segmented to before
+            applying the modlist. Default is `DEFAULT_MTU`.
+        packet_budget (float, optional): The time (in seconds) a packet can
+            wait in an engine thread before being processed. The late
+            packets are accepted unmodified. Default is 'None' (no
+            deadline).
+        max_backlog (int, optional): The number of packets waiting to be
+            read from a queue above which they are accepted unmodified.
+            Default is 'None' (no limit).
+        split_chains (bool, optional): Read the OUTPUT and the INPUT queues
+            of each pair on their own connection, in their own thread, so a
+            slow chain does not delay the other one. Default is 'False' (1
+            thread per pair of queues).
+        watchdog (bool, optional): Supervise the engine threads: a thread
+            that died or stalled is replaced (with the current modlists),
+            the packets of its batch are accepted unmodified and the
+            incident is recorded on the current test. Default is 'False'.
+        stall_timeout (float, optional): The time (in seconds) a packet can
+            be processed before the watchdog considers its thread stalled.
+            Default is `DEFAULT_STALL_TIMEOUT`.
+        cpu_affinity (bool, optional): Pin the thread reading each queue
+            (and its netlink connection) to the CPUs whose packets the
+            kernel sends to this queue, and each worker to its own CPU (see
+            `fragscapy.affinity`). The rules balancing over several queues
+            then use `--queue-cpu-fanout`. Default is 'False' unless `cpus`
+            or `numa_node` is given.
+        cpus (str, optional): The CPUs to pin to, as a CPU list (e.g.
+            '0-3,8'). Default is all the CPUs the process can run on.
+        numa_node (int, optional): Only pin to the CPUs of this NUMA node.
+            Default is 'None' (any node).
 
     Attributes:
         progressbar (bool): Shows a progressbar during the process if True.
@@ -347,6 +857,29 @@ class Engine(object):
             should dumped to. 'None' means the packets are not dumped.
         append (bool): If 'True', do not erase the existing files
             (modif, stdout and stderr), append the results to them instead.
+        workers (int): The number of worker processes that apply the
+            modifications. '0' if applied by the engine threads.
+        worker_threads (int): The number of worker threads that apply the
+            modifications. '0' if applied by the engine threads.
+        offload (bool): Offload the connections left unchanged to the kernel
+            if 'True'.
+        kernel_plans (bool): Apply the modlists that can be planned with
+            kernel rules if 'True'.
+        bypass_empty (bool): Remove the NFQUEUE rules of the chains whose
+            modlist leaves the packets unchanged if 'True'.
+        packet_budget (float): The time a packet can wait before being
+            processed, 'None' if there is no deadline.
+        max_backlog (int): The number of packets waiting to be read above
+            which they are accepted unmodified, 'None' if there is no limit.
+        split_chains (bool): Read each chain in its own thread if 'True'.
+        stall_timeout (float): The time a packet can be processed before the
+            watchdog considers its thread stalled.
+        restarts (int): The number of engine threads restarted by the
+            watchdog.
+        cpu_affinity (bool): Pin the engine threads and the workers to CPUs
+            if 'True'.
+        planned_tests (int): The number of tests that used a kernel plan (or
+            bypassed the NFQUEUE) on at least one chain.
 
     Examples:
         >>> engine = Engine(Config("my_conf.json"))
@@ -378,9 +911,60 @@ class Engine(object):
         "Fail : {nb_failed}\n"
         "    {display_failed}\n"
         "Not Done : {nb_not_done}\n"
-        "    {display_not_done}"
+        "    {display_not_done}\n"
+        "Packets dropped by the queues : {nb_dropped}\n"
+        "    {display_dropped}\n"
+        "Packets accepted unmodified (overload) : {nb_bypassed}\n"
+        "    {display_bypassed}\n"
+        "Engine incidents : {nb_incidents}\n"
+        "    {display_incidents}"
+    )
+    # Template used to display the stats of each queue
+    STATS_TEMPLATE = (
+        "Queue {qnums} (batch size {batch_size}): {stats}"
+    )
+    # Template used to display the stats of each worker process
+    WORKER_STATS_TEMPLATE = (
+        "Worker {i}: {processed} packets processed"
+    )
+    # Template used to display the kind of workers used
+    WORKER_THREADS_STATS_TEMPLATE = (
+        "{nb_workers} worker threads (GIL {gil})"
+    )
+    # Template used to display the stats of the sender of each thread
+    SENDER_STATS_TEMPLATE = (
+        "Thread {i}: {stats}"
+    )
+    # Template used to display the packets accepted unmodified by each thread
+    BYPASS_STATS_TEMPLATE = (
+        "Thread {i}: {bypassed} packets accepted unmodified (overload)"
+    )
+    # Template used to display the number of threads restarted
+    WATCHDOG_STATS_TEMPLATE = (
+        "Watchdog: {restarts} engine threads restarted"
+    )
+    # Template used to display the connections offloaded by each thread
+    OFFLOAD_STATS_TEMPLATE = (
+        "Thread {i}: {offloaded} connections offloaded"
+    )
+    # Template used to display the number of tests using kernel plans
+    PLANS_STATS_TEMPLATE = (
+        "{planned} tests out of {nb_mods} run with kernel plans (or without "
+        "the NFQUEUE) on at least one chain"
+    )
+    # Template used to display the CPUs each thread is pinned to
+    AFFINITY_STATS_TEMPLATE = (
+        "Thread {i} (queues {qnums}): pinned to CPUs {cpus}"
+    )
+    # Template used to display the CPU each worker is pinned to
+    WORKER_AFFINITY_STATS_TEMPLATE = (
+        "Worker {i}: pinned to CPUs {cpus}"
+    )
+    # Template used to display the stats of the scheduler of each thread
+    SCHEDULER_STATS_TEMPLATE = (
+        "Thread {i}: {scheduled} packets delayed (max lateness "
+        "{max_lateness:.3f}s), {stats}"
     )
-
 
     def __init__(self, config, **kwargs):
         self.progressbar = kwargs.pop("progressbar", True)
@@ -390,6 +974,11 @@ class Engine(object):
         in_ml = ModListGenerator(config.input)
         out_ml = ModListGenerator(config.output)
         ml_iterator = mlgen_product(in_ml, out_ml)
+        # The mods used on each chain, to report the packets they need
+        self._chain_mods = collections.OrderedDict((
+            ('INPUT', [get_mod(mod['mod_name']) for mod in config.input]),
+            ('OUTPUT', [get_mod(mod['mod_name']) for mod in config.output]),
+        ))
         if self.progressbar:  # Use tqdm for showing progressbar
             ml_iterator = tqdm.tqdm(ml_iterator, total=len(in_ml)*len(out_ml))
 
@@ -407,23 +996,252 @@ class Engine(object):
             remote_pcap_pattern=kwargs.pop("remote_pcap", None)
         )
         self.append = kwargs.pop("append", False)
+        self.bypass_empty = kwargs.pop("bypass_empty", False)
+        # The packets of a bypassed chain can't be dumped
+        patterns = self.test_suite.test_patterns
+        if self.bypass_empty and (patterns.local_pcap_pattern is not None
+                                  or patterns.remote_pcap_pattern is not None):
+            raise EngineError("Can't bypass the NFQUEUE and dump the packets "
+                              "in pcap files")
+        self.workers = kwargs.pop("workers", 0)
+        self.worker_threads = kwargs.pop("worker_threads", 0)
+        if self.workers and self.worker_threads:
+            raise EngineError("Can't use both worker processes and worker "
+                              "threads")
+        if self.worker_threads > 1 and gil_enabled():
+            engine_warning(
+                "The GIL is enabled: the worker threads won't apply the "
+                "modifications in parallel (use worker processes or a "
+                "free-threaded Python)"
+            )
+        self.offload = kwargs.pop("offload", False)
+        self.kernel_plans = kwargs.pop("kernel_plans", False)
+        self.planned_tests = 0
+        mtu = kwargs.pop("mtu", DEFAULT_MTU)
+        self.packet_budget = kwargs.pop("packet_budget", None)
+        self.max_backlog = kwargs.pop("max_backlog", None)
+        self.split_chains = kwargs.pop("split_chains", False)
+        self.stall_timeout = kwargs.pop("stall_timeout",
+                                        DEFAULT_STALL_TIMEOUT)
+        self.restarts = 0
+        # The packets bypassed by the threads replaced by the watchdog
+        self._retired_bypassed = 0
+        self._watchdog = (Watchdog(self) if kwargs.pop("watchdog", False)
+                          else None)
+        # Protects the list of the engine threads (and their nfqueues),
+        # which the watchdog can change at any time
+        self._threads_lock = threading.Lock()
+        # The modlists and the test currently running, given to the threads
+        # that are restarted
+        self._snapshot = ModListSnapshot(0, None, None)
+        self._current_test = None
+        cpus = kwargs.pop("cpus", None)
+        numa_node = kwargs.pop("numa_node", None)
+        self.cpu_affinity = (kwargs.pop("cpu_affinity", False)
+                             or cpus is not None or numa_node is not None)
+        # The CPUs the threads and workers can be pinned to
+        self._cpus = (usable_cpus(cpus, numa_node) if self.cpu_affinity
+                      else None)
+        self.nf_backend = kwargs.pop("nf_backend", 'iptables')
+        if self.nf_backend not in NF_BACKENDS:
+            raise EngineError("Unknown netfilter backend '{}', should be one "
+                              "of {}".format(self.nf_backend,
+                                             ', '.join(NF_BACKENDS)))
+        sender = kwargs.pop("sender", 'raw')
+        if sender not in SENDERS:
+            raise EngineError("Unknown sender '{}', should be one of {}"
+                              .format(sender, ', '.join(SENDERS)))
+        iface = kwargs.pop("iface", None)
+        # Each thread (or worker process) has its own sender
+        new_thread_sender = functools.partial(
+            new_sender, sender, iface=iface,
+            qdisc_bypass=kwargs.pop("qdisc_bypass", False)
+        )
+        # The kernel plans of the current test (by chain) and the interface
+        # netem can use (only when it is explicitly given)
+        self._plans = None
+        self._netem_iface = iface
+        self._netem = (NetemQdisc(iface)
+                       if self.kernel_plans and iface is not None else None)
+        self._generation = 0  # The generation of the current modlists
+        # A single background writer for all the pcap files
+        self._pcap_sink = self._new_pcap_sink()
+        nb_workers = self.workers or self.worker_threads
+        self._worker_cpus = (worker_cpus(nb_workers, self._cpus)
+                             if self._cpus and nb_workers else None)
+        self._pool = (
+            WorkerPool(self.workers, sender_factory=new_thread_sender,
+                       pcap_sink=self._pcap_sink, mtu=mtu,
+                       cpus=self._worker_cpus)
+            if self.workers else
+            ThreadWorkerPool(self.worker_threads,
+                             sender_factory=new_thread_sender,
+                             pcap_sink=self._pcap_sink, mtu=mtu,
+                             cpus=self._worker_cpus)
+            if self.worker_threads else None
+        )
 
         # Populate the NFQUEUE-related objects
         self._nfrules = list()
         self._nfqueues = list()
-        self._qnums = set()
+        self._qnums = dict()  # qnum -> options of its NFQueue(s)
         for nfrule in config.nfrules:
-            self._nfrules.append(NFQueueRule(**nfrule))
-            qnum = nfrule.get('qnum', 0)
-            if not qnum % 2:
-                self._qnums.add(qnum)
-        for qnum in self._qnums:
-            self._nfqueues.append(NFQueue(qnum=qnum))
-
-        # Prepare the threads that catches, modify and send the packets
+            nfrule = NFQueueRule(**nfrule)
+            if self.offload:
+                nfrule.offload = True
+            if (self.cpu_affinity and nfrule.queues > 1
+                    and not nfrule.cpu_fanout):
+                # The queue of a packet must be chosen by its CPU for the
+                # consumer of the queue to run on the same CPU
+                engine_warning(
+                    "The rule using qnum {} balances the packets with "
+                    "--queue-cpu-fanout to match the CPU affinity"
+                    .format(nfrule.qnum)
+                )
+                nfrule.cpu_fanout = True
+            self._nfrules.append(nfrule)
+            options = self._qnums.setdefault(nfrule.qnum, dict(
+                queues=nfrule.queues, batch_size=1, gso=False,
+                copy_meta=True, max_len=None, rcvbuf=None, fail_open=False
+            ))
+            if options['queues'] != nfrule.queues:
+                raise EngineError(
+                    "Rules using qnum {} should balance over the same number "
+                    "of queues. Got {} and {}."
+                    .format(nfrule.qnum, options['queues'], nfrule.queues)
+                )
+            # If multiple rules use the same queue, the biggest batch (and
+            # queue length and buffer) wins, GSO and fail-open are used if a
+            # rule asks for it and the payload is copied if a rule needs it
+            options['batch_size'] = max(options['batch_size'],
+                                        nfrule.batch_size)
+            options['gso'] = options['gso'] or nfrule.gso
+            options['copy_meta'] = options['copy_meta'] and nfrule.copy_meta
+            options['max_len'] = _max_option(options['max_len'],
+                                             nfrule.max_len)
+            options['rcvbuf'] = _max_option(options['rcvbuf'], nfrule.rcvbuf)
+            options['fail_open'] = options['fail_open'] or nfrule.fail_open
+        _check_queue_ranges(self._qnums)
+        if any(options['copy_meta'] for options in self._qnums.values()):
+            self._check_verdict_only()
+        # 1 NFQueue (i.e. 1 thread) per pair of OUTPUT/INPUT queues, or per
+        # queue if the chains are split.
+        chains = (OUTPUT.name, INPUT.name) if self.split_chains else (None,)
         self._engine_threads = list()
-        for nfqueue in self._nfqueues:
-            self._engine_threads.append(EngineThread(nfqueue))
+        # The CPUs each thread is pinned to and the arguments of the engine
+        # threads, used to restart a thread
+        self._thread_cpus = list()
+        self._new_thread_sender = new_thread_sender
+        self._thread_kwargs = dict(
+            pool=self._pool, pcap_sink=self._pcap_sink, offload=self.offload,
+            mtu=mtu, budget=self.packet_budget, max_backlog=self.max_backlog
+        )
+        for qnum, options in self._qnums.items():
+            for index in range(options['queues']):
+                # The CPUs whose packets are sent to this queue
+                cpus = (fanout_cpus(index, options['queues'], self._cpus)
+                        if self._cpus else None)
+                for chain in chains:
+                    # The workers verdict the packets out of their batch
+                    factory = self._nfqueue_factory(
+                        qnum=qnum, index=index, chain=chain,
+                        batch_verdicts=self._pool is None, **options
+                    )
+                    # The netlink reader of the connection is started pinned
+                    factory = functools.partial(call_pinned, cpus, factory)
+                    nfqueue = factory()
+                    self._thread_cpus.append(cpus)
+                    self._nfqueues.append(nfqueue)
+                    self._engine_threads.append(
+                        self._new_engine_thread(nfqueue, options['gso'], cpus)
+                    )
+
+    def _nfqueue_factory(self, **kwargs):  # pylint: disable=no-self-use
+        """Returns the callable creating a `NFQueue` with `kwargs`."""
+        return functools.partial(NFQueue, **kwargs)
+
+    def _new_pcap_sink(self):  # pylint: disable=no-self-use
+        """Returns the sink writing all the pcap files."""
+        return PcapSink()
+
+    def _new_scheduler(self):
+        """Returns the scheduler sending the delayed packets of a
+        thread."""
+        return DelayScheduler(self._new_thread_sender())
+
+    def _new_engine_thread(self, nfqueue, gso=False, cpus=None):
+        """Returns a new `EngineThread` reading `nfqueue` (receiving the GSO
+        packets unsegmented if `gso`), pinned to `cpus`, with the current
+        modlists and pcap files."""
+        engine_thread = EngineThread(
+            nfqueue, sender=self._new_thread_sender(),
+            scheduler=self._new_scheduler(),
+            gso=gso, cpus=cpus, daemon=True, **self._thread_kwargs
+        )
+        engine_thread.snapshot = self._snapshot
+        if self._current_test is not None:
+            engine_thread.local_pcap = self._current_test.local_pcap
+            engine_thread.remote_pcap = self._current_test.remote_pcap
+        return engine_thread
+
+    def check_engine_threads(self):
+        """Replaces the engine threads that died or stalled (see
+        `Watchdog`).
+
+        The packets of the batch of such a thread are accepted unmodified. A
+        stalled thread can not be interrupted: it is abandoned and the new
+        thread reads the same nfqueue, so the packets waiting in it are
+        kept (and its drop counters go on). The incident is recorded on the
+        current test.
+        """
+        now = time.monotonic()
+        with self._threads_lock:
+            for i, engine_thread in enumerate(self._engine_threads):
+                if engine_thread.is_stopped() or engine_thread.ident is None:
+                    continue
+                if not engine_thread.is_alive():
+                    incident = "died ({!r})".format(engine_thread.error)
+                elif engine_thread.is_stalled(self.stall_timeout, now):
+                    incident = "stalled for more than {}s".format(
+                        self.stall_timeout
+                    )
+                    engine_thread.abandon()
+                else:
+                    continue
+                nfqueue = self._nfqueues[i]
+                # pylint: disable=protected-access
+                new_thread = self._new_engine_thread(
+                    nfqueue, engine_thread._gso, self._thread_cpus[i]
+                )
+                self._engine_threads[i] = new_thread
+                self._retired_bypassed += engine_thread.bypassed
+                new_thread.start()
+                self.restarts += 1
+                self._record_incident(
+                    "Engine thread {} (queues {}) {}, restarted".format(
+                        i, "/".join(str(q) for q in nfqueue.qnums), incident
+                    )
+                )
+
+    def _record_incident(self, incident):
+        """Records an incident on the current test (and warns about it)."""
+        test_case = self._current_test
+        if test_case is not None:
+            test_case.incidents.append(incident)
+        engine_warning(incident)
+
+    def _check_verdict_only(self):
+        """Checks that all the mods only accept or drop the packets, so they
+        can be applied by the queues copying only the metadata of the
+        packets. Raises `EngineError` if not."""
+        for chain, mods in self._chain_mods.items():
+            for mod in mods:
+                if not issubclass(mod, VERDICT_ONLY_MODS):
+                    raise EngineError(
+                        "The {} mod '{}' needs the content of the packets, "
+                        "it can't be used with the copy_meta option"
+                        .format(chain, mod.name or mod.__name__)
+                    )
 
     def _write_modlist_to_file(self, repeated_test_case):
         """Writes the modification details to the 'modif_file'."""
@@ -440,41 +1258,112 @@ class Engine(object):
 
     def _update_modlists(self, repeated_test_case):
         """Changes the modlist in all the threads."""
-        for engine_thread in self._engine_threads:
-            engine_thread.input_modlist = repeated_test_case.input_modlist
-            engine_thread.output_modlist = repeated_test_case.output_modlist
+        self._generation += 1
+        snapshot = ModListSnapshot(
+            self._generation,
+            repeated_test_case.input_modlist,
+            repeated_test_case.output_modlist
+        )
+        with self._threads_lock:
+            self._snapshot = snapshot
+            for engine_thread in self._engine_threads:
+                engine_thread.snapshot = snapshot
+        if self._pool is not None:
+            self._pool.set_modlists(repeated_test_case.input_modlist,
+                                    repeated_test_case.output_modlist)
+        if self.kernel_plans or self.bypass_empty:
+            self._update_kernel_plans(repeated_test_case)
         self._write_modlist_to_file(repeated_test_case)
 
+    def _update_kernel_plans(self, repeated_test_case):
+        """Replaces the NFQUEUE rules of the chains whose modlist can be
+        planned by the kernel rules of the plan (and puts them back for the
+        others). Without `kernel_plans`, only the chains whose modlist leaves
+        the packets unchanged are planned: their NFQUEUE rules are simply
+        removed."""
+        plans = plan_modlists(
+            repeated_test_case.input_modlist,
+            repeated_test_case.output_modlist,
+            self._netem_iface
+        )
+        for chain, plan in plans.items():
+            if ((not self.kernel_plans and plan != IDENTITY_PLAN)
+                    or (not self.bypass_empty and plan == IDENTITY_PLAN)):
+                plans[chain] = None
+        if all(plan is None for plan in plans.values()):
+            plans = None  # The NFQUEUE is used on both chains
+        else:
+            self.planned_tests += 1
+        if plans == self._plans:
+            return
+        if self._netem is not None:
+            self._netem.update(plans['OUTPUT'] if plans else None)
+
+        def update():
+            for nfrule in self._nfrules:
+                nfrule.plans = plans or dict()
+        # A single transaction: the chains are never left unqueued
+        replace_rules(self._nfrules, update, self.nf_backend)
+        self._plans = plans
+
     def _update_pcap_files(self, test_case):
         """Changes the pcap files in all the threads."""
-        for engine_thread in self._engine_threads:
-            engine_thread.local_pcap = test_case.local_pcap
-            engine_thread.remote_pcap = test_case.remote_pcap
+        # Close the files of the previous test once they are written
+        self._pcap_sink.rotate()
+        with self._threads_lock:
+            self._current_test = test_case
+            for engine_thread in self._engine_threads:
+                engine_thread.local_pcap = test_case.local_pcap
+                engine_thread.remote_pcap = test_case.remote_pcap
+        if self._pool is not None:
+            self._pool.local_pcap = test_case.local_pcap
+            self._pool.remote_pcap = test_case.remote_pcap
 
     def _insert_nfrules(self):
-        """Inserts all the NF rules using `ip(6)tables`."""
-        for nfrule in self._nfrules:
-            nfrule.insert()
+        """Inserts all the NF rules using `ip(6)tables-restore` (one
+        transaction per family) or `nft` (one transaction)."""
+        insert_rules(self._nfrules, self.nf_backend)
 
     def _remove_nfrules(self):
-        """Removes all the NF rules using `ip(6)tables`."""
-        for nfrule in self._nfrules:
-            nfrule.remove()
+        """Removes all the NF rules using `ip(6)tables-restore` (one
+        transaction per family) or `nft` (one transaction)."""
+        remove_rules(self._nfrules, self.nf_backend)
 
     def _start_threads(self):
-        """Starts the engine threads used to process the packets."""
+        """Starts the engine threads used to process the packets (and the
+        worker processes if any)."""
+        self._pcap_sink.start()
+        if self._pool is not None:
+            self._pool.start()
         for engine_thread in self._engine_threads:
             engine_thread.start()
+        if self._watchdog is not None:
+            self._watchdog.start()
 
     def _stop_threads(self):
-        """Send the signal to stop the threads used to process the packets."""
+        """Send the signal to stop the threads used to process the packets
+        (and the worker processes if any)."""
         for engine_thread in self._engine_threads:
             engine_thread.stop()
+        if self._pool is not None:
+            self._pool.stop()
+
+    def _stop_watchdog(self):
+        """Stops the watchdog (if any): no thread is restarted anymore."""
+        if self._watchdog is not None and self._watchdog.ident is not None:
+            self._watchdog.stop()
+            self._watchdog.join()
 
     def _join_threads(self):
-        """Joins the engine threads used to process the packets."""
+        """Joins the engine threads used to process the packets (and the
+        worker processes if any)."""
         for engine_thread in self._engine_threads:
             engine_thread.join()
+        if self._pool is not None:
+            self._pool.join()
+        # Nothing can be dumped anymore: write what remains and close
+        self._pcap_sink.stop()
+        self._pcap_sink.join()
 
     def pre_run(self):
         """Runs all the actions that need to be run before `.run()`."""
@@ -502,7 +1391,11 @@ class Engine(object):
                     try:
                         if not interrupted:
                             self._update_pcap_files(test_case)
+                            drops = self._queue_drops()
+                            bypassed = self._bypassed()
                             test_case.run()
+                            test_case.drops = self._queue_drops() - drops
+                            test_case.bypassed = self._bypassed() - bypassed
                     except (KeyboardInterrupt, ProcessLookupError):
                         interrupted = True
             except (KeyboardInterrupt, ProcessLookupError):
@@ -510,10 +1403,31 @@ class Engine(object):
 
     def post_run(self):
         """Runs all the actions that need to be run after `.run()`."""
+        self._stop_watchdog()
         self.unbind_queues()
         self._stop_threads()
         self._join_threads()
         self._remove_nfrules()
+        if self._netem is not None:
+            self._netem.remove()
+
+    def _queue_drops(self):
+        """Updates the drop counters of all the queues and returns their
+        total."""
+        drops = read_queue_drops()
+        with self._threads_lock:
+            for nfqueue in self._nfqueues:
+                nfqueue.update_drops(drops)
+            return sum(nfqueue.stats.drops for nfqueue in self._nfqueues)
+
+    def _bypassed(self):
+        """Returns the number of packets accepted unmodified by all the
+        engine threads because they were overloaded."""
+        with self._threads_lock:
+            return self._retired_bypassed + sum(
+                engine_thread.bypassed
+                for engine_thread in self._engine_threads
+            )
 
     def unbind_queues(self):
         """Unbind any NFQUEUE open by the engine previously."""
@@ -525,9 +1439,13 @@ class Engine(object):
         display_limit = 80 // len("n°ii_j, ")  # Max 80 chars
 
         nb_tests, nb_mods, nb_passed, nb_failed, nb_not_done = 0, 0, 0, 0, 0
+        nb_dropped, nb_bypassed, nb_incidents = 0, 0, 0
         display_passed = list()
         display_failed = list()
         display_not_done = list()
+        display_dropped = list()
+        display_bypassed = list()
+        display_incidents = list()
         for repeated_test_case in self.test_suite.tests_generated:
             nb_mods += 1
             for test_case in repeated_test_case.tests_generated:
@@ -547,6 +1465,32 @@ class Engine(object):
                     test_case.test_id,
                     display_limit
                 )
+                if test_case.drops:
+                    # The result may be caused by the queues themselves
+                    nb_dropped += 1
+                    _append_to_display_list(
+                        display_dropped,
+                        repeated_test_case.test_id,
+                        test_case.test_id,
+                        display_limit
+                    )
+                if test_case.bypassed:
+                    # Some packets escaped the modifications
+                    nb_bypassed += 1
+                    _append_to_display_list(
+                        display_bypassed,
+                        repeated_test_case.test_id,
+                        test_case.test_id,
+                        display_limit
+                    )
+                if test_case.incidents:
+                    nb_incidents += 1
+                    _append_to_display_list(
+                        display_incidents,
+                        repeated_test_case.test_id,
+                        test_case.test_id,
+                        display_limit
+                    )
 
         results = self.RESULTS_TEMPLATE.format(
             nb_tests=nb_tests,
@@ -557,9 +1501,74 @@ class Engine(object):
             display_failed=", ".join(display_failed),
             nb_not_done=nb_not_done,
             display_not_done=", ".join(display_not_done),
+            nb_dropped=nb_dropped,
+            display_dropped=", ".join(display_dropped),
+            nb_bypassed=nb_bypassed,
+            display_bypassed=", ".join(display_bypassed),
+            nb_incidents=nb_incidents,
+            display_incidents=", ".join(display_incidents),
         )
         print(results)
 
+    def print_stats(self):
+        """Prints the statistics of each queue (and each worker) used by the
+        engine."""
+        for nfqueue in self._nfqueues:
+            print(self.STATS_TEMPLATE.format(
+                qnums="/".join(str(q) for q in nfqueue.qnums),
+                batch_size=nfqueue.batch_size,
+                stats=nfqueue.stats
+            ))
+        if self.kernel_plans or self.bypass_empty:
+            print(self.PLANS_STATS_TEMPLATE.format(
+                planned=self.planned_tests,
+                nb_mods=len(self.test_suite.tests_generated)
+            ))
+        if self._watchdog is not None:
+            print(self.WATCHDOG_STATS_TEMPLATE.format(restarts=self.restarts))
+        if self.packet_budget is not None or self.max_backlog is not None:
+            for i, engine_thread in enumerate(self._engine_threads):
+                print(self.BYPASS_STATS_TEMPLATE.format(
+                    i=i, bypassed=engine_thread.bypassed
+                ))
+        if self.offload:
+            for i, engine_thread in enumerate(self._engine_threads):
+                print(self.OFFLOAD_STATS_TEMPLATE.format(
+                    i=i, offloaded=engine_thread.offloaded
+                ))
+        if self.cpu_affinity:
+            for i, nfqueue in enumerate(self._nfqueues):
+                print(self.AFFINITY_STATS_TEMPLATE.format(
+                    i=i, qnums="/".join(str(q) for q in nfqueue.qnums),
+                    cpus=format_cpu_list(self._thread_cpus[i])
+                ))
+            for i, cpus in enumerate(self._worker_cpus or []):
+                print(self.WORKER_AFFINITY_STATS_TEMPLATE.format(
+                    i=i, cpus=format_cpu_list(cpus)
+                ))
+        if self.worker_threads:
+            print(self.WORKER_THREADS_STATS_TEMPLATE.format(
+                nb_workers=self.worker_threads,
+                gil="enabled" if gil_enabled() else "disabled"
+            ))
+        if self._pool is not None:
+            for i, processed in enumerate(self._pool.processed):
+                print(self.WORKER_STATS_TEMPLATE.format(
+                    i=i, processed=processed
+                ))
+        else:
+            for i, engine_thread in enumerate(self._engine_threads):
+                print(self.SENDER_STATS_TEMPLATE.format(
+                    i=i, stats=engine_thread.sender.stats
+                ))
+                scheduler = engine_thread.scheduler
+                if scheduler.scheduled:
+                    print(self.SCHEDULER_STATS_TEMPLATE.format(
+                        i=i, scheduled=scheduler.scheduled,
+                        max_lateness=scheduler.max_lateness,
+                        stats=scheduler.sender.stats
+                    ))
+
     def start(self):
         """Starts the test suite by running `.pre_run()`, `.run()` and
         finally `.post_run()`."""
@@ -568,12 +1577,27 @@ class Engine(object):
         self.post_run()
         if self.display_results:
             self.print_results()
+            self.print_stats()
 
     def check_nfrules(self):
         """Checks that the NF rules should work without errors."""
         self._insert_nfrules()
         self._remove_nfrules()
 
+    def check_packet_filters(self):
+        """Reports the packets queued by each NF rule and the packets each
+        mod has an effect on, so the NF rules can be restricted to the
+        packets the mods need."""
+        for nfrule in self._nfrules:
+            print("NF rule on qnum {}: queues {}"
+                  .format(nfrule.qnum, nfrule.packets))
+        for chain, mods in self._chain_mods.items():
+            for mod in mods:
+                print("{} mod {}: acts on {}".format(
+                    chain, mod.name or mod.__name__,
+                    mod.packets or "all packets"
+                ))
+
     def check_modlist_generation(self):
         """Checks that the ModListGenerator will generate all mods."""
         if not self.append:
@@ -0,0 +1,164 @@
+"""Segments the GSO packets caught on the OUTPUT chain.
+
+By default, the kernel segments a GSO packet (e.g. a TCP packet bigger than
+the MTU that the NIC would have segmented) before queuing it: each segment is
+then copied to userland and verdicted on its own. When the queue accepts the
+GSO packets (see `NFQueue`), the whole super-packet is queued once instead
+and it is segmented here, on the raw bytes, only if the modifications need
+the packets the remote host will actually see. The checksum of these packets
+is usually not computed yet either (it is left to the NIC) so it is fixed
+here as well.
+
+NFQUEUE does not give the segment size chosen by the kernel: the packets are
+segmented so each one fits in the MTU given to `segment()`. Only TCP over
+IPv4 and IPv6 (without extension headers) is segmented, the other packets
+only get their checksum fixed.
+"""
+
+import struct
+
+from scapy.utils import checksum
+
+
+# The MTU used to segment the packets if none is given
+DEFAULT_MTU = 1500
+
+_PROTO_TCP = 6
+_PROTO_UDP = 17
+# The offset of the checksum in the TCP and UDP headers
+_CHKSUM_OFFSETS = {_PROTO_TCP: 16, _PROTO_UDP: 6}
+
+# The TCP flags that are only kept on the first or the last segment
+_TCP_FIN = 0x01
+_TCP_PSH = 0x08
+_TCP_CWR = 0x80
+
+
+def _l4_offset(raw):
+    """Returns the offset of the L4 header of a raw IP packet and its
+    protocol, or 'None' if it can not be segmented (fragment, extension
+    headers, not TCP nor UDP, ...)."""
+    if len(raw) >= 40 and raw[0] >> 4 == 6:
+        proto, offset = raw[6], 40
+    elif len(raw) >= 20 and raw[0] >> 4 == 4:
+        if struct.unpack_from('!H', raw, 6)[0] & 0x3FFF:
+            return None  # A fragment
+        proto, offset = raw[9], (raw[0] & 0x0F) * 4
+    else:
+        return None
+    if proto not in _CHKSUM_OFFSETS:
+        return None
+    if len(raw) < offset + (20 if proto == _PROTO_TCP else 8):
+        return None
+    return offset, proto
+
+
+def _pseudo_header(raw, proto, l4_len):
+    """Returns the pseudo-header of the L4 checksum of a raw IP packet."""
+    if raw[0] >> 4 == 6:
+        return bytes(raw[8:40]) + struct.pack('!I3xB', l4_len, proto)
+    return bytes(raw[12:20]) + struct.pack('!xBH', proto, l4_len)
+
+
+def _set_l4_checksum(raw, offset, proto):
+    """Computes the TCP or UDP checksum of a raw IP packet (a `bytearray`)
+    in place."""
+    chksum_offset = offset + _CHKSUM_OFFSETS[proto]
+    raw[chksum_offset:chksum_offset+2] = b'\x00\x00'
+    l4_len = len(raw) - offset
+    chksum = checksum(
+        _pseudo_header(raw, proto, l4_len) + bytes(raw[offset:])
+    )
+    if proto == _PROTO_UDP and chksum == 0:
+        chksum = 0xFFFF  # 0 means no checksum in UDP
+    struct.pack_into('!H', raw, chksum_offset, chksum)
+
+
+def _set_ip_length(raw, ip_id=None):
+    """Updates the length (and the id) of the IP header of a raw IP packet
+    (a `bytearray`) in place, including the IPv4 header checksum."""
+    if raw[0] >> 4 == 6:
+        struct.pack_into('!H', raw, 4, len(raw) - 40)
+        return
+    struct.pack_into('!H', raw, 2, len(raw))
+    if ip_id is not None:
+        struct.pack_into('!H', raw, 4, ip_id)
+    ihl = (raw[0] & 0x0F) * 4
+    raw[10:12] = b'\x00\x00'
+    struct.pack_into('!H', raw, 10, checksum(bytes(raw[:ihl])))
+
+
+def fix_checksum(raw):
+    """Returns a raw IP packet with its TCP or UDP checksum computed.
+
+    Args:
+        raw: The raw IP packet (e.g. a GSO packet whose checksum is left to
+            the NIC).
+
+    Returns:
+        The raw packet with the right checksum (`bytes`), or `raw` itself if
+        it is not a TCP or UDP packet.
+    """
+    l4 = _l4_offset(raw)
+    if l4 is None:
+        return raw
+    fixed = bytearray(raw)
+    _set_l4_checksum(fixed, *l4)
+    return bytes(fixed)
+
+
+def segment(raw, mtu=DEFAULT_MTU):
+    """Segments a raw TCP packet in packets that fit in `mtu`.
+
+    Each segment gets the headers of the original packet with the sequence
+    number, the IP length (and the IPv4 id) and the checksums updated. FIN
+    and PSH are only kept on the last segment and CWR on the first one, like
+    the kernel does.
+
+    Args:
+        raw: The raw IP packet to segment.
+        mtu: The maximum size of the segments (IP header included). Default
+            is `DEFAULT_MTU`.
+
+    Returns:
+        The list of the raw segments (`bytes`). It only contains the packet
+        (with its checksum fixed) if it fits in `mtu` or can not be
+        segmented.
+
+    Examples:
+        >>> raws = segment(bytes(IP()/TCP()/Raw(b"A"*4000)), mtu=1500)
+        >>> [len(r) for r in raws]
+        [1500, 1500, 1120]
+    """
+    l4 = _l4_offset(raw)
+    if l4 is None:
+        return [raw]
+    offset, proto = l4
+    if proto != _PROTO_TCP or len(raw) <= mtu:
+        return [fix_checksum(raw)]
+    hdr_len = offset + (raw[offset+12] >> 4) * 4
+    mss = mtu - hdr_len
+    if mss <= 0 or len(raw) <= hdr_len:
+        return [fix_checksum(raw)]
+
+    headers = bytes(raw[:hdr_len])
+    ipv4 = raw[0] >> 4 == 4
+    ip_id = struct.unpack_from('!H', raw, 4)[0] if ipv4 else None
+    seq = struct.unpack_from('!I', raw, offset + 4)[0]
+    flags = raw[offset+13]
+    segments = []
+    for start in range(hdr_len, len(raw), mss):
+        seg = bytearray(headers)
+        seg += raw[start:start+mss]
+        first, last = start == hdr_len, start + mss >= len(raw)
+        struct.pack_into('!I', seg, offset + 4,
+                         (seq + start - hdr_len) & 0xFFFFFFFF)
+        seg[offset+13] = flags & ~(
+            (0 if last else _TCP_FIN | _TCP_PSH) | (0 if first else _TCP_CWR)
+        )
+        _set_ip_length(seg, ip_id)
+        if ip_id is not None:
+            ip_id = (ip_id + 1) & 0xFFFF
+        _set_l4_checksum(seg, offset, proto)
+        segments.append(bytes(seg))
+    return segments
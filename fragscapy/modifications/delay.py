@@ -76,6 +76,13 @@ class Delay(Mod):
         """See base class."""
         return self.delay_all or self.delay_index is not None
 
+    def passthrough_after(self):
+        """See base class."""
+        if (self.delay_all or self.delay_index is None
+                or self.delay_index < 0):
+            return None  # All, random or from the end: acts on any list
+        return self.delay_index
+
     def apply(self, pkt_list):
         """Delays the correct packet(s). See `Mod.apply` for more details."""
         l = len(pkt_list)
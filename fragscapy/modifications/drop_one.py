@@ -52,6 +52,12 @@ class DropOne(Mod):
         """See base class."""
         return self.drop_index is not None  # i.e. not random
 
+    def passthrough_after(self):
+        """See base class."""
+        if self.drop_index is None or self.drop_index < 0:
+            return None  # Random or from the end: acts on any list
+        return self.drop_index
+
     def apply(self, pkt_list):
         """Drops one packet. See `Mod.apply` for more details."""
         l = len(pkt_list)
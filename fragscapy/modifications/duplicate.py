@@ -53,6 +53,12 @@ class Duplicate(Mod):
         """See base class."""
         return self.duplicate_index is not None  # i.e. not random
 
+    def passthrough_after(self):
+        """See base class."""
+        if self.duplicate_index is None or self.duplicate_index < 0:
+            return None  # Random or from the end: acts on any list
+        return self.duplicate_index
+
     def apply(self, pkt_list):
         """Duplicates one packet. See `Mod.apply` for more details."""
         l = len(pkt_list)
@@ -31,6 +31,7 @@ class Ipv4Frag(Mod):
     name = "Ipv4Frag"
     doc = ("Fragments the IPv4 packets at the L3-layer\n"
            "ipv4_frag <size>")
+    packets = "IPv4 packets"
     _nb_args = 1
 
     def parse_args(self, *args):
@@ -38,6 +38,7 @@ class Ipv4Overlap(Mod):
            "  - 'overlapsize' is the size in octets of random data that\n"
            "        overlaps\n"
            "The final size of the packets is 'fragsize + overlapsize'.")
+    packets = "IPv4 packets"
 
     def parse_args(self, *args):
         try:
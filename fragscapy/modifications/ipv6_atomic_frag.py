@@ -34,6 +34,7 @@ class Ipv6AtomicFrag(Mod):
     doc = ("Fragments the IPv6 packets at the L3-layer and creates atomic "
            "fragments\n"
            "ipv6_atomic_frag <size>")
+    packets = "IPv6 packets"
     _nb_args = 1
 
     def parse_args(self, *args):
@@ -119,6 +119,7 @@ class Ipv6ExtHdrMixup(Mod):
     name = "Ipv6ExtHdrMixup"
     doc = ("Mixes-up the order of the extension headers in an IPv6 packet\n"
            "ipv6_ext_hdr_mixup")
+    packets = "IPv6 packets with extension headers"
     _nb_args = 0
 
     def is_deterministic(self):
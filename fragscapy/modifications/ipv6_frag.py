@@ -29,6 +29,7 @@ class Ipv6Frag(Mod):
     name = "Ipv6Frag"
     doc = ("Fragments the IPv6 packets at the L3-layer\n"
            "ipv6_frag <size>")
+    packets = "IPv6 packets"
     _nb_args = 1
 
     def parse_args(self, *args):
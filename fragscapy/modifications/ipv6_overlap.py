@@ -37,6 +37,7 @@ class Ipv6Overlap(Mod):
            "  - 'overlapsize' is the size in octets of random data that\n"
            "        overlaps\n"
            "The final size of the packets is 'fragsize + overlapsize'.")
+    packets = "IPv6 packets"
 
     def parse_args(self, *args):
         try:
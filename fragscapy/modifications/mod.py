@@ -21,7 +21,9 @@ class Mod(abc.ABC):
 
     For an even better implementation one could redefine the `.name` and
     `.doc` attribute in order to get cleaner usage. But defaults are provided
-    (respectively the class name and "No usage documented").
+    (respectively the class name and "No usage documented"). The `.packets`
+    attribute can also be redefined when the modification only has an effect
+    on some packets, so the NF rules can be restricted to those.
 
     Args:
         *args: The arguments of the mods.
@@ -30,6 +32,9 @@ class Mod(abc.ABC):
         name: The name of the modification.
         doc: A string that describes the goal and the syntax of the
             modification. It is displayed when requesting the usage.
+        packets: A short description of the packets the modification has an
+            effect on ('None' means all the packets). It is reported when
+            checking a config file.
 
     Raises:
         ValueError: incorrect number of parameters.
@@ -37,6 +42,7 @@ class Mod(abc.ABC):
 
     name = None
     doc = None
+    packets = None
     _nb_args = -1
 
     def __init__(self, *args):
@@ -47,6 +53,33 @@ class Mod(abc.ABC):
         """Is the modification deterministic (no random)."""
         return True
 
+    def is_reentrant(self):  # pylint: disable=no-self-use
+        """Can the modification be applied by several threads at once ?
+
+        A reentrant modification only modifies the `PacketList` it is given
+        (which belongs to a single intercepted packet) and never its own
+        attributes, so the worker threads of the engine can apply it in
+        parallel. Base class returns 'True', a modification that keeps a
+        state between calls (or whose side effects must not interleave, e.g.
+        multi-line outputs) should redefine it: the modlists containing it
+        are then applied by one worker thread at a time.
+        """
+        return True
+
+    def passthrough_after(self):  # pylint: disable=no-self-use
+        """Returns the index of the `PacketList` from which the modification
+        acts, or 'None' if it may change any packet list.
+
+        A modification acting on a fixed index (e.g. `drop_one 2`) leaves
+        the lists of at most that many packets unchanged. The modlists are
+        applied to each intercepted packet on its own, so the engine uses it
+        to offload to the kernel (see `PacketWrapper.offload()`) the
+        connections whose packets are all left unchanged (see
+        `ModList.passthrough_after()`). Base class returns 'None', a
+        modification that only acts from a fixed index should redefine it.
+        """
+        return None
+
     def parse_args(self, *args):
         """Parses the arguments and extract the necessary data from it.
 
@@ -51,6 +51,10 @@ class Reorder(Mod):
         """See base class."""
         return self.method != METHOD.RANDOM
 
+    def passthrough_after(self):
+        """See base class."""
+        return 1  # A single packet can't be reordered
+
     def apply(self, pkt_list):
         """Reorder the packets. See `Mod.apply` for more details."""
         if self.method == METHOD.REVERSE:
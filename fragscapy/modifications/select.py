@@ -39,6 +39,11 @@ class Select(Mod):
                 raise ValueError("Non integer parameter. "
                                  "Got {}".format(arg))
 
+    def passthrough_after(self):
+        """See base class."""
+        # Only selecting the first packet leaves a single packet unchanged
+        return 1 if self.sequence == [0] else None
+
     def apply(self, pkt_list):
         """Keeps only the wanted packets. See `Mod.apply` for more details."""
         new_pl = PacketList()
@@ -21,6 +21,11 @@ class Summary(Mod):
            "summary")
     _nb_args = 0
 
+    def is_reentrant(self):
+        """The lines of the packets of concurrent calls would be mixed up.
+        See base class."""
+        return False
+
     def apply(self, pkt_list):
         """Prints the summary for each packet.See `Mod.apply` for more
         details."""
@@ -41,6 +41,7 @@ class TcpOverlap(Mod):
            "  - 'append' is either 'before' of 'after' and indicates where to\n"
            "        add the random data that overlaps.\n"
            "The final size of the TCP payload is 'fragsize + overlapsize'")
+    packets = "TCP segments with a payload"
     _nb_args = 3
 
     def parse_args(self, *args):
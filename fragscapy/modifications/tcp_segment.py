@@ -28,6 +28,7 @@ class TcpSegment(Mod):
     name = "TcpSegment"
     doc = ("Segments the TCP packets at the L4-layer\n"
            "tcp_segment <segmentsize>")
+    packets = "TCP segments with a payload"
     _nb_args = 1
 
     def parse_args(self, *args):
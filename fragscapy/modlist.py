@@ -1,5 +1,8 @@
 """Defines a list of `Mod` objects."""
 
+import math
+
+
 class ModList(list):
     """A list modifications.
 
@@ -60,3 +63,22 @@ class ModList(list):
     def is_deterministic(self):
         """Are all the mod deterministic (i.e. non-random)."""
         return all(mod.is_deterministic() for mod in self)
+
+    def is_reentrant(self):
+        """Are all the mods reentrant (i.e. can be applied by several
+        threads at once). See `Mod.is_reentrant`."""
+        return all(mod.is_reentrant() for mod in self)
+
+    def passthrough_after(self):
+        """Returns the number of packets up to which the packet lists are
+        left unchanged by all the mods ('None' if at least one mod may
+        change any list, infinite for an empty modlist). A mod leaving a
+        list unchanged keeps its length, so the next mod sees the same list.
+        See `Mod.passthrough_after`."""
+        after = math.inf
+        for mod in self:
+            mod_after = mod.passthrough_after()
+            if mod_after is None:
+                return None
+            after = min(after, mod_after)
+        return after
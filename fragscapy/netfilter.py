@@ -6,6 +6,12 @@ userland and modify them before sending them. To access them, this module uses
 
 Here it can be used to capture traffic (with an optional filter on protocol,
 host and/or port) and cast them to Scapy packets so they can be manipulated.
+The packets can also be filtered on their TCP payload, TCP flags or length so
+the packets the modifications have no effect on never leave the kernel. In the
+same way, once the modifications leave the rest of a connection unchanged, the
+packet can be offloaded (see `PacketWrapper.offload()`): its connection is
+marked and its next packets skip the queue. The NFQUEUE target of a chain can
+also be replaced by the kernel rules of a plan (see `fragscapy.planner`).
 Once the python modification is done, one would simply invoke the `.mangle()`
 or `.drop()` methods to notify Netfilter of either a new packet or the want to
 drop the packet. So far, the only L3-protocols supported are IPv4 and IPv6.
@@ -14,21 +20,74 @@ being sent to the user.
 
 The main objects to use are `NFQueueRule` which is used to manipulate iptables
 and ip6tables rules and `NFQueue`, the queue that can be iterated over to
-access the packets in the NFQUEUE target.
+access the packets in the NFQUEUE target. The rules of several `NFQueueRule`
+can be inserted (and removed) together with `insert_rules()` and
+`remove_rules()`: they are applied in a single `ip(6)tables-restore
+--noflush` transaction per address family. With the 'nftables' backend, the
+rules are instead created in a dedicated nftables table, with the hosts and
+ports in sets so a single rule per chain (and group of similar rules) is
+evaluated whatever the number of hosts and ports.
+
+When the `NFQueue` is used with a `batch_size` greater than 1, the packets are
+read by batches and the verdicts are only sent to Netfilter once the whole
+batch has been processed. Consecutive accepts (resp. drops) are then regrouped
+in a single batch verdict, saving one netlink message per packet.
+
+The packets the kernel could not queue (the queue was full or the netlink
+socket buffer overflowed) are counted in the `QueueStats` of each `NFQueue`,
+from the counters of `NFQUEUE_PROC` and the ENOBUFS errors of the socket.
+
+An `NFQueue` created with `notify=True` can also be driven by an event loop
+instead of a blocking thread: a byte is written on a pipe (see
+`NFQueue.fileno()`) each time packets are received and `NFQueue.poll_batch()`
+returns them without waiting.
+
+The batch verdicts, the notifications and the reception with a timeout rely
+on private internals of `fnfqueue` (hence the pinned `FNFQUEUE_VERSION`):
+`check_fnfqueue()` makes sure they exist when the module is imported.
 """
 
 import abc
 import collections
 import os
+import socket
 import subprocess
+import threading
+import time
 
 import fnfqueue
 
 import scapy.data
 import scapy.layers.inet
 import scapy.layers.inet6
-import scapy.sendrecv
 
+from fragscapy.sender import thread_sender
+
+
+# The default number of packets read and verdicted at once by a `NFQueue`
+DEFAULT_BATCH_SIZE = 1
+
+# The default time (in seconds) a `NFQueue` waits for a packet before checking
+# again if it has been stopped
+DEFAULT_POLL_TIMEOUT = 0.1
+
+# The file with the counters of each queue bound (see `read_queue_drops()`)
+NFQUEUE_PROC = "/proc/net/netfilter/nfnetlink_queue"
+
+# The socket option setting the receive buffer size above `rmem_max` (from
+# asm-generic/socket.h, it needs CAP_NET_ADMIN)
+SO_RCVBUFFORCE = 33
+
+# The Netfilter hooks (from linux/netfilter.h) used to know on which chain a
+# packet was caught, whatever the queue it was sent to
+NF_INET_LOCAL_IN = 1
+NF_INET_LOCAL_OUT = 3
+
+# The flags of the skb info of a packet (from linux/netfilter/
+# nfnetlink_queue.h): its checksum is not computed yet (left to the NIC) and
+# it is a GSO packet (only received by the queues accepting GSO packets)
+SKB_CSUMNOTREADY = 1 << 0
+SKB_GSO = 1 << 1
 
 # Define a constant structure that holds the options for iptables together
 Chain = collections.namedtuple('Chain',
@@ -36,6 +95,26 @@ Chain = collections.namedtuple('Chain',
 OUTPUT = Chain('OUTPUT', '-d', '--dport', 0)
 INPUT = Chain('INPUT', '-s', '--sport', 1)
 
+# The bit of the packet mark (and of the connection mark) used to offload a
+# connection: the packets of a marked connection skip the queue
+OFFLOAD_MARK = 0x10000000
+
+# The bit of the packet mark used to send the packets to the netem qdisc of a
+# kernel plan (see `fragscapy.planner`)
+NETEM_MARK = 0x20000000
+
+# The TCP flags that can be used in the `tcp_flags` filter (iptables names)
+TCP_FLAGS = ('FIN', 'SYN', 'RST', 'PSH', 'ACK', 'URG', 'ECE', 'CWR')
+
+# The u32 expressions matching the TCP segments with a payload: they read the
+# first byte after the TCP header, which only succeeds if there is one. The
+# IPv6 one assumes the TCP header follows the IPv6 header (no extension
+# header).
+U32_TCP_PAYLOAD = {
+    socket.AF_INET: "0>>22&0x3C@12>>26&0x3C@0>>24=0:255",
+    socket.AF_INET6: "52>>26&0x3C@40>>24=0:255",
+}
+
 
 class NFQueueRule(object):  # pylint: disable=too-many-instance-attributes
     """A Netfilter rule to enable/disable the NFQUEUE.
@@ -69,6 +148,54 @@ class NFQueueRule(object):  # pylint: disable=too-many-instance-attributes
             respect, how this modules uses NFQUEUE, it should be even: qnum is
             used for OUTPUT and qnum+1 is used for INPUT. If qnum is odd, a
             `ValueError` is raised.
+        queues: The number of queues to balance the packets over (on each
+            chain). Default is '1'. With N queues, the OUTPUT chain uses the
+            queues qnum to qnum+N-1 and the INPUT chain uses the queues
+            qnum+N to qnum+2N-1, so the packets can be processed by N
+            threads in parallel.
+        cpu_fanout: When balancing over multiple queues, use the CPU id to
+            choose the queue (`--queue-cpu-fanout`) instead of a hash of
+            the flow. As long as the NIC steers a flow to the same CPU
+            (RSS/RPS), it stays on the same queue. Default is 'True'.
+        batch_size: The maximum number of packets the `NFQueue` of `qnum`
+            should read and verdict at once. It does not change the rules
+            themselves but is kept here so it can be configured alongside
+            the queue number. Default is '1' (no batching).
+        payload_only: Only queue the TCP segments carrying a payload (the
+            handshake and the pure ACKs are never sent to userland). It uses
+            the u32 match, and with IPv6, only the segments with no extension
+            header are matched. Default is 'False'.
+        tcp_flags: Only queue the TCP segments with the given flags, in the
+            iptables format '<mask> <comp>' (e.g. 'SYN,ACK,FIN,RST SYN'
+            matches the segments with only SYN set among the 4 flags).
+            Default is 'None' (all segments).
+        min_length: Only queue the packets of at least `min_length` bytes
+            (the length of the IP packet, headers included). Default is
+            'None' (all lengths).
+        offload: Add the rules that let the connections marked with
+            `OFFLOAD_MARK` skip the queue (see `PacketWrapper.offload()`).
+            Default is 'False'.
+        gso: Let the `NFQueue` of `qnum` receive the GSO packets as they
+            are instead of having the kernel segment them before queuing
+            them (see `fragscapy.gso`). Like `batch_size`, it is only kept
+            here to be configured alongside the queue number. Default is
+            'False'.
+        copy_meta: Only copy the metadata of the packets to the `NFQueue` of
+            `qnum`, not their content. Only the modlists that give a verdict
+            without reading the packets (e.g. `drop_proba`) can then be
+            used and the packets are not dumped in the pcap files. Default is
+            'False'.
+        max_len: The maximum number of packets waiting in the kernel for
+            the `NFQueue` of `qnum` (on each queue). Default is 'None' which
+            keeps the kernel default (1024).
+        rcvbuf: The size (in bytes) of the netlink receive buffer of the
+            `NFQueue` of `qnum`. Default is 'None' which keeps the system
+            default.
+        fail_open: Accept the packets instead of dropping them when the
+            queues of `qnum` are full. Default is 'False'.
+        queue_bypass: Accept the packets instead of dropping them when no
+            program listens on the queue (`--queue-bypass`), e.g. if the
+            engine stopped. Default is 'False'.
 
     Attributes:
         output_chain: Apply the rule on the output chain if 'True'.
@@ -83,6 +210,31 @@ class NFQueueRule(object):  # pylint: disable=too-many-instance-attributes
         ipv4: Enable IPv4 if 'True'.
         ipv6: Enable IPv6 if 'True'.
         qnum: The Queue number for the NFQUEUE target.
+        queues: The number of queues to balance the packets over.
+        cpu_fanout: Use the CPU id to choose the queue if 'True'.
+        batch_size: The maximum number of packets read and verdicted at once
+            by the `NFQueue` of `qnum`.
+        payload_only: Only queue the TCP segments carrying a payload if
+            'True'.
+        tcp_flags: The '<mask> <comp>' TCP flags to filter on. 'None' means
+            all segments will match.
+        min_length: The minimum length of the packets to queue. 'None' means
+            all lengths will match.
+        offload: Let the offloaded connections skip the queue if 'True'.
+        gso: The `NFQueue` of `qnum` receives the GSO packets if 'True'.
+        copy_meta: The `NFQueue` of `qnum` only receives the metadata of the
+            packets if 'True'.
+        max_len: The maximum number of packets waiting in each queue of
+            `qnum`. 'None' means the kernel default.
+        rcvbuf: The size of the netlink receive buffer of the `NFQueue` of
+            `qnum`. 'None' means the system default.
+        fail_open: Accept the packets when the queues of `qnum` are full if
+            'True'.
+        queue_bypass: Accept the packets when no program listens on the
+            queue if 'True'.
+        plans: The kernel plans (see `fragscapy.planner`) replacing the
+            NFQUEUE target, by chain name ('OUTPUT' or 'INPUT'). The chains
+            with no plan (or a 'None' plan) use the NFQUEUE target.
 
     Raises:
         ValueError: See the message for details. Wrong combination of
@@ -104,7 +256,11 @@ class NFQueueRule(object):  # pylint: disable=too-many-instance-attributes
     # pylint: disable=too-many-arguments
     def __init__(self, output_chain=True, input_chain=True, proto=None,
                  host=None, host6=None, port=None, ipv4=True, ipv6=True,
-                 qnum=0):
+                 qnum=0, queues=1, cpu_fanout=True,
+                 batch_size=DEFAULT_BATCH_SIZE, payload_only=False,
+                 tcp_flags=None, min_length=None, offload=False, gso=False,
+                 copy_meta=False, max_len=None, rcvbuf=None,
+                 fail_open=False, queue_bypass=False):
         if not output_chain and not input_chain:
             raise ValueError("Can not deactivate both output_chain and "
                              "input_chain")
@@ -115,9 +271,33 @@ class NFQueueRule(object):  # pylint: disable=too-many-instance-attributes
         if qnum % 2:
             raise ValueError("qnum should be even")
 
-        if proto is None and port is not None:
-            # proto default to 'tcp' when only the port is specified
+        if queues < 1:
+            raise ValueError("queues should be at least 1")
+
+        if batch_size < 1:
+            raise ValueError("batch_size should be at least 1")
+
+        if min_length is not None and not 0 < min_length <= 65535:
+            raise ValueError("min_length should be between 1 and 65535")
+
+        if max_len is not None and max_len < 1:
+            raise ValueError("max_len should be at least 1")
+
+        if rcvbuf is not None and rcvbuf < 1:
+            raise ValueError("rcvbuf should be at least 1")
+
+        if tcp_flags is not None:
+            tcp_flags = _parse_tcp_flags(tcp_flags)
+
+        if proto is None and (port is not None or payload_only
+                              or tcp_flags is not None):
+            # proto default to 'tcp' when only the port (or a TCP filter) is
+            # specified
             proto = 'tcp'
+        if ((payload_only or tcp_flags is not None)
+                and proto.lower() != 'tcp'):
+            raise ValueError("payload_only and tcp_flags can only be used "
+                             "with the 'tcp' proto")
         if host6 is None:
             # host6 default to the same as host if not specified
             host6 = host
@@ -134,14 +314,53 @@ class NFQueueRule(object):  # pylint: disable=too-many-instance-attributes
         self.ipv4 = ipv4
         self.ipv6 = ipv6
         self.qnum = qnum
+        self.queues = queues
+        self.cpu_fanout = cpu_fanout
+        self.batch_size = batch_size
+        self.payload_only = payload_only
+        self.tcp_flags = tcp_flags
+        self.min_length = min_length
+        self.offload = offload
+        self.gso = gso
+        self.copy_meta = copy_meta
+        self.max_len = max_len
+        self.rcvbuf = rcvbuf
+        self.fail_open = fail_open
+        self.queue_bypass = queue_bypass
+        self.plans = dict()
+        self._resolved = dict()
 
-    def _build_nfqueue_opt(self, h, chain):
-        """Returns the options to use for building the NFQUEUE rule.
+    @property
+    def packets(self):
+        """A short description of the packets queued by the rule (besides
+        the protocol, hosts and ports)."""
+        filters = []
+        if self.payload_only:
+            filters.append("with a TCP payload")
+        if self.tcp_flags is not None:
+            filters.append("with the TCP flags {1} (among {0})"
+                           .format(*self.tcp_flags))
+        if self.min_length is not None:
+            filters.append("of at least {} bytes".format(self.min_length))
+        if not filters:
+            return "all packets"
+        return "packets {}".format(", ".join(filters))
+
+    def queue_range(self, chain):
+        """Returns the range of queue numbers used on `chain`."""
+        first = self.qnum + chain.qnum * self.queues
+        return range(first, first + self.queues)
+
+    def _build_match_opt(self, h, chain, family):
+        """Returns the options matching the packets to queue (i.e. the
+        NFQUEUE rule without its target).
 
         Args:
             h: The current hostname to filter on.
             chain: The current chain (changes the direction "src/dst" for
-                some options and the queue number).
+                some options).
+            family: `socket.AF_INET` or `socket.AF_INET6` (changes the
+                payload filter).
 
         Returns:
             A list of parameters that can be used as options in an
@@ -158,10 +377,49 @@ class NFQueueRule(object):  # pylint: disable=too-many-instance-attributes
             if self.port is not None:
                 opt.append(chain.port_opt)       # --dport or --sport
                 opt.append(str(self.port))       # <port>
+            if self.tcp_flags is not None:
+                opt.append('--tcp-flags')        # --tcp-flags
+                opt.extend(self.tcp_flags)       # <mask> <comp>
+        if self.min_length is not None:
+            opt.append('-m')                     # -m
+            opt.append('length')                 # length
+            opt.append('--length')               # --length
+            opt.append("{}:65535".format(self.min_length))  # <min>:65535
+        if self.payload_only:
+            opt.append('-m')                     # -m
+            opt.append('u32')                    # u32
+            opt.append('--u32')                  # --u32
+            opt.append(U32_TCP_PAYLOAD[family])  # <first payload byte>
+        return opt
+
+    def _build_nfqueue_opt(self, h, chain, family):
+        """Returns the options to use for building the NFQUEUE rule.
+
+        Args:
+            h: The current hostname to filter on.
+            chain: The current chain (changes the direction "src/dst" for
+                some options and the queue number).
+            family: `socket.AF_INET` or `socket.AF_INET6` (changes the
+                payload filter).
+
+        Returns:
+            A list of parameters that can be used as options in an
+            ip(6)tables command.
+        """
+        opt = self._build_match_opt(h, chain, family)
         opt.append('-j')                         # -j
         opt.append('NFQUEUE')                    # NFQUEUE
-        opt.append('--queue-num')                # --queue-num
-        opt.append(str(self.qnum + chain.qnum))  # <qnum> or <qnum>+1
+        qrange = self.queue_range(chain)
+        if self.queues == 1:
+            opt.append('--queue-num')            # --queue-num
+            opt.append(str(qrange[0]))           # <qnum> or <qnum>+1
+        else:
+            opt.append('--queue-balance')        # --queue-balance
+            opt.append("{}:{}".format(qrange[0], qrange[-1]))  # <a>:<b>
+            if self.cpu_fanout:
+                opt.append('--queue-cpu-fanout')  # --queue-cpu-fanout
+        if self.queue_bypass:
+            opt.append('--queue-bypass')         # --queue-bypass
         return opt
 
     def _build_rst_opt(self, h, chain):   # pylint: disable=no-self-use
@@ -194,31 +452,114 @@ class NFQueueRule(object):  # pylint: disable=too-many-instance-attributes
         opt.append("DROP")              # DROP
         return opt
 
-    def _insert_or_remove(self, insert=True):
-        """Build and then insert or remove the netfilter rules.
+    def _build_plan_opts(self, h, chain, family, plan):
+        """Returns the options to use for building the rules of a kernel
+        plan, in place of the NFQUEUE rule: a random drop and a mark for
+        the netem qdisc.
+
+        Args:
+            h: The current hostname to filter on.
+            chain: The current chain (changes the direction "src/dst" for
+                some options).
+            family: `socket.AF_INET` or `socket.AF_INET6` (changes the
+                payload filter).
+            plan: The `KernelPlan` to apply.
 
-        Both operations are regrouped as they are very similary built. The
-        only difference is a '-I' or a '-D' in the options.
+        Returns:
+            A list of lists of parameters that can be used as options in an
+            ip(6)tables command, in the order they should be inserted (empty
+            if the plan leaves the packets unchanged).
+        """
+        opts = []
+        if plan.delay > 0 or plan.duplicate:
+            opts.append(self._build_match_opt(h, chain, family) + [
+                '-j', 'MARK', '--or-mark', "0x{:x}".format(NETEM_MARK)
+            ])
+        if plan.drop_proba > 0:
+            # Inserted last so the packets are dropped before being marked
+            opts.append(self._build_match_opt(h, chain, family) + [
+                '-m', 'statistic', '--mode', 'random',
+                '--probability', "{:.6f}".format(plan.drop_proba),
+                '-j', 'DROP'
+            ])
+        return opts
+
+    def _build_offload_opts(self, h, chain):
+        """Returns the options to use for building the 2 rules offloading
+        the marked connections: the first one accepts the packets of the
+        marked connections, the second one marks the connection of a packet
+        marked by `PacketWrapper.offload()` (so the packet is then accepted
+        by the first rule).
 
         Args:
-            insert: Inserts the rule if 'True', removes it if 'False'.
+            h: The current hostname to filter on.
+            chain: The current chain (changes the direction "src/dst" for
+                some options).
 
-        Raises:
-            CalledProcessError: An error occurred while running the
-                sub-command ip(6)tables.
+        Returns:
+            A list of 2 lists of parameters that can be used as options in
+            an ip(6)tables command, in the order they should be inserted.
+        """
+        opt = []    # The common iptables options
+        opt.append(chain.name)                   # OUTPUT or INPUT
+        if h is not None:
+            opt.append(chain.host_opt)           # -d or -s
+            opt.append(h)                        # <hostname>
+        if self.proto is not None:
+            opt.append('-p')                     # -p
+            opt.append(self.proto)               # <protocol>
+            if self.port is not None:
+                opt.append(chain.port_opt)       # --dport or --sport
+                opt.append(str(self.port))       # <port>
+        mark = "0x{:x}".format(OFFLOAD_MARK)
+        accept_opt = opt + [
+            '-m', 'connmark', '--mark', "{0}/{0}".format(mark),
+            '-j', 'ACCEPT'
+        ]
+        save_opt = opt + [
+            '-m', 'mark', '--mark', "{0}/{0}".format(mark),
+            '-j', 'CONNMARK', '--or-mark', mark
+        ]
+        return [accept_opt, save_opt]
+
+    def _resolve(self, family):
+        """Returns the addresses to filter on for `family` ('None' if all
+        the hosts match).
+
+        A hostname is resolved once and for all (and remembered), so the
+        rules are removed with the exact same addresses they were inserted
+        with, and a single name resolution is made for all the rules.
         """
-        # Pre-catch non root errors here instead of letting iptables fail.
-        # Because it returns an exitcode of 2 which can indicate something
-        # else.
-        if os.geteuid() != 0:
-            raise PermissionError("You should be root")
-
-        # The binaries to use (IPv4 and/or IPv6) with the associated hostname
-        bin_host = []
-        if self.ipv4:
-            bin_host.append(("/sbin/iptables", self.host))
-        if self.ipv6:
-            bin_host.append(("/sbin/ip6tables", self.host6))
+        host = self.host if family == socket.AF_INET else self.host6
+        if host is None:
+            return None
+        if (host, family) not in self._resolved:
+            try:
+                addrs = sorted(set(
+                    info[4][0] for info in socket.getaddrinfo(host, None,
+                                                              family)
+                ))
+            except (socket.gaierror, UnicodeError):
+                # Not a hostname (e.g. a network) or can't be resolved: let
+                # ip(6)tables-restore handle (and report) it
+                addrs = [host]
+            self._resolved[(host, family)] = ','.join(addrs)
+        return self._resolved[(host, family)]
+
+    def rules(self, family):
+        """Returns the ip(6)tables rules (as lists of options, without the
+        '-I' or '-D' command) to use for `family`.
+
+        Args:
+            family: `socket.AF_INET` (iptables) or `socket.AF_INET6`
+                (ip6tables).
+
+        Returns:
+            A list of rules, empty if the family is not enabled.
+        """
+        if not (self.ipv4 if family == socket.AF_INET else self.ipv6):
+            return []
+        h = self._resolve(family)
 
         # The chains to use (OUTUT and/or INPUT)
         chains = []
@@ -227,24 +568,21 @@ class NFQueueRule(object):  # pylint: disable=too-many-instance-attributes
         if self.input_chain:
             chains.append(INPUT)
 
-        # The options builders (_build_nfqueue_opt and/or _build_rst_opt)
-        opt_builders = [self._build_nfqueue_opt]
-        if self.proto is not None and self.proto.lower() == 'tcp':
-            opt_builders.append(self._build_rst_opt)
-
-        for binary, h in bin_host:
-            for chain in chains:
-                for opt_builder in opt_builders:
-                    # Build the iptables/ip6tables resulting command
-                    cmd = []
-                    cmd.append(binary)
-                    if insert:
-                        cmd.append('-I')
-                    else:
-                        cmd.append('-D')
-                    cmd.extend(opt_builder(h, chain))
-                    # Run the command and raise an exception if an error occurs
-                    subprocess.run(cmd, check=True)
+        # The NFQUEUE rule (or the rules of the kernel plan), the offload
+        # rules and, for TCP, the "reset TCP's RST flag" rule (each one is
+        # inserted before the previous ones)
+        rules = []
+        for chain in chains:
+            plan = self.plans.get(chain.name)
+            if plan is None:
+                rules.append(self._build_nfqueue_opt(h, chain, family))
+            else:
+                rules.extend(self._build_plan_opts(h, chain, family, plan))
+            if self.offload:
+                rules.extend(self._build_offload_opts(h, chain))
+            if self.proto is not None and self.proto.lower() == 'tcp':
+                rules.append(self._build_rst_opt(h, chain))
+        return rules
 
     def insert(self):
         """Builds and insert the resulting rules in iptables and ip6tables.
@@ -253,7 +591,7 @@ class NFQueueRule(object):  # pylint: disable=too-many-instance-attributes
             CalledProcessError: exception is raised if an error occurs in the
                 process.
         """
-        self._insert_or_remove(insert=True)
+        insert_rules([self])
 
     def remove(self):
         """Removes the previously inserted rules in iptables and ip6tables.
@@ -262,7 +600,856 @@ class NFQueueRule(object):  # pylint: disable=too-many-instance-attributes
             CalledProcessError: exception is raised if an error occurs in the
                 process.
         """
-        self._insert_or_remove(insert=False)
+        remove_rules([self])
+
+
+# The backends that can be used to insert the rules
+NF_BACKENDS = ('iptables', 'nftables')
+
+# The ip(6)tables-restore binaries for each family
+RESTORE_BINARIES = collections.OrderedDict((
+    (socket.AF_INET, "/sbin/iptables-restore"),
+    (socket.AF_INET6, "/sbin/ip6tables-restore"),
+))
+
+
+def build_restore_script(nfrules, family, insert=True):
+    """Builds the ip(6)tables-restore input inserting (or removing) the rules
+    of all the `nfrules` for `family`.
+
+    Args:
+        nfrules: The `NFQueueRule` objects.
+        family: `socket.AF_INET` or `socket.AF_INET6`.
+        insert: Inserts the rules if 'True', removes them if 'False'.
+
+    Returns:
+        The script, or 'None' if there is no rule for this family.
+    """
+    return _restore_script(_restore_lines(nfrules, family, insert))
+
+
+def _restore_lines(nfrules, family, insert=True):
+    """Returns the ip(6)tables-restore commands inserting (or removing) the
+    rules of all the `nfrules` for `family`."""
+    lines = []
+    for nfrule in nfrules:
+        for opt in nfrule.rules(family):
+            lines.append(' '.join(['-I' if insert else '-D'] + opt))
+    return lines
+
+
+def _restore_script(lines):
+    """Returns the ip(6)tables-restore input running the commands of
+    `lines` in a single transaction, 'None' if there is none."""
+    if not lines:
+        return None
+    return '\n'.join(['*filter'] + lines + ['COMMIT', ''])
+
+
+# The name of the nftables table holding all the rules (nftables backend)
+NFT_TABLE = "fragscapy"
+
+# The nftables names of the families and of the types of their addresses
+_NFT_FAMILIES = collections.OrderedDict((
+    (socket.AF_INET, ('ipv4', 'ip', 'ipv4_addr')),
+    (socket.AF_INET6, ('ipv6', 'ip6', 'ipv6_addr')),
+))
+
+# The range of the random numbers used for the random drops of the plans
+_NFT_PROBA_SCALE = 1000000
+
+# A group of rules that only differ by the host and/or port they match: they
+# are replaced by a single nftables rule matching a set
+_NftGroup = collections.namedtuple(
+    '_NftGroup',
+    ['hook', 'family', 'proto', 'addr_field', 'port_field', 'filters',
+     'verdict']
+)
+
+
+def _parse_tcp_flags(tcp_flags):
+    """Parses a '<mask> <comp>' TCP flags filter (iptables format).
+
+    Returns:
+        The `(mask, comp)` tuple, with the flags in upper case.
+
+    Raises:
+        ValueError: The filter is not in the right format or uses an unknown
+            flag.
+    """
+    parts = tcp_flags.upper().split()
+    if len(parts) != 2:
+        raise ValueError("tcp_flags should be '<mask> <comp>', got '{}'"
+                         .format(tcp_flags))
+    for part in parts:
+        if part in ('ALL', 'NONE'):
+            continue
+        for flag in part.split(','):
+            if flag not in TCP_FLAGS:
+                raise ValueError("Unknown TCP flag '{}' in tcp_flags, should "
+                                 "be one of {}, ALL or NONE"
+                                 .format(flag, ', '.join(TCP_FLAGS)))
+    return tuple(parts)
+
+
+def _nft_tcp_flags(flags):
+    """Returns the nftables value of some iptables-style TCP flags."""
+    if flags == 'NONE':
+        return "0x0"
+    if flags == 'ALL':
+        flags = ','.join(TCP_FLAGS)
+    return "({})".format('|'.join(flags.lower().split(',')))
+
+
+def _nft_filters(nfrule):
+    """Returns the nftables matches of the packet filters of `nfrule` (the
+    equivalent of the length, tcp-flags and u32 matches)."""
+    match = []
+    if nfrule.tcp_flags is not None:
+        mask, comp = nfrule.tcp_flags
+        match.append("tcp flags & {} == {}".format(
+            _nft_tcp_flags(mask), _nft_tcp_flags(comp)
+        ))
+    if nfrule.min_length is not None:
+        match.append("meta length >= {}".format(nfrule.min_length))
+    if nfrule.payload_only:
+        # Reading the first byte of the payload fails if there is none
+        match.append("@ih,0,8 >= 0x0")
+    return ' '.join(match) or None
+
+
+def _nft_queue_verdict(nfrule, chain):
+    """Returns the nftables 'queue' statement of `nfrule` on `chain`."""
+    qrange = nfrule.queue_range(chain)
+    flags = []
+    if nfrule.queue_bypass:
+        flags.append("bypass")
+    if nfrule.queues == 1:
+        verdict = "queue num {}".format(qrange[0])
+    else:
+        verdict = "queue num {}-{}".format(qrange[0], qrange[-1])
+        if nfrule.cpu_fanout:
+            flags.append("fanout")
+    if flags:
+        verdict += " " + ",".join(flags)
+    return verdict
+
+
+def _nft_plan_verdicts(plan):
+    """Returns the `(filter, verdict)` of the nftables rules of a kernel plan
+    (in order), or 'None' if there is no plan (the NFQUEUE is used)."""
+    if plan is None:
+        return None
+    verdicts = []
+    if plan.drop_proba > 0:
+        verdicts.append((
+            "numgen random mod {} < {}".format(
+                _NFT_PROBA_SCALE,
+                int(round(plan.drop_proba * _NFT_PROBA_SCALE))
+            ),
+            "drop"
+        ))
+    if plan.delay > 0 or plan.duplicate:
+        verdicts.append((
+            None, "meta mark set meta mark | 0x{:x}".format(NETEM_MARK)
+        ))
+    return verdicts
+
+
+def _nft_entries(nfrule):
+    """Yields the `(group, element)` matched by `nfrule`, where `element` is
+    a `(address, port)` tuple (each one possibly 'None')."""
+    chains = []
+    if nfrule.output_chain:
+        chains.append((OUTPUT, 'output', 'daddr', 'dport'))
+    if nfrule.input_chain:
+        chains.append((INPUT, 'input', 'saddr', 'sport'))
+    port = str(nfrule.port).replace(':', '-') if nfrule.port else None
+    proto = nfrule.proto.lower() if nfrule.proto is not None else None
+    filters = _nft_filters(nfrule)
+
+    for family in _NFT_FAMILIES:
+        if not (nfrule.ipv4 if family == socket.AF_INET else nfrule.ipv6):
+            continue
+        hosts = nfrule._resolve(family)  # pylint: disable=protected-access
+        addrs = hosts.split(',') if hosts is not None else [None]
+        for chain, hook, addr_field, port_field in chains:
+            verdicts = _nft_plan_verdicts(nfrule.plans.get(chain.name))
+            if verdicts is None:
+                verdicts = [(None, _nft_queue_verdict(nfrule, chain))]
+            for addr in addrs:
+                for plan_filter, verdict in verdicts:
+                    yield _NftGroup(
+                        hook, family, proto,
+                        addr_field if addr is not None else None,
+                        port_field if port is not None else None,
+                        ' '.join(f for f in (filters, plan_filter)
+                                 if f is not None) or None,
+                        verdict
+                    ), (addr, port)
+                if proto == 'tcp':
+                    # Like the iptables "reset TCP's RST flag" rule: drop
+                    # the RST sent by the local kernel
+                    yield _NftGroup(
+                        'output', family, proto,
+                        'daddr' if addr is not None else None,
+                        port_field if port is not None else None, None,
+                        "tcp flags & rst == rst drop"
+                    ), (addr, port)
+                if nfrule.offload:
+                    # Like the iptables offload rules: save the mark on the
+                    # connection and accept the marked connections
+                    mark = "0x{:x}".format(OFFLOAD_MARK)
+                    yield _NftGroup(
+                        hook, family, proto,
+                        addr_field if addr is not None else None,
+                        port_field if port is not None else None,
+                        "meta mark & {0} == {0}".format(mark),
+                        "ct mark set ct mark | {} accept".format(mark)
+                    ), (addr, port)
+                    yield _NftGroup(
+                        hook, family, proto,
+                        addr_field if addr is not None else None,
+                        port_field if port is not None else None,
+                        "ct mark & {0} == {0}".format(mark), "accept"
+                    ), (addr, port)
+
+
+def build_nft_script(nfrules):
+    """Builds the `nft -f` input creating the table with the rules of all
+    the `nfrules` (and replacing the table if it already exists).
+
+    The rules that only differ by their host and/or port are regrouped: the
+    hosts and ports are put in a named set (a concatenation of both if
+    needed) and a single rule per chain matches the set, so the cost of the
+    matching does not grow with the number of hosts and ports.
+
+    Args:
+        nfrules: The `NFQueueRule` objects.
+
+    Returns:
+        The script.
+    """
+    groups = collections.OrderedDict()
+    for nfrule in nfrules:
+        for group, element in _nft_entries(nfrule):
+            elements = groups.setdefault(group, list())
+            if element not in elements:
+                elements.append(element)
+
+    sets = []
+    chains = collections.OrderedDict((('output', []), ('input', [])))
+    # The drops (and accepts) first: the queue verdicts are final
+    ordered = sorted(groups.items(),
+                     key=lambda item: 'queue' in item[0].verdict)
+    for i, (group, elements) in enumerate(ordered):
+        name, l3_proto, addr_type = _NFT_FAMILIES[group.family]
+        match = ["meta nfproto {}".format(name)]
+        if group.proto is not None:
+            match.append("meta l4proto {}".format(group.proto))
+        keys, types = [], []
+        if group.addr_field is not None:
+            keys.append("{} {}".format(l3_proto, group.addr_field))
+            types.append(addr_type)
+        if group.port_field is not None:
+            keys.append("{} {}".format(group.proto, group.port_field))
+            types.append("inet_service")
+        if keys:
+            set_name = "set{}".format(i)
+            values = [
+                ' . '.join(v for v in element if v is not None)
+                for element in elements
+            ]
+            flags = ("flags interval; "
+                     if any('/' in v or '-' in v for v in values) else "")
+            sets.append(
+                "  set {} {{ type {}; {}elements = {{ {} }}; }}".format(
+                    set_name, ' . '.join(types), flags, ', '.join(values)
+                )
+            )
+            match.append("{} @{}".format(' . '.join(keys), set_name))
+        if group.filters is not None:
+            match.append(group.filters)
+        chains[group.hook].append(
+            "    {} {}".format(' '.join(match), group.verdict)
+        )
+
+    lines = [
+        # Creates the table if needed so it can always be deleted: the whole
+        # table is replaced atomically
+        "table inet {}".format(NFT_TABLE),
+        "delete table inet {}".format(NFT_TABLE),
+        "table inet {} {{".format(NFT_TABLE),
+    ]
+    lines.extend(sets)
+    for hook, rules in chains.items():
+        if not rules:
+            continue
+        lines.append("  chain {} {{".format(hook))
+        lines.append(
+            "    type filter hook {} priority 0; policy accept;".format(hook)
+        )
+        lines.extend(rules)
+        lines.append("  }")
+    lines.append("}")
+    return '\n'.join(lines + [''])
+
+
+def _nft(script):
+    """Runs `script` with `nft -f` (a single atomic transaction)."""
+    subprocess.run(["/usr/sbin/nft", "-f", "-"], input=script.encode(),
+                   check=True)
+
+
+def _insert_or_remove(nfrules, insert=True, backend='iptables'):
+    """Builds and then inserts or removes the netfilter rules of all the
+    `nfrules`, with a single transaction per family (iptables) or a single
+    transaction for everything (nftables).
+
+    Both operations are regrouped as they are very similary built. The only
+    difference is a '-I' or a '-D' in the rules (or the creation or deletion
+    of the nftables table).
+
+    Args:
+        nfrules: The `NFQueueRule` objects.
+        insert: Inserts the rules if 'True', removes them if 'False'.
+        backend: The netfilter backend to use: 'iptables' or 'nftables'.
+
+    Raises:
+        CalledProcessError: An error occurred while running the
+            sub-command ip(6)tables-restore (none of the rules of this
+            family were changed) or nft (none of the rules were changed).
+        ValueError: The backend is unknown.
+    """
+    _check_backend(backend)
+
+    if backend == 'nftables':
+        if insert:
+            _nft(build_nft_script(nfrules))
+        else:
+            _nft("delete table inet {}\n".format(NFT_TABLE))
+        return
+
+    for family in RESTORE_BINARIES:
+        _restore(family, build_restore_script(nfrules, family, insert))
+
+
+def _check_backend(backend):
+    """Checks that the rules can be changed with `backend`.
+
+    Raises:
+        ValueError: The backend is unknown.
+        PermissionError: The process is not root.
+    """
+    if backend not in NF_BACKENDS:
+        raise ValueError("Unknown netfilter backend '{}', should be one of "
+                         "{}".format(backend, ', '.join(NF_BACKENDS)))
+
+    # Pre-catch non root errors here instead of letting iptables fail.
+    # Because it returns an exitcode of 2 which can indicate something
+    # else.
+    if os.geteuid() != 0:
+        raise PermissionError("You should be root")
+
+
+def _restore(family, script):
+    """Runs `script` (if not 'None') with the ip(6)tables-restore binary of
+    `family`."""
+    if script is None:
+        return
+    # Keep the other rules, only apply these ones (all or nothing).
+    # Run the command and raise an exception if an error occurs
+    subprocess.run([RESTORE_BINARIES[family], '--noflush'],
+                   input=script.encode(), check=True)
+
+
+def insert_rules(nfrules, backend='iptables'):
+    """Inserts the rules of all the `nfrules` at once.
+
+    Args:
+        nfrules: The `NFQueueRule` objects.
+        backend: The netfilter backend to use: 'iptables' (default) or
+            'nftables'.
+
+    Raises:
+        CalledProcessError: exception is raised if an error occurs in the
+            process.
+    """
+    _insert_or_remove(nfrules, insert=True, backend=backend)
+
+
+def replace_rules(nfrules, update, backend='iptables'):
+    """Replaces the rules of all the `nfrules` by the ones they have once
+    `update()` is called (e.g. to change their `plans`), at once.
+
+    The old rules are removed and the new ones inserted in the same
+    transaction (one per family with iptables, the table is replaced with
+    nftables), so the packets never go through the chains without either.
+
+    Args:
+        nfrules: The `NFQueueRule` objects.
+        update: The callable changing the `nfrules`.
+        backend: The netfilter backend to use: 'iptables' (default) or
+            'nftables'.
+
+    Raises:
+        CalledProcessError: exception is raised if an error occurs in the
+            process (the rules of this family were not changed).
+    """
+    _check_backend(backend)
+
+    if backend == 'nftables':
+        update()
+        # The whole table is replaced atomically
+        _nft(build_nft_script(nfrules))
+        return
+
+    removed = collections.OrderedDict(
+        (family, _restore_lines(nfrules, family, insert=False))
+        for family in RESTORE_BINARIES
+    )
+    update()
+    for family, lines in removed.items():
+        _restore(family, _restore_script(
+            lines + _restore_lines(nfrules, family, insert=True)
+        ))
+
+
+def remove_rules(nfrules, backend='iptables'):
+    """Removes the previously inserted rules of all the `nfrules` at once.
+
+    Args:
+        nfrules: The `NFQueueRule` objects.
+        backend: The netfilter backend to use: 'iptables' (default) or
+            'nftables'.
+
+    Raises:
+        CalledProcessError: exception is raised if an error occurs in the
+            process.
+    """
+    _insert_or_remove(nfrules, insert=False, backend=backend)
+
+
+# The version of `fnfqueue` whose private internals are used below (the
+# batch verdicts, the notifications and the reception with a timeout)
+FNFQUEUE_VERSION = "1.1.2"
+
+# The private attributes used on `fnfqueue` objects (and a factory building
+# an instance to check them on)
+_FNFQUEUE_INTERNALS = (
+    ('fnfqueue', lambda: fnfqueue,
+     ('_PacketErrorQueue', 'PacketInvalidException',
+      'BufferOverflowException')),
+    ('fnfqueue.lib', lambda: fnfqueue.lib,
+     ('set_verdict_batch', 'parse_packet', 'NFQA_SKB_INFO')),
+    ('fnfqueue.Connection', lambda: fnfqueue.Connection,
+     ('_recycle', 'reset')),
+    ('fnfqueue.Packet', lambda: fnfqueue.Packet(None, None),
+     ('_invalid', '_invalidate', '_is_invalid', '_get_property32', '_conn',
+      'packet')),
+    ('fnfqueue._PacketErrorQueue',
+     lambda: fnfqueue._PacketErrorQueue(),  # pylint: disable=protected-access
+     ('_packet_queue', '_packet_cond', '_exception', 'append', 'exception')),
+)
+
+
+def _check_internals(name, obj, attrs):
+    """Raises an `ImportError` naming the attributes `attrs` missing on
+    `obj` (described by `name`)."""
+    missing = [attr for attr in attrs if not hasattr(obj, attr)]
+    if missing:
+        raise ImportError(
+            "Incompatible fnfqueue module (version {} is required): {} has "
+            "no {}".format(FNFQUEUE_VERSION, name, ", ".join(missing))
+        )
+
+
+def check_fnfqueue(conn=None):
+    """Checks that the private internals of `fnfqueue` used by this module
+    exist, so an incompatible version fails at startup and not in the
+    middle of a run. It is done when this module is imported.
+
+    Args:
+        conn: A `fnfqueue.Connection` to check the attributes of too.
+            Default is 'None' (only the module and its classes are checked).
+
+    Raises:
+        ImportError: Some of the internals are missing.
+    """
+    for name, factory, attrs in _FNFQUEUE_INTERNALS:
+        try:
+            obj = factory()
+        except (AttributeError, TypeError) as err:
+            raise ImportError(
+                "Incompatible fnfqueue module (version {} is required): {} "
+                "is not usable ({})".format(FNFQUEUE_VERSION, name, err)
+            )
+        _check_internals(name, obj, attrs)
+    if conn is not None:
+        _check_internals('fnfqueue.Connection', conn, ('_conn', '_received'))
+        # pylint: disable=protected-access
+        _check_internals('fnfqueue.Connection._conn', conn._conn, ('fd',))
+
+
+check_fnfqueue()
+
+
+def _pending_packets(conn):
+    """Returns the number of packets already received from the kernel by the
+    `fnfqueue.Connection` and waiting to be read (reading them won't
+    block)."""
+    # pylint: disable=protected-access
+    return len(conn._received._packet_queue)
+
+
+# pylint: disable=protected-access
+class _NotifyingPacketQueue(fnfqueue._PacketErrorQueue):
+    """The queue where the reader thread of a `fnfqueue.Connection` puts the
+    packets received, also writing a byte on a pipe each time packets (or an
+    error) are received."""
+    def __init__(self):
+        super(_NotifyingPacketQueue, self).__init__()
+        self.notify_r, self._notify_w = os.pipe()
+        os.set_blocking(self.notify_r, False)
+        os.set_blocking(self._notify_w, False)
+        # The reader thread may still notify while the pipe is closed
+        self._notify_lock = threading.Lock()
+
+    def _notify(self):
+        """Wakes up the reader of the pipe."""
+        with self._notify_lock:
+            if self._notify_w is None:
+                return
+            try:
+                os.write(self._notify_w, b'\0')
+            except BlockingIOError:
+                pass  # The pipe is full, it will be read anyway
+
+    def drain(self):
+        """Empties the pipe."""
+        try:
+            while os.read(self.notify_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close_pipe(self):
+        """Closes both ends of the pipe."""
+        with self._notify_lock:
+            if self._notify_w is not None:
+                os.close(self.notify_r)
+                os.close(self._notify_w)
+                self._notify_w = None
+
+    def append(self, packets):
+        super(_NotifyingPacketQueue, self).append(packets)
+        self._notify()
+
+    def exception(self, e):
+        super(_NotifyingPacketQueue, self).exception(e)
+        self._notify()
+
+
+def read_queue_drops():
+    """Reads the drop counters of the queues bound on the system.
+
+    They are the `queue_dropped` (the queue was full) and
+    `queue_user_dropped` (the packet could not be sent to the netlink socket)
+    columns of `NFQUEUE_PROC`. The counters of a queue only exist while it is
+    bound. The packets accepted by a full queue in fail-open mode are not
+    counted.
+
+    Returns:
+        A dictionary with the `(queue_dropped, queue_user_dropped)` of each
+        queue number, empty if the file can not be read.
+    """
+    drops = dict()
+    try:
+        with open(NFQUEUE_PROC) as proc:
+            for line in proc:
+                fields = line.split()
+                if len(fields) >= 7:
+                    drops[int(fields[0])] = (int(fields[5]), int(fields[6]))
+    except OSError:
+        pass
+    return drops
+
+
+def _set_rcvbuf(conn, size):
+    """Sets the receive buffer size of the netlink socket of a
+    `fnfqueue.Connection`, above the system limit if allowed."""
+    # pylint: disable=protected-access
+    sock = socket.fromfd(conn._conn.fd, socket.AF_NETLINK, socket.SOCK_RAW)
+    try:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, size)
+        except PermissionError:
+            # Capped to `net.core.rmem_max`
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    finally:
+        sock.close()  # Only closes the duplicate of the fd
+
+
+def _set_verdict_batch(pkts, action):
+    """Sends a single batch verdict for all the `fnfqueue` packets in `pkts`.
+
+    A batch verdict applies to every packet of the queue whose id is lower or
+    equal to the id of the last packet. So `pkts` must be all the packets
+    still waiting for a verdict on this queue, in the order they were
+    received. The packets already verdicted (e.g. by another thread) are
+    left out.
+
+    Args:
+        pkts: A list of `fnfqueue.Packet` from the same queue.
+        action: The verdict to apply (`fnfqueue.ACCEPT` or `fnfqueue.DROP`).
+
+    Raises:
+        OSError: The verdict could not be sent.
+    """
+    # fnfqueue only exposes the batch verdict in its C library so the
+    # bookkeeping usually done by `fnfqueue.Packet.verdict` is done here.
+    # pylint: disable=protected-access
+    pkts = [pkt for pkt in pkts if not pkt._invalid]
+    if not pkts:
+        return
+    conn = pkts[-1]._conn
+    ret = 0
+    if conn._conn is not None:
+        ret = fnfqueue.lib.set_verdict_batch(
+            conn._conn, pkts[-1].packet, action, 0, 0, 0
+        )
+    for pkt in pkts:
+        if pkt._invalid:
+            continue  # Verdicted meanwhile: already recycled
+        conn._recycle(pkt.packet)
+        pkt._invalidate()
+    if ret == -1:
+        errno = fnfqueue.ffi.errno
+        raise OSError(errno, os.strerror(errno))
+
+
+class QueueStats(object):
+    """Statistics about the batches read and verdicted by a `NFQueue`.
+
+    They are meant to help tuning the `batch_size` of the queue: if most of
+    the batches are full, the batch size can be increased, if the number of
+    packets per verdict is low, batching does not help much.
+
+    They also count the packets lost before reaching userland, so a test
+    result caused by the queue itself can be spotted.
+
+    Attributes:
+        batches: The number of batches read.
+        packets: The number of packets read.
+        verdicts: The number of verdict messages sent to Netfilter.
+        max_batch: The size of the biggest batch read.
+        full_batches: The number of batches that reached the batch size.
+        kernel_drops: The number of packets dropped by the kernel because
+            the queues were full.
+        user_drops: The number of packets dropped by the kernel because they
+            could not be sent to the netlink socket.
+        overruns: The number of times the netlink socket overflowed
+            (ENOBUFS), each time losing an unknown number of packets.
+    """
+    def __init__(self):
+        self.batches = 0
+        self.packets = 0
+        self.verdicts = 0
+        self.max_batch = 0
+        self.full_batches = 0
+        self.kernel_drops = 0
+        self.user_drops = 0
+        self.overruns = 0
+
+    def add_batch(self, size, batch_size):
+        """Records a new batch of `size` packets read from a queue with a
+        maximum batch size of `batch_size`."""
+        self.batches += 1
+        self.packets += size
+        self.max_batch = max(self.max_batch, size)
+        if size >= batch_size:
+            self.full_batches += 1
+
+    def add_verdicts(self, nb_verdicts):
+        """Records `nb_verdicts` more verdict messages sent."""
+        self.verdicts += nb_verdicts
+
+    @property
+    def mean_batch(self):
+        """The average number of packets per batch."""
+        return self.packets / self.batches if self.batches else 0.0
+
+    @property
+    def packets_per_verdict(self):
+        """The average number of packets per verdict message."""
+        return self.packets / self.verdicts if self.verdicts else 0.0
+
+    @property
+    def drops(self):
+        """The number of packets lost before reaching userland (plus the
+        number of overruns, which lost at least one packet each)."""
+        return self.kernel_drops + self.user_drops + self.overruns
+
+    def __str__(self):
+        return (
+            "{packets} packets in {batches} batches (mean {mean:.2f}, max "
+            "{max_batch}, {full} full), {verdicts} verdicts "
+            "({ppv:.2f} packets/verdict), {kernel_drops} dropped by the "
+            "kernel (queue full), {user_drops} dropped by netlink, "
+            "{overruns} ENOBUFS overruns".format(
+                packets=self.packets,
+                batches=self.batches,
+                mean=self.mean_batch,
+                max_batch=self.max_batch,
+                full=self.full_batches,
+                verdicts=self.verdicts,
+                ppv=self.packets_per_verdict,
+                kernel_drops=self.kernel_drops,
+                user_drops=self.user_drops,
+                overruns=self.overruns,
+            )
+        )
+
+    def __repr__(self):
+        return (
+            "QueueStats(batches={}, packets={}, verdicts={}, max_batch={})"
+            .format(self.batches, self.packets, self.verdicts, self.max_batch)
+        )
+
+
+class VerdictBatch(object):
+    """The verdicts waiting to be sent for the packets of a batch.
+
+    The verdicts are recorded in order and only sent when `.flush()` is
+    called. The consecutive accepts (resp. drops) on the same queue are sent
+    as a single batch verdict. Mangles can't be batched (the payload or the
+    mark has to be sent) so they are sent one by one, in order with the
+    others.
+
+    The verdicts can be recorded and sent from different threads (e.g. by
+    the watchdog of the engine, see `.fail_open()`): a packet that already
+    has a verdict when the batch is sent is skipped, and a verdict that
+    fails does not prevent the next ones from being sent.
+
+    Args:
+        stats: A `QueueStats` object where to count the verdicts sent.
+            Default is 'None' (not counted).
+        merge: Regroup the consecutive accepts (resp. drops) in a single
+            batch verdict if 'True'. It is only correct if all the packets
+            received before are verdicted with this batch (or before), so it
+            must be disabled when some packets are verdicted asynchronously.
+            Default is 'True'.
+    """
+    def __init__(self, stats=None, merge=True):
+        self._stats = stats
+        self._merge = merge
+        self._verdicts = list()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._verdicts)
+
+    def add(self, pkt, action, mangle=0):
+        """Records the verdict `action` for the `fnfqueue` packet `pkt`.
+
+        Args:
+            pkt: The `fnfqueue.Packet`.
+            action: The verdict (`fnfqueue.ACCEPT`, `fnfqueue.DROP` or
+                `fnfqueue.REPEAT`).
+            mangle: The modified attributes of `pkt` that must be sent with
+                the verdict (`fnfqueue.MANGLE_PAYLOAD` and/or
+                `fnfqueue.MANGLE_MARK`). Default is '0' (none).
+        """
+        with self._lock:
+            self._verdicts.append((pkt, action, mangle))
+
+    def flush(self):
+        """Sends all the recorded verdicts to Netfilter.
+
+        Raises:
+            OSError: A verdict could not be sent (the others were sent).
+        """
+        with self._lock:
+            self._flush()
+
+    def fail_open(self, pkts):
+        """Sends the recorded verdicts, then accepts the packets of `pkts`
+        that still have no verdict, at once for the threads recording
+        verdicts meanwhile. The errors are ignored.
+
+        Args:
+            pkts: The `fnfqueue.Packet` objects to accept.
+        """
+        with self._lock:
+            try:
+                self._flush()
+            except OSError:
+                pass
+            for pkt in pkts:
+                self._verdicts.append((pkt, fnfqueue.ACCEPT, 0))
+            try:
+                self._flush()
+            except OSError:
+                pass
+
+    def _flush(self):
+        """Sends all the recorded verdicts (the lock is held)."""
+        # The runs of same verdicts are computed per queue because the batch
+        # verdict is based on the packet id which is specific to a queue.
+        # The packets verdicted meanwhile by another thread are skipped.
+        # pylint: disable=protected-access
+        queues = collections.OrderedDict()
+        for pkt, action, mangle in self._verdicts:
+            if not pkt._invalid:
+                queues.setdefault(pkt.packet.queue_id, list()).append(
+                    (pkt, action, mangle)
+                )
+        self._verdicts = list()
+
+        nb_verdicts = 0
+        errors = list()
+        for verdicts in queues.values():
+            run, run_action = list(), None
+            for pkt, action, mangle in verdicts:
+                if mangle or action != run_action or not self._merge:
+                    nb_verdicts += self._flush_run(run, run_action, errors)
+                    run, run_action = list(), None
+                if mangle:
+                    try:
+                        pkt.verdict(action, mangle)
+                        nb_verdicts += 1
+                    except fnfqueue.PacketInvalidException:
+                        pass  # Verdicted meanwhile by another thread
+                    except OSError as e:
+                        errors.append(e)
+                else:
+                    run.append(pkt)
+                    run_action = action
+            nb_verdicts += self._flush_run(run, run_action, errors)
+
+        if self._stats is not None:
+            self._stats.add_verdicts(nb_verdicts)
+        if errors:
+            raise errors[0]
+
+    @staticmethod
+    def _flush_run(run, action, errors):
+        """Sends the verdict `action` for all the packets in `run` and
+        returns the number of verdict messages sent. The error (if any) is
+        appended to `errors`."""
+        if not run:
+            return 0
+        try:
+            if len(run) == 1:
+                run[0].verdict(action)
+            else:
+                _set_verdict_batch(run, action)
+        except fnfqueue.PacketInvalidException:
+            return 0  # Verdicted meanwhile by another thread
+        except OSError as e:
+            errors.append(e)
+            return 0
+        return 1
 
 
 class NFQueue(object):
@@ -289,21 +1476,124 @@ class NFQueue(object):
     ...         print("{}:{}".format(t.sport, t.dport))
     ...     p.mangle()
 
+    The packets can also be processed by batches with `.batches()`. In this
+    case, the verdicts (`.accept()`, `.drop()` and `.mangle()`) are only sent
+    once the whole batch has been processed:
+
+    >>> q = NFQueue(batch_size=64)
+    >>> for batch in q.batches():
+    ...     for p in batch:
+    ...         p.accept()
+    >>> print(q.stats)
+
+    When the rule balances the packets over multiple queues (see
+    `NFQueueRule`), one `NFQueue` is created per pair of OUTPUT/INPUT queues
+    with `index` indicating which pair of the range it serves. With `chain`,
+    only one queue of the pair is bound so each chain can be read on its own
+    connection (by its own thread).
+
     :param qnum: The queue number to use. For the same reasons explained in
         `NFQueue`'s documentations, qnum should be even and will raise a
         `ValueError` exception if not.
+    :param batch_size: The maximum number of packets to read (and then to
+        verdict) at once. Default is 1 (no batching).
+    :param queues: The number of queues the rule balances the packets over.
+        Default is 1.
+    :param index: The index of the OUTPUT/INPUT pair of queues to bind to,
+        between 0 and `queues`-1. Default is 0.
+    :param batch_verdicts: Regroup the consecutive accepts (resp. drops) of a
+        batch in a single verdict. It must be disabled if some packets are
+        verdicted outside of their batch. Default is True.
+    :param gso: Receive the GSO packets without segmenting them in the
+        kernel (`NFQA_CFG_F_GSO`). Their checksum may not be computed yet
+        (see `PacketWrapper.skb_info`). Default is False.
+    :param copy_meta: Only copy the metadata of the packets (`COPY_META`):
+        the packets have no payload (see `PacketWrapper.has_payload`) and can
+        only be accepted or dropped. Default is False.
+    :param max_len: The maximum number of packets waiting in the kernel on
+        each queue. Default is None (the kernel default, 1024).
+    :param rcvbuf: The size (in bytes) of the receive buffer of the netlink
+        socket. When it overflows, the packets are lost (see
+        `QueueStats.overruns`). Default is None (the system default).
+    :param fail_open: Accept the packets when a queue is full instead of
+        dropping them. Default is False.
+    :param chain: The chain whose queue is bound ('OUTPUT' or 'INPUT').
+        Default is None (both queues of the pair).
+    :param poll_timeout: The maximum time (in seconds) to wait for a packet
+        before checking again if the queue has been stopped. `.stop()` also
+        wakes the waiting thread up at once. Default is
+        `DEFAULT_POLL_TIMEOUT`.
+    :param notify: Write a byte on a pipe each time packets are received, so
+        an event loop can watch `.fileno()` and read them with
+        `.poll_batch()`. Default is False.
     """
-    def __init__(self, qnum=0):
+    # pylint: disable=too-many-arguments,too-many-locals
+    def __init__(self, qnum=0, batch_size=DEFAULT_BATCH_SIZE, queues=1,
+                 index=0, batch_verdicts=True, gso=False, copy_meta=False,
+                 max_len=None, rcvbuf=None, fail_open=False, chain=None,
+                 poll_timeout=DEFAULT_POLL_TIMEOUT, notify=False):
         if qnum % 2:
             raise ValueError('qnum should be even')
+        if batch_size < 1:
+            raise ValueError('batch_size should be at least 1')
+        if not 0 <= index < queues:
+            raise ValueError('index should be between 0 and queues-1')
+        if chain not in (None, OUTPUT.name, INPUT.name):
+            raise ValueError("chain should be 'OUTPUT', 'INPUT' or None")
 
-        self._conn = fnfqueue.Connection()
-        self._conn.bind(qnum).set_mode(
-            fnfqueue.MAX_PAYLOAD, fnfqueue.COPY_PACKET
-        )
-        self._conn.bind(qnum+1).set_mode(
-            fnfqueue.MAX_PAYLOAD, fnfqueue.COPY_PACKET
+        self.qnum = qnum
+        self.batch_size = batch_size
+        self.queues = queues
+        self.index = index
+        self.gso = gso
+        self.copy_meta = copy_meta
+        self.max_len = max_len
+        self.rcvbuf = rcvbuf
+        self.fail_open = fail_open
+        self.chain = chain
+        self.poll_timeout = poll_timeout
+        # The queue used by the OUTPUT chain and the one used by INPUT chain
+        # (or only the one of `chain`)
+        self.qnums = tuple(
+            qnum + c.qnum * queues + index for c in (OUTPUT, INPUT)
+            if chain is None or c.name == chain
         )
+        self.stats = QueueStats()
+
+        if batch_size > 1:
+            # Receive up to `batch_size` packets per netlink read and make
+            # sure there are always enough buffers allocated for that.
+            self._conn = fnfqueue.Connection(
+                alloc_size=max(50, batch_size), chunk_size=batch_size
+            )
+            self._verdicts = VerdictBatch(self.stats, merge=batch_verdicts)
+        else:
+            self._conn = fnfqueue.Connection()
+            self._verdicts = None
+        try:
+            check_fnfqueue(self._conn)
+        except ImportError:
+            self._conn.close()
+            raise
+        # The queue signaling the packets received on a pipe (no queue is
+        # bound yet so the reader thread has not received anything)
+        self._notifying = None
+        if notify:
+            self._notifying = _NotifyingPacketQueue()
+            # pylint: disable=protected-access
+            self._conn._received = self._notifying
+        if rcvbuf is not None:
+            _set_rcvbuf(self._conn, rcvbuf)
+        copy_mode = fnfqueue.COPY_META if copy_meta else fnfqueue.COPY_PACKET
+        for queue_num in self.qnums:
+            queue = self._conn.bind(queue_num)
+            queue.set_mode(fnfqueue.MAX_PAYLOAD, copy_mode)
+            if gso:
+                queue.gso = True
+            if max_len is not None:
+                queue.set_maxlen(max_len)
+            if fail_open:
+                queue.fail_open = True
 
         # Has the nfqueue been stopped ?
         self._stopped = False
@@ -314,29 +1604,228 @@ class NFQueue(object):
     def __next__(self):
         return self.next_packet()
 
+    @staticmethod
+    def _wrap(p, verdicts=None):
+        """Wraps a `fnfqueue` packet in the corresponding `PacketWrapper`.
+        Returns 'None' (and accepts the packet) if the L3 protocol is not
+        supported."""
+        if p.hw_protocol == scapy.data.ETH_P_IP:
+            return IP(p, verdicts)
+        if p.hw_protocol == scapy.data.ETH_P_IPV6:
+            return IPv6(p, verdicts)
+        if verdicts is None:
+            p.accept()
+        else:
+            verdicts.add(p, fnfqueue.ACCEPT)
+        return None
+
+    def _wait_packet(self, block=True):
+        """Waits (at most `poll_timeout` seconds) for the next packet read
+        from the netlink socket by the reader thread of the connection. With
+        `block` set to False, it does not wait at all.
+
+        Returns:
+            The raw `fnfqueue` packet, the exception the reader thread
+            reported or 'None' if there is no packet yet (or the queue has
+            been stopped).
+        """
+        # fnfqueue only offers a blocking iteration over the packets: its
+        # reader thread polls the socket (and a wake-up pipe) and hands the
+        # packets over through a condition that is waited on with a timeout
+        # here, so a stop is never missed.
+        # pylint: disable=protected-access
+        received = self._conn._received
+        with received._packet_cond:
+            if (block and not received._packet_queue
+                    and received._exception is None and not self._stopped):
+                received._packet_cond.wait(self.poll_timeout)
+            if received._exception is not None:
+                return received._exception
+            if received._packet_queue:
+                return received._packet_queue.popleft()
+            return None
+
+    def _receive(self, block=True):
+        """Yields the `fnfqueue` packets received, until the queue is
+        stopped or the connection is closed (or, with `block` set to False,
+        until no packet is left). The overruns of the netlink socket are
+        counted and the reception goes on."""
+        while not self._stopped:
+            p = self._wait_packet(block)
+            if p is None:
+                if not block:
+                    return
+                continue
+            if isinstance(p, fnfqueue.BufferOverflowException):
+                # Some packets were lost, the next ones are still received
+                self.stats.overruns += 1
+                self._conn.reset()
+                continue
+            if isinstance(p, StopIteration):
+                return  # The connection has been closed
+            if isinstance(p, Exception):
+                raise p
+            err = fnfqueue.lib.parse_packet(p)
+            if err != 0:
+                raise OSError(err, os.strerror(err))
+            yield fnfqueue.Packet(self._conn, p)
+
     def next_packet(self):
-        """Returns the next packet in NFQUEUE."""
+        """Returns the next packet in NFQUEUE. Its verdict is sent
+        immediately, even if the queue uses batches."""
         if self.is_stopped():
             raise StopIteration
-        for p in self._conn:
-            if p.hw_protocol == scapy.data.ETH_P_IP:
-                return IP(p)
-            if p.hw_protocol == scapy.data.ETH_P_IPV6:
-                return IPv6(p)
-            p.accept()
+        for p in self._receive():
+            pkt = self._wrap(p)
+            if pkt is not None:
+                self.stats.add_batch(1, 1)
+                self.stats.add_verdicts(1)
+                return pkt
         raise StopIteration
 
+    def next_batch(self):
+        """Returns a list of the next packets in NFQUEUE.
+
+        It blocks until at least 1 packet is available and then takes all the
+        packets already received, up to `batch_size` packets. The verdicts of
+        these packets are only sent on `.flush_verdicts()`.
+        """
+        if self.is_stopped():
+            raise StopIteration
+        if self._verdicts is None:
+            return [self.next_packet()]
+        batch = list()
+        for p in self._receive():
+            pkt = self._wrap(p, self._verdicts)
+            if pkt is not None:
+                batch.append(pkt)
+            if batch and (len(batch) >= self.batch_size
+                          or not _pending_packets(self._conn)):
+                break
+        if not batch:
+            # The queue has been stopped (or the connection closed)
+            self.flush_verdicts()
+            raise StopIteration
+        self.stats.add_batch(len(batch), self.batch_size)
+        return batch
+
+    def poll_batch(self):
+        """Returns a list of the packets already received (up to
+        `batch_size` packets), without waiting. The list is empty if there is
+        none. Like `.next_batch()`, the verdicts are only sent on
+        `.flush_verdicts()` (if the queue uses batches).
+
+        It is meant to be called by an event loop when `.fileno()` is
+        readable: the pipe is emptied first, so it is only readable again
+        once new packets are received. The packets left (see `.backlog()`)
+        must be polled without waiting for the pipe.
+        """
+        if self.is_stopped():
+            raise StopIteration
+        if self._notifying is not None:
+            self._notifying.drain()
+        batch = list()
+        for p in self._receive(block=False):
+            pkt = self._wrap(p, self._verdicts)
+            if pkt is not None:
+                batch.append(pkt)
+                if len(batch) >= self.batch_size:
+                    break
+        if batch:
+            self.stats.add_batch(len(batch), self.batch_size)
+            if self._verdicts is None:
+                self.stats.add_verdicts(len(batch))
+        return batch
+
+    def fileno(self):
+        """Returns the file descriptor readable when packets are received
+        (only with `notify`)."""
+        if self._notifying is None:
+            raise ValueError('the nfqueue was created without notify')
+        return self._notifying.notify_r
+
+    def backlog(self):
+        """Returns the number of packets already received from the kernel
+        and waiting to be read."""
+        return _pending_packets(self._conn)
+
+    def flush_verdicts(self):
+        """Sends the verdicts recorded for the packets of the last batch."""
+        if self._verdicts is not None:
+            self._verdicts.flush()
+
+    def fail_open(self, packets):
+        """Accepts unmodified the packets of `packets` that have no verdict
+        yet, after sending the verdicts recorded. It can be called from
+        another thread than the one reading the queue (e.g. while that one
+        is stuck on a packet), the packets are never verdicted twice and the
+        errors are ignored.
+
+        :param packets: The packets (`IP` or `IPv6`) to accept.
+        """
+        pkts = [packet.fnfqueue_pkt for packet in packets]
+        if self._verdicts is not None:
+            self._verdicts.fail_open(pkts)
+            return
+        for pkt in pkts:
+            try:
+                pkt.accept()
+            except Exception:  # pylint: disable=broad-except
+                pass  # Already verdicted
+
+    def batches(self):
+        """Yields the batches of packets in NFQUEUE. The verdicts of a batch
+        are automatically flushed before the next batch is read."""
+        while True:
+            try:
+                batch = self.next_batch()
+            except StopIteration:
+                return
+            yield batch
+            self.flush_verdicts()
+
     def is_stopped(self):
         """Has the nfqueue been stopped (i.e. cannot be used anymore) ?"""
         return self._stopped
 
     def stop(self):
-        """Stops the process of the nfqueue by closing the connection."""
+        """Stops the process of the nfqueue. The thread waiting for packets
+        is woken up at once and stops reading (the batch being processed is
+        still verdicted). The connection is closed with `.close()`, by the
+        reading thread."""
+        self._stopped = True
+        # pylint: disable=protected-access
+        received = self._conn._received
+        with received._packet_cond:
+            received._packet_cond.notify_all()
+
+    def close(self):
+        """Stops the nfqueue and closes the connection. The packets not
+        verdicted yet are dropped by the kernel."""
         self._stopped = True
         self._conn.close()
+        if self._notifying is not None:
+            self._notifying.close_pipe()
+
+    def update_drops(self, drops=None):
+        """Updates the drop counters of `.stats` with the kernel counters of
+        the queues (they are kept once the queues are unbound).
+
+        :param drops: The counters returned by `read_queue_drops()`, read
+            here if None (the default).
+        """
+        if drops is None:
+            drops = read_queue_drops()
+        counters = [drops[queue_num] for queue_num in self.qnums
+                    if queue_num in drops]
+        if counters:
+            self.stats.kernel_drops = sum(c[0] for c in counters)
+            self.stats.user_drops = sum(c[1] for c in counters)
 
     def unbind(self):
-        """Unbind all the NFQUEUES."""
+        """Unbind all the NFQUEUES (their drop counters are read
+        first)."""
+        self.update_drops()
         for queue in list(self._conn.queue.values()):
             queue.unbind()
 
@@ -350,14 +1839,75 @@ class PacketWrapper(abc.ABC):
     validate (or drop) the `fnfqueue` packets are still usable.
     See the corresponding documentation to learn how to use those modules.
 
+    The `scapy` packet is only built (i.e. the payload is dissected) the
+    first time it is accessed. Until then, the packet is kept as its raw
+    payload (see `.raw`) and mangling it is the same as accepting it.
+    Once dissected, the packet is serialized only once, when its verdict is
+    given, and if the result is the original payload, it is accepted as is.
+
+    The verdict methods (`.accept()`, `.drop()`, `.mangle()` and
+    `.offload()`) are either sent immediately or recorded in a
+    `VerdictBatch` to be sent later with the rest of the batch.
+
+    The attributes of the `fnfqueue` packet (e.g. `.mark`, `.hook` or
+    `.payload`) are resolved first, so reading them never dissects the
+    packet. Only the other attributes are looked up in the `scapy` packet.
+
+    When the queue only copies the metadata of the packets, `.raw` is 'None'
+    (see `.has_payload`): the packet can only be accepted or dropped.
+
     :param pkt: the `fnfqueue` packet received
-    :param output: Is the packet from the OUTPUT chain. Default is True
+    :param verdicts: the `VerdictBatch` where to record the verdicts. Default
+        is 'None' which means the verdicts are sent immediately.
     """
 
-    def __init__(self, pkt):
-        self.scapy_pkt = self.l3_layer(pkt.payload)
+    def __init__(self, pkt, verdicts=None):
+        self._scapy_pkt = None
         self.fnfqueue_pkt = pkt
-        self._output = pkt.packet.queue_id % 2 == 0
+        try:
+            self.raw = memoryview(pkt.payload)
+        except fnfqueue.NoSuchAttributeException:
+            self.raw = None  # Only the metadata were copied
+        # The delays of the resulting packets are measured from here
+        self.arrival = time.monotonic()
+        # The hook tells the chain whatever the queue (balanced or not)
+        self._output = pkt.hook == NF_INET_LOCAL_OUT
+        self._verdicts = verdicts
+
+    @property
+    def scapy_pkt(self):
+        """The `scapy` packet, dissected from the payload on first
+        access."""
+        if self._scapy_pkt is None:
+            self._scapy_pkt = self.l3_layer(bytes(self.raw))
+        return self._scapy_pkt
+
+    @scapy_pkt.setter
+    def scapy_pkt(self, new):
+        self._scapy_pkt = new
+
+    def is_dissected(self):
+        """Has the `scapy` packet been built ? If not, the packet is still
+        exactly the payload received."""
+        return self._scapy_pkt is not None
+
+    @property
+    def has_payload(self):
+        """Was the content of the packet copied ? If not, only its metadata
+        are known."""
+        return self.raw is not None
+
+    @property
+    def skb_info(self):
+        """The skb info flags of the packet (`SKB_CSUMNOTREADY`,
+        `SKB_GSO`), '0' if none is set."""
+        try:
+            # pylint: disable=protected-access
+            return self.fnfqueue_pkt._get_property32(
+                'skb_info', fnfqueue.lib.NFQA_SKB_INFO
+            )
+        except fnfqueue.NoSuchAttributeException:
+            return 0
 
     @property
     @abc.abstractmethod
@@ -378,36 +1928,127 @@ class PacketWrapper(abc.ABC):
 
     def _apply_modifications(self):
         """Reports the modifications in the Scapy packet to the fnfqueue
-        packet."""
-        self.fnfqueue_pkt.payload = bytes(self.scapy_pkt)
+        packet.
+
+        The Scapy packet is serialized (once) only if it was dissected.
+
+        Returns:
+            True if the payload of the fnfqueue packet changed, False if the
+            packet is still the original one.
+        """
+        if not self.is_dissected():
+            return False
+        payload = bytes(self.scapy_pkt)
+        if payload == self.raw:
+            # Dissected (e.g. only read by the mods) but left untouched
+            return False
+        self.fnfqueue_pkt.payload = payload
+        return True
+
+    def accept(self):
+        """Accepts the packet without its modifications."""
+        if self._verdicts is None:
+            self.fnfqueue_pkt.accept()
+        else:
+            self._verdicts.add(self.fnfqueue_pkt, fnfqueue.ACCEPT)
+
+    def drop(self):
+        """Drops the packet."""
+        if self._verdicts is None:
+            self.fnfqueue_pkt.drop()
+        else:
+            self._verdicts.add(self.fnfqueue_pkt, fnfqueue.DROP)
+
+    def mangle(self):
+        """Accepts the packet with its modifications."""
+        if not self._apply_modifications():
+            # Nothing was modified, the original bytes can be used
+            self.accept()
+            return
+        if self._verdicts is None:
+            self.fnfqueue_pkt.mangle()
+        else:
+            self._verdicts.add(self.fnfqueue_pkt, fnfqueue.ACCEPT,
+                               mangle=fnfqueue.MANGLE_PAYLOAD)
+
+    def offload(self, mark=OFFLOAD_MARK):
+        """Accepts the packet without its modifications and marks its
+        connection as offloaded.
+
+        The packet gets `mark` and goes through the Netfilter hook again
+        (`REPEAT` verdict), where the offload rules (see `NFQueueRule`) save
+        the mark on the connection and accept the packet. The next packets
+        of the connection are then accepted without being queued, for as
+        long as the connection exists (even after the modifications change).
+
+        Args:
+            mark: The bits to set in the mark of the packet. Default is
+                `OFFLOAD_MARK`.
+        """
+        try:
+            current = self.fnfqueue_pkt.mark
+        except fnfqueue.NoSuchAttributeException:
+            current = 0  # The packet has no mark
+        self.fnfqueue_pkt.mark = current | mark
+        if self._verdicts is None:
+            self.fnfqueue_pkt.verdict(fnfqueue.REPEAT, fnfqueue.MANGLE_MARK)
+        else:
+            self._verdicts.add(self.fnfqueue_pkt, fnfqueue.REPEAT,
+                               mangle=fnfqueue.MANGLE_MARK)
+
+    def _is_fnfqueue_attr(self, name):
+        """Is `name` an attribute of the `fnfqueue` packet ? Its properties
+        are not evaluated."""
+        pkt = self.__dict__.get('fnfqueue_pkt')
+        return (pkt is not None
+                and (hasattr(type(pkt), name) or name in vars(pkt)))
 
     def __dir__(self):
-        ret = ['scapy_pkt', 'fnfqueue_pkt', 'l3_layer', 'is_input',
-               'is_output']
-        ret.extend(dir(self.scapy_pkt))
+        ret = ['scapy_pkt', 'fnfqueue_pkt', 'raw', 'arrival', 'l3_layer',
+               'has_payload', 'skb_info', 'is_input',
+               'is_output', 'is_dissected', 'accept', 'drop', 'mangle',
+               'offload']
+        if self.is_dissected():
+            ret.extend(dir(self.scapy_pkt))
+        elif self.has_payload:
+            # The fields can be listed without dissecting the packet
+            ret.extend(field.name for field in self.l3_layer.fields_desc)
         ret.extend(dir(self.fnfqueue_pkt))
         return ret
 
     def __getattr__(self, name):
-        try:
-            return getattr(self.scapy_pkt, name)
-        except AttributeError:
-            pass
-        ret = getattr(self.fnfqueue_pkt, name)
-        # When accessing the underlying fnfqueue methods,
-        # force to apply the modifications (useful before calling methods
-        # such as accept, mangle, verdict, ...)
-        self._apply_modifications()
-        return ret
-
-    def raw_send(self):
-        """Sends the scapy packet directly on a raw socket.
+        if name.startswith('__') or name in ('_scapy_pkt', 'raw'):
+            # Not set yet (e.g. while unpickling): no lookup in the packets
+            raise AttributeError(name)
+        if self._is_fnfqueue_attr(name):
+            ret = getattr(self.fnfqueue_pkt, name)
+            # When giving a verdict with the underlying fnfqueue method,
+            # force to apply the modifications first
+            if name == 'verdict':
+                self._apply_modifications()
+            return ret
+        if not self.has_payload:
+            raise AttributeError(
+                "'{}' is not an attribute of a packet queued without its "
+                "payload".format(name)
+            )
+        return getattr(self.scapy_pkt, name)
+
+    def raw_send(self, sender=None):
+        """Sends the scapy packet directly, below the IP stack.
 
         The charge of dropping the nfqueue packet is left to the user
         (if necessary).
-        """
-        scapy.sendrecv.send(self.scapy_pkt)
 
+        Args:
+            sender: The sender (see `fragscapy.sender`) to use. Default is
+                'None' which means the sender of the calling thread (see
+                `fragscapy.sender.thread_sender()`).
+        """
+        if sender is None:
+            sender = thread_sender()
+        sender.send(bytes(self.scapy_pkt) if self.is_dissected()
+                    else self.raw)
 
 
 class IP(PacketWrapper):
@@ -1,9 +1,18 @@
-"""A list of wrappers around Scapy packets and metadata (e.g. delay)."""
+"""A list of wrappers around Scapy packets and metadata (e.g. delay).
+
+The packets can be added either as Scapy packets or as raw bytes. In the
+latter case, the Scapy packet is only built (i.e. the bytes are dissected)
+the first time a modification accesses it. A packet that is never accessed
+keeps its original bytes and costs no build at all.
+"""
 
 import time
 
 import scapy.sendrecv
 
+# Not `from ... import`: `fragscapy.sender` imports this module too
+import fragscapy.sender
+
 
 # The minimum time (in seconds) a packet will be delayed
 MIN_TIME_DELAY = 0.01
@@ -28,12 +37,16 @@ class PacketStruct(object):
     amount of seconds. That way, the user can easily control the delay between
     each packet to be sent.
 
+    The packet can also be created from raw bytes with `.from_raw()`. The
+    bytes are then only dissected the first time `pkt` is accessed.
+
     Args:
         pkt: The Scapy packet.
         delay: The delay (in seconds) before sending the packet.
 
     Attributes:
-        pkt: The Scapy packet.
+        pkt: The Scapy packet (dissected when first accessed if the packet
+            was created from raw bytes).
 
     Examples:
         >>> pkt = PacketStruct(IP()/TCP()/"PLOP", 25)
@@ -51,9 +64,51 @@ class PacketStruct(object):
         PacketStruct(pkt=44B, delay=25.0s)
     """
     def __init__(self, pkt, delay):
-        self.pkt = pkt
+        self._pkt = pkt
+        self._raw = None
+        self._l3_layer = None
         self._delay = _safe_delay(delay)
 
+    @classmethod
+    def from_raw(cls, raw, l3_layer, delay=0):
+        """Creates a packet from raw bytes, dissected only when needed.
+
+        Args:
+            raw: The raw bytes of the packet (a bytes-like object).
+            l3_layer: The Scapy layer to use for the dissection (e.g.
+                `scapy.layers.inet.IP` or `scapy.layers.inet6.IPv6`).
+            delay: The delay (in seconds) before sending the packet.
+        """
+        # pylint: disable=protected-access
+        pkt_struct = cls(None, delay)
+        pkt_struct._raw = raw
+        pkt_struct._l3_layer = l3_layer
+        return pkt_struct
+
+    @property
+    def pkt(self):
+        """The Scapy packet."""
+        if self._pkt is None and self._raw is not None:
+            self._pkt = self._l3_layer(bytes(self._raw))
+        return self._pkt
+
+    @pkt.setter
+    def pkt(self, val):
+        self._pkt = val
+        self._raw = None
+
+    def is_dissected(self):
+        """Has the Scapy packet been built ? If not, the packet is still
+        exactly its original raw bytes."""
+        return self._pkt is not None
+
+    @property
+    def raw(self):
+        """The bytes of the packet, without building it if possible."""
+        if self._pkt is None and self._raw is not None:
+            return bytes(self._raw)
+        return bytes(self._pkt)
+
     @property
     def delay(self):
         """The delay to wait before sending the packet."""
@@ -63,19 +118,35 @@ class PacketStruct(object):
     def delay(self, val):
         self._delay = _safe_delay(val)
 
-    def send(self):
-        """Sends the packet as a Layer-3 packet."""
+    def send(self, sender=None):
+        """Sends the packet as a Layer-3 packet.
+
+        Args:
+            sender: The sender (see `fragscapy.sender`) to use. Default is
+                'None' which means the sender of the calling thread (see
+                `fragscapy.sender.thread_sender()`).
+        """
         # Only sleep if above the min limit
         if self.delay > MIN_TIME_DELAY:
             time.sleep(self.delay)
-        scapy.sendrecv.send(self.pkt)
+        if sender is None:
+            sender = fragscapy.sender.thread_sender()
+        sender.send(self.raw)
 
-    def sendp(self):
-        """Sends the packet as a Layer-2 packet."""
+    def sendp(self, sender=None):
+        """Sends the packet as a Layer-2 packet.
+
+        Args:
+            sender: The `fragscapy.sender.TxRingSender` to use. Default is
+                'None' which means a new socket is opened for the packet.
+        """
         # Only sleep if above the min limit
         if self.delay > MIN_TIME_DELAY:
             time.sleep(self.delay)
-        scapy.sendrecv.sendp(self.pkt)
+        if sender is not None:
+            sender.send_batch((bytes(self.pkt),))
+        else:
+            scapy.sendrecv.sendp(self.pkt)
 
     def display(self):
         """Displays the content of the packet.
@@ -89,6 +160,8 @@ class PacketStruct(object):
 
     def copy(self):
         """Returns a copy of the packet."""
+        if not self.is_dissected():
+            return PacketStruct.from_raw(self._raw, self._l3_layer, self.delay)
         return PacketStruct(self.pkt, self.delay)
 
     def __str__(self):
@@ -107,7 +180,7 @@ class PacketStruct(object):
 
     def __repr__(self):
         return "PacketStruct(pkt={}B, delay={}s)".format(
-            len(self.pkt), self.delay
+            len(self.raw), self.delay
         )
 
 
@@ -169,6 +242,17 @@ class PacketList(object):
         """
         self.pkts.append(PacketStruct(pkt, delay))
 
+    def add_raw_packet(self, raw, l3_layer, delay=0):
+        """Adds a new packet from raw bytes at the end of the list. It is
+        only dissected if a modification accesses it.
+
+        Args:
+            raw: The raw bytes of the packet.
+            l3_layer: The Scapy layer to use for the dissection.
+            delay: The delay to respect before sending the packet.
+        """
+        self.pkts.append(PacketStruct.from_raw(raw, l3_layer, delay))
+
     def edit_delay(self, index, delay):
         """Changes the delay before packet emission.
 
@@ -205,13 +289,30 @@ class PacketList(object):
         """
         self.pkts.insert(index, PacketStruct(pkt, delay))
 
-    def send_all(self):
-        """Sends all packets in the list as Layer3 packets."""
-        for pkt in self.pkts:
-            pkt.send()
+    def send_all(self, sender=None):
+        """Sends all packets in the list as Layer3 packets.
+
+        Args:
+            sender: The sender (see `fragscapy.sender`) to use. Its persistent
+                socket(s) are used and the packets are sent by batches.
+                Default is 'None' which means the sender of the calling
+                thread (see `fragscapy.sender.thread_sender()`).
+        """
+        if sender is None:
+            sender = fragscapy.sender.thread_sender()
+        sender.send_packetlist(self)
 
-    def sendp_all(self):
-        """Sends all packets in the list as Layer2 packets."""
+    def sendp_all(self, sender=None):
+        """Sends all packets in the list as Layer2 packets.
+
+        Args:
+            sender: The `fragscapy.sender.TxRingSender` to use. The frames
+                are written in its TX ring and sent by batches. Default is
+                'None' which means a new socket is opened for each packet.
+        """
+        if sender is not None:
+            sender.sendp_packetlist(self)
+            return
         for pkt in self.pkts:
             pkt.sendp()
 
@@ -0,0 +1,222 @@
+"""Dumps the packets in pcap files from a background thread.
+
+Appending each packet with `scapy.utils.wrpcap` reopens the file (and checks
+its header) and flushes it every time, on the path of the packets being
+processed. A `PcapSink` instead queues the raw packets in memory and a
+background thread writes them, keeping one buffered `RawPcapWriter` open per
+file until the files are rotated (i.e. the test changes) or the sink is
+stopped.
+
+The packets are written with the `LINKTYPE_RAW` link-layer type: the records
+are the raw IPv4 or IPv6 packets, without any Layer-2 header, and both
+families can be mixed in the same file. The timestamp of a record is the time
+the packet was queued, not the time it was written.
+
+The `LoopPcapSink` is the equivalent for the engine driven by an asyncio event
+loop (see `fragscapy.asyncengine`): the packets are written in the buffers of
+the writers at once, from the loop, and a timer of the loop flushes them.
+"""
+
+import queue
+import threading
+import time
+
+import scapy.utils
+
+
+# The link-layer type of the pcap files: raw IPv4/IPv6 packets
+LINKTYPE_RAW = 101
+
+# The default time (in seconds) between 2 flushes of the `LoopPcapSink`
+FLUSH_INTERVAL = 1.0
+
+# The special items of the queue (besides the packets)
+_ROTATE = object()
+_FLUSH = object()
+_STOP = object()
+
+
+class _PcapWriters(object):
+    """Keeps a buffered `RawPcapWriter` open per file (in `._writers`) and
+    counts the packets written (in `.written`)."""
+    def _writer(self, filename):
+        """Returns the open writer of `filename`, opening it if needed."""
+        writer = self._writers.get(filename)
+        if writer is None:
+            writer = scapy.utils.RawPcapWriter(
+                filename, linktype=LINKTYPE_RAW, append=True, sync=False
+            )
+            # Only written on the first `write()`, which is not used here (it
+            # can not set the timestamps)
+            writer.write_header(None)
+            self._writers[filename] = writer
+        return writer
+
+    def _close_all(self):
+        """Closes all the open files."""
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+
+    def _write(self, filename, timestamp, raws):
+        """Appends packets to a pcap file."""
+        writer = self._writer(filename)
+        sec = int(timestamp)
+        usec = int((timestamp - sec) * 1000000)
+        for raw in raws:
+            writer.write_packet(raw, sec=sec, usec=usec)
+        self.written += len(raws)
+
+    def _flush_all(self):
+        """Flushes all the open files."""
+        for writer in self._writers.values():
+            writer.flush()
+
+
+class PcapSink(_PcapWriters, threading.Thread):
+    """Thread writing raw packets in pcap files.
+
+    The packets are queued with `.dump()`, which only copies a reference to
+    the packets, and written in order by the thread.
+
+    Attributes:
+        written: The number of packets written so far.
+
+    Examples:
+        >>> sink = PcapSink()
+        >>> sink.start()
+        >>> sink.dump("local_1.pcap", [bytes(IP()/TCP())])
+        >>> sink.rotate()   # Closes 'local_1.pcap' once it is written
+        >>> sink.dump("local_2.pcap", [bytes(IP()/UDP())])
+        >>> sink.stop()     # Writes everything and closes the files
+        >>> sink.join()
+    """
+    def __init__(self):
+        super(PcapSink, self).__init__(daemon=True)
+        self.written = 0
+        self._queue = queue.Queue()
+        self._writers = dict()
+
+    def dump(self, filename, raws):
+        """Queues packets to be appended to a pcap file.
+
+        Args:
+            filename: The pcap file to write the packets in.
+            raws: A list of raw IP packets (bytes). They must not be modified
+                afterwards.
+        """
+        self._queue.put((filename, time.time(), raws))
+
+    def rotate(self):
+        """Closes all the open files once the packets already queued are
+        written. The next packets re-open their file (in append mode)."""
+        self._queue.put(_ROTATE)
+
+    def flush(self):
+        """Waits until all the packets queued are written and flushed to the
+        files."""
+        self._queue.put(_FLUSH)
+        self._queue.join()
+
+    def stop(self):
+        """Stops the thread once all the packets queued are written. The files
+        are then closed."""
+        self._queue.put(_STOP)
+
+    def run(self):
+        """Writes the queued packets until the sink is stopped."""
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    self._close_all()
+                    return
+                if item is _ROTATE:
+                    self._close_all()
+                elif item is _FLUSH:
+                    self._flush_all()
+                else:
+                    self._write(*item)
+            except OSError as e:
+                # Losing a dump is better than stopping all the dumps
+                print("Can't write in the pcap file: {}".format(e))
+            finally:
+                self._queue.task_done()
+
+
+class LoopPcapSink(_PcapWriters):
+    """Writes raw packets in pcap files from an asyncio event loop.
+
+    It has the same interface as the `PcapSink` but no thread: `.dump()`
+    writes the packets in the buffer of the writer of the file at once and a
+    timer of `loop` flushes the files every `interval` seconds. It must only
+    be used from the thread running the loop.
+
+    Args:
+        loop: The asyncio event loop running the flushes.
+        interval: The time (in seconds) between 2 flushes. Default is
+            `FLUSH_INTERVAL`.
+
+    Attributes:
+        written: The number of packets written so far.
+
+    Examples:
+        >>> sink = LoopPcapSink(loop)
+        >>> sink.start()    # Flushes the files periodically
+        >>> sink.dump("local_1.pcap", [bytes(IP()/TCP())])
+        >>> sink.rotate()   # Closes 'local_1.pcap'
+        >>> sink.stop()     # Closes the files
+    """
+    def __init__(self, loop, interval=FLUSH_INTERVAL):
+        self.written = 0
+        self._writers = dict()
+        self._loop = loop
+        self._interval = interval
+        self._timer = None
+
+    def dump(self, filename, raws):
+        """Appends packets to a pcap file.
+
+        Args:
+            filename: The pcap file to write the packets in.
+            raws: A list of raw IP packets (bytes).
+        """
+        try:
+            self._write(filename, time.time(), raws)
+        except OSError as e:
+            # Losing a dump is better than stopping all the dumps
+            print("Can't write in the pcap file: {}".format(e))
+
+    def rotate(self):
+        """Closes all the open files. The next packets re-open their file (in
+        append mode)."""
+        self._close_all()
+
+    def flush(self):
+        """Flushes all the open files."""
+        try:
+            self._flush_all()
+        except OSError as e:
+            print("Can't write in the pcap file: {}".format(e))
+
+    def _periodic_flush(self):
+        """Flushes the files and sets the timer of the next flush."""
+        self.flush()
+        self._timer = self._loop.call_later(self._interval,
+                                            self._periodic_flush)
+
+    def start(self):
+        """Starts flushing the files periodically."""
+        self._timer = self._loop.call_later(self._interval,
+                                            self._periodic_flush)
+
+    def stop(self):
+        """Stops flushing the files and closes them."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._close_all()
+
+    def join(self, timeout=None):
+        """Does nothing: there is no thread to wait for. Only there to be
+        used like a `PcapSink`."""
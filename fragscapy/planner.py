@@ -0,0 +1,225 @@
+"""Plans the modlists that the kernel can apply by itself.
+
+Some modifications only give a verdict on the packets (`drop_proba`) or
+change when they are sent (`delay`, `duplicate`, `reorder`): the kernel can
+do the same thing without sending the packets to userland. A random drop is a
+`statistic` (iptables) or `numgen random` (nftables) rule in place of the
+NFQUEUE rule, and a delay and/or a duplication is a netem qdisc on the
+interface, fed with the packets marked with `NETEM_MARK` by the rules.
+
+`plan_modlist()` tells if a modlist can be replaced that way and returns the
+corresponding `KernelPlan`. The plan is computed on the packet list built for
+a single intercepted packet, so it is the exact equivalent of the modlist:
+e.g. `duplicate first` followed by `drop_proba 0.1` can not be planned (each
+copy would be dropped independently) but the opposite order can.
+
+The netem qdisc only applies to the packets leaving an interface: delays and
+duplications can only be planned on the OUTPUT chain, when the interface is
+known. The other modlists keep using the NFQUEUE.
+
+The modlists made only of `VERDICT_ONLY_MODS` always have a plan that
+neither delays nor duplicates the packets (see `is_verdict_only()`): they can
+still be applied from userland to packets queued without their content.
+"""
+
+import collections
+import subprocess
+
+from fragscapy.modifications.delay import Delay
+from fragscapy.modifications.drop_proba import DropProba
+from fragscapy.modifications.duplicate import Duplicate
+from fragscapy.modifications.reorder import Reorder
+from fragscapy.netfilter import NETEM_MARK
+from fragscapy.packetlist import MIN_TIME_DELAY
+
+
+# The kernel equivalent of a modlist: the probability to drop a packet, the
+# delay (in seconds) of the packets and whether they are duplicated
+KernelPlan = collections.namedtuple(
+    'KernelPlan', ['drop_proba', 'delay', 'duplicate']
+)
+
+# The plan of a modlist that leaves the packets unchanged
+IDENTITY_PLAN = KernelPlan(0.0, 0.0, False)
+
+# The `tc` binary used to set up the netem qdisc
+TC_BINARY = "/sbin/tc"
+
+# The band of the root prio qdisc where the marked packets are sent (the
+# first 3 bands keep the default priomap)
+_NETEM_BAND = 4
+_PRIOMAP = ['1', '2', '2', '2', '1', '2', '0', '0',
+            '1', '1', '1', '1', '1', '1', '1', '1']
+
+# The mods that only accept or drop the packets they are applied to
+VERDICT_ONLY_MODS = (DropProba, Reorder)
+
+# A index that can not be known in advance (random index on several packets)
+_UNKNOWN = object()
+
+
+def needs_netem(plan):
+    """Does `plan` need a netem qdisc (i.e. delays or duplicates packets) ?"""
+    return plan.delay > 0 or plan.duplicate
+
+
+def is_verdict_only(plan):
+    """Does `plan` only accept or drop the packets (i.e. it can be applied
+    without the content of the packets) ?"""
+    return plan is not None and not needs_netem(plan)
+
+
+def _resolve_index(index, delays):
+    """Returns the index of the packet a 'first|last|random|<id>' mod acts
+    on, in a list of `len(delays)` packets. Returns 'None' if the mod acts on
+    none of them and `_UNKNOWN` if it can not be known."""
+    if index is None:  # Random
+        return 0 if len(delays) == 1 else _UNKNOWN
+    if -len(delays) <= index <= len(delays) - 1:
+        return index % len(delays)
+    return None
+
+
+def plan_modlist(modlist):
+    """Translates a modlist in a `KernelPlan`, if possible.
+
+    Args:
+        modlist: The `ModList` to translate.
+
+    Returns:
+        The `KernelPlan` equivalent to `modlist` or 'None' if some mods can't
+        be applied by the kernel (or not exactly like the modlist would).
+    """
+    keep = 1.0
+    # The delays of the packets resulting from a single packet
+    delays = [0.0]
+    for mod in modlist:
+        if isinstance(mod, DropProba):
+            if len(delays) > 1:
+                return None  # Each copy would be dropped independently
+            keep *= 1 - mod.drop_proba
+        elif isinstance(mod, Reorder):
+            if len(set(delays)) > 1:
+                return None  # Only a no-op if the packets are the same
+        elif isinstance(mod, Delay):
+            if mod.delay_all:
+                indexes = range(len(delays))
+            else:
+                index = _resolve_index(mod.delay_index, delays)
+                if index is _UNKNOWN:
+                    return None
+                indexes = [] if index is None else [index]
+            for i in indexes:
+                delays[i] = mod.delay
+        elif isinstance(mod, Duplicate):
+            index = _resolve_index(mod.duplicate_index, delays)
+            if index is _UNKNOWN:
+                return None
+            if index is not None:
+                delays.insert(index, 0.0)
+        else:
+            return None
+
+    # netem sends all the copies at once, after the same delay
+    if len(delays) > 2 or delays[0] < 0:
+        return None
+    if any(delay > MIN_TIME_DELAY for delay in delays[1:]):
+        return None
+    return KernelPlan(
+        drop_proba=1 - keep,
+        delay=delays[0] if delays[0] > MIN_TIME_DELAY else 0.0,
+        duplicate=len(delays) == 2
+    )
+
+
+def plan_modlists(input_modlist, output_modlist, iface=None):
+    """Plans the modlists of both chains.
+
+    Args:
+        input_modlist: The `ModList` of the INPUT chain.
+        output_modlist: The `ModList` of the OUTPUT chain.
+        iface: The interface the netem qdisc can be set on. Default is 'None'
+            which means only the drops can be planned.
+
+    Returns:
+        A dictionary with the `KernelPlan` of each chain ('INPUT' and
+        'OUTPUT'), or 'None' for the chains that still need the NFQUEUE.
+    """
+    plans = dict()
+    chains = (('INPUT', input_modlist, False),
+              ('OUTPUT', output_modlist, iface is not None))
+    for chain, modlist, netem in chains:
+        plan = plan_modlist(modlist)
+        if plan is not None and needs_netem(plan) and not netem:
+            plan = None
+        plans[chain] = plan
+    return plans
+
+
+def _tc(*args):
+    """Runs a `tc` command and raises an exception if it fails."""
+    subprocess.run([TC_BINARY] + list(args), check=True)
+
+
+class NetemQdisc(object):
+    """The netem qdisc delaying and/or duplicating the packets marked with
+    `NETEM_MARK` on an interface.
+
+    It replaces the root qdisc of the interface with a prio qdisc: the marked
+    packets go through the netem qdisc of the last band, the others use the
+    default bands. The root qdisc is deleted (i.e. reset to the default one)
+    when the plan no longer needs netem.
+
+    Args:
+        iface: The interface to set the qdisc on.
+
+    Attributes:
+        iface: The interface to set the qdisc on.
+        plan: The `KernelPlan` currently applied, 'None' if there is no
+            qdisc.
+
+    Examples:
+        >>> netem = NetemQdisc("eth0")
+        >>> netem.update(KernelPlan(0.0, 0.2, True))
+        >>> netem.remove()
+    """
+    def __init__(self, iface):
+        self.iface = iface
+        self.plan = None
+
+    def update(self, plan):
+        """Applies the delay and duplication of `plan` ('None' or a plan
+        that does not need netem removes the qdisc)."""
+        if plan is not None and not needs_netem(plan):
+            plan = None
+        current = self.plan
+        if (plan is not None and current is not None
+                and plan.delay == current.delay
+                and plan.duplicate == current.duplicate):
+            return  # The same qdisc is already set
+        self.remove()
+        if plan is None:
+            return
+
+        netem_opts = []
+        if plan.delay > 0:
+            netem_opts.extend(['delay', "{:.3f}ms".format(plan.delay*1000)])
+        if plan.duplicate:
+            netem_opts.extend(['duplicate', '100%'])
+        mark = "0x{:x}".format(NETEM_MARK)
+        _tc('qdisc', 'add', 'dev', self.iface, 'root', 'handle', '1:',
+            'prio', 'bands', str(_NETEM_BAND), 'priomap', *_PRIOMAP)
+        self.plan = plan
+        _tc('qdisc', 'add', 'dev', self.iface,
+            'parent', "1:{}".format(_NETEM_BAND), 'handle', '40:', 'netem',
+            *netem_opts)
+        _tc('filter', 'add', 'dev', self.iface, 'parent', '1:',
+            'protocol', 'all', 'prio', '1', 'handle', "{0}/{0}".format(mark),
+            'fw', 'flowid', "1:{}".format(_NETEM_BAND))
+
+    def remove(self):
+        """Removes the qdisc (if any)."""
+        if self.plan is None:
+            return
+        self.plan = None
+        _tc('qdisc', 'del', 'dev', self.iface, 'root')
@@ -0,0 +1,241 @@
+"""Sends the delayed packets without blocking the processing of the queue.
+
+The `delay` modification (and the mods that keep the delay of the packets
+they rewrite) asks for some packets to be sent later. Sleeping in the thread
+that processes the NFQUEUE would stall every other packet of the queue, so the
+delayed packets are handed to a `DelayScheduler` instead: a thread that owns
+its own sender and a heap of the packets to send, ordered by deadline.
+
+The delay of a packet is the time to wait after the previous packet of its
+`PacketList` (the first one is delayed from the arrival of the intercepted
+packet). The deadlines are computed once, from the arrival of the original
+packet, so the time spent applying the modifications (or waiting for the
+scheduler) is not added to the delays.
+
+The `AsyncDelayScheduler` does the same with the timers of an asyncio event
+loop, for the engine driven by such a loop (see `fragscapy.asyncengine`).
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+from fragscapy.packetlist import MIN_TIME_DELAY
+
+
+def split_by_deadline(packetlist, arrival):
+    """Groups the packets of a `PacketList` by the time they should be sent.
+
+    The packets are serialized here, so the scheduler never touches a Scapy
+    packet.
+
+    Args:
+        packetlist: The `PacketList` to split.
+        arrival: The time (`time.monotonic()`) the original packet arrived.
+
+    Returns:
+        A list of `(deadline, raws)` tuples, in order, where `raws` is the
+        list of the raw packets to send at `deadline`.
+    """
+    groups = []
+    deadline = arrival
+    raws = []
+    for pkt in packetlist:
+        # Only delay if above the min limit
+        if pkt.delay > MIN_TIME_DELAY:
+            if raws:
+                groups.append((deadline, raws))
+                raws = []
+            deadline += pkt.delay
+        raws.append(pkt.raw)
+    if raws:
+        groups.append((deadline, raws))
+    return groups
+
+
+class _Dispatcher(object):  # pylint: disable=too-few-public-methods
+    """Sends the packets already due and schedules the others (with the
+    `.schedule()` method of the scheduler)."""
+    def dispatch(self, packetlist, arrival, sender):
+        """Sends the packets of a `PacketList` that are already due with
+        `sender` (in the calling thread) and schedules the others.
+
+        Args:
+            packetlist: The `PacketList` to send.
+            arrival: The time (`time.monotonic()`) the original packet
+                arrived.
+            sender: The sender of the calling thread.
+        """
+        groups = split_by_deadline(packetlist, arrival)
+        now = time.monotonic()
+        for i, (deadline, raws) in enumerate(groups):
+            if deadline - now > MIN_TIME_DELAY:
+                # The deadlines only increase: all the next ones are later
+                for later_deadline, later_raws in groups[i:]:
+                    self.schedule(later_deadline, later_raws)
+                return
+            sender.send_raws(raws)
+
+
+class DelayScheduler(_Dispatcher, threading.Thread):
+    """Thread sending batches of packets at a given deadline.
+
+    The batches are kept in a heap ordered by deadline (then by order of
+    scheduling, so batches with the same deadline are sent in order). The
+    thread sleeps until the next deadline or until a new batch is scheduled.
+    The batches still pending when the scheduler is stopped are discarded.
+
+    Args:
+        sender: The sender used to send the packets (see `fragscapy.sender`).
+            It is only used by the scheduler thread.
+
+    Attributes:
+        sender: The sender used to send the packets.
+        scheduled: The number of packets scheduled so far.
+        max_lateness: The maximum time (in seconds) a batch was sent after
+            its deadline.
+
+    Examples:
+        >>> scheduler = DelayScheduler(RawSender())
+        >>> scheduler.start()
+        >>> # Sends what is due now with `sender`, schedules the rest
+        >>> scheduler.dispatch(packetlist, arrival, sender)
+        >>> scheduler.stop()
+        >>> scheduler.join()
+    """
+    def __init__(self, sender):
+        super(DelayScheduler, self).__init__(daemon=True)
+        self.sender = sender
+        self.scheduled = 0
+        self.max_lateness = 0
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+
+    def schedule(self, deadline, raws):
+        """Schedules a batch of raw packets to be sent at `deadline`.
+
+        Args:
+            deadline: The time (`time.monotonic()`) to send the packets at.
+            raws: The list of the raw (Layer-3) packets to send.
+        """
+        with self._cond:
+            heapq.heappush(self._heap, (deadline, next(self._counter), raws))
+            self.scheduled += len(raws)
+            # Only wake up the thread if it waits for a later deadline
+            if self._heap[0][2] is raws:
+                self._cond.notify()
+
+    def pending(self):
+        """Returns the number of packets waiting to be sent."""
+        with self._cond:
+            return sum(len(raws) for _, _, raws in self._heap)
+
+    def _next_batch(self):
+        """Waits for the next batch to be due and returns it (or 'None' if the
+        scheduler is stopped)."""
+        with self._cond:
+            while not self._stopped:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                timeout = self._heap[0][0] - time.monotonic()
+                if timeout <= 0:
+                    _, _, raws = heapq.heappop(self._heap)
+                    self.max_lateness = max(self.max_lateness, -timeout)
+                    return raws
+                self._cond.wait(timeout)
+            return None
+
+    def run(self):
+        """Sends the batches at their deadline until the scheduler is
+        stopped."""
+        while True:
+            raws = self._next_batch()
+            if raws is None:
+                break
+            self.sender.send_raws(raws)
+        self.sender.close()
+
+    def stop(self):
+        """Stops the scheduler. The pending packets are discarded."""
+        with self._cond:
+            self._stopped = True
+            self._heap = []
+            self._cond.notify()
+
+
+class AsyncDelayScheduler(_Dispatcher):
+    """Sends batches of packets at a given deadline from the timers of an
+    asyncio event loop.
+
+    It has the same interface as the `DelayScheduler` but no thread: each
+    batch is a timer of `loop` (whose clock is `time.monotonic()`), so it
+    must only be used from the thread running the loop. The batches still
+    pending when the scheduler is stopped are discarded.
+
+    Args:
+        sender: The sender used to send the packets (see `fragscapy.sender`).
+        loop: The asyncio event loop running the timers.
+
+    Attributes:
+        sender: The sender used to send the packets.
+        scheduled: The number of packets scheduled so far.
+        max_lateness: The maximum time (in seconds) a batch was sent after
+            its deadline.
+
+    Examples:
+        >>> scheduler = AsyncDelayScheduler(RawSender(), loop)
+        >>> scheduler.dispatch(packetlist, arrival, scheduler.sender)
+        >>> loop.run_until_complete(asyncio.sleep(1))
+        >>> scheduler.stop()
+    """
+    def __init__(self, sender, loop):
+        self.sender = sender
+        self.scheduled = 0
+        self.max_lateness = 0
+        self._loop = loop
+        # The timer and the packets of each batch pending
+        self._timers = dict()
+        self._counter = itertools.count()
+
+    def schedule(self, deadline, raws):
+        """Schedules a batch of raw packets to be sent at `deadline`.
+
+        Args:
+            deadline: The time (`time.monotonic()`) to send the packets at.
+            raws: The list of the raw (Layer-3) packets to send.
+        """
+        key = next(self._counter)
+        timer = self._loop.call_at(deadline, self._send, key, deadline)
+        self._timers[key] = (timer, raws)
+        self.scheduled += len(raws)
+
+    def _send(self, key, deadline):
+        """Sends the batch `key`, due at `deadline`."""
+        _, raws = self._timers.pop(key)
+        self.max_lateness = max(self.max_lateness,
+                                self._loop.time() - deadline)
+        self.sender.send_raws(raws)
+
+    def pending(self):
+        """Returns the number of packets waiting to be sent."""
+        return sum(len(raws) for _, raws in self._timers.values())
+
+    def start(self):
+        """Does nothing: the timers are run by the loop. Only there to be
+        used like a `DelayScheduler`."""
+
+    def stop(self):
+        """Stops the scheduler. The pending packets are discarded and the
+        sender is closed."""
+        for timer, _ in self._timers.values():
+            timer.cancel()
+        self._timers = dict()
+        self.sender.close()
+
+    def join(self, timeout=None):
+        """Does nothing: there is no thread to wait for. Only there to be
+        used like a `DelayScheduler`."""
@@ -0,0 +1,512 @@
+"""Long-lived sockets to send the packets built by the modifications.
+
+Sending a packet with `scapy.sendrecv.send` opens a new socket and looks up
+the route of the packet each time. When an intercepted packet is turned into
+dozens of fragments, this is the main cost of the OUTPUT chain.
+
+Both send backends write the packets below the IP stack, on an `AF_PACKET`
+socket, like `scapy.sendrecv.send` does: the packets do not go through the
+netfilter hooks again (they would be queued a second time and the conntrack
+could reassemble the fragments) and the kernel does not rewrite any field of
+their IP header. They keep their socket for their whole life:
+
+* `RawSender` (backend 'raw') keeps one `AF_PACKET` datagram socket, for any
+  interface. The interface and the link-layer address of each destination
+  are resolved by Scapy (route and neighbour) once and cached, the kernel
+  builds the link-layer header. As with Scapy, the packets routed to the
+  loopback interface are the exception: they are sent on raw IP sockets.
+* `TxRingSender` (backend 'txring') writes Layer-2 frames directly in the
+  `PACKET_TX_RING` of an `AF_PACKET` socket bound to an interface: the frames
+  of a whole `PacketList` are copied in a shared memory mapping and handed to
+  the kernel with a single `send()`. The Ethernet header of a Layer-3 packet
+  is resolved once per destination.
+
+A sender is not thread-safe: each `EngineThread` (or worker process) uses its
+own. Use `new_sender()` to build one from the name of its backend, or
+`thread_sender()` to get the `RawSender` kept for the calling thread.
+"""
+
+import mmap
+import socket
+import struct
+import threading
+import time
+
+import scapy.config
+import scapy.layers.inet
+import scapy.layers.inet6
+import scapy.layers.l2
+
+# Not `from ... import`: `fragscapy.packetlist` imports this module too
+import fragscapy.packetlist
+
+
+# The maximum number of destinations kept in the cache of a sender
+MAX_CACHED_DESTINATIONS = 1024
+
+# The names of the send backends
+SENDERS = ('raw', 'txring')
+
+# The sender of each thread (see `thread_sender()`)
+_THREAD_SENDERS = threading.local()
+
+# The default size of a frame in the TX ring (header included) and the
+# default number of frames
+DEFAULT_FRAME_SIZE = 2048
+DEFAULT_FRAME_NR = 256
+
+# The AF_PACKET socket options (from linux/if_packet.h)
+SOL_PACKET = getattr(socket, 'SOL_PACKET', 263)
+PACKET_VERSION = 10
+PACKET_TX_RING = 13
+PACKET_QDISC_BYPASS = 20
+TPACKET_V2 = 1
+# The status of a frame in the TX ring
+TP_STATUS_AVAILABLE = 0
+TP_STATUS_SEND_REQUEST = 1
+# struct tpacket_req: block size, block nr, frame size, frame nr
+_TPACKET_REQ = struct.Struct('=IIII')
+# The start of struct tpacket2_hdr: status, len, snaplen
+_TPACKET2_HDR = struct.Struct('=III')
+# The offset of the data in a frame: TPACKET_ALIGN(sizeof(tpacket2_hdr))
+_TPACKET2_DATA_OFFSET = 32
+
+
+class SenderStats(object):
+    """The counters of a sender (`RawSender` or `TxRingSender`).
+
+    Attributes:
+        packets: The number of packets sent.
+        bytes: The number of bytes sent (headers included).
+        batches: The number of batches of packets sent.
+        errors: The number of packets the kernel refused to send.
+    """
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.batches = 0
+        self.errors = 0
+
+    def __str__(self):
+        return ("{} packets ({} bytes) sent in {} batches, {} errors"
+                .format(self.packets, self.bytes, self.batches, self.errors))
+
+    def __repr__(self):
+        return ("SenderStats(packets={}, bytes={}, batches={}, errors={})"
+                .format(self.packets, self.bytes, self.batches, self.errors))
+
+
+def _destination(raw):
+    """Returns the address family and the raw destination address of an IPv4
+    or IPv6 packet."""
+    if raw[0] >> 4 == 6:
+        return socket.AF_INET6, bytes(raw[24:40])
+    return socket.AF_INET, bytes(raw[16:20])
+
+
+def _resolve_link(family, dst):
+    """Returns the interface to send a packet to `dst` on and the Ethernet
+    header to prepend to it, as resolved by Scapy (route and neighbour).
+
+    Args:
+        family: `socket.AF_INET` or `socket.AF_INET6`.
+        dst: The raw destination address.
+    """
+    addr = socket.inet_ntop(family, dst)
+    if family == socket.AF_INET6:
+        iface = scapy.config.conf.route6.route(addr)[0]
+        l3_pkt = scapy.layers.inet6.IPv6(dst=addr)
+    else:
+        iface = scapy.config.conf.route.route(addr)[0]
+        l3_pkt = scapy.layers.inet.IP(dst=addr)
+    return str(iface), bytes(scapy.layers.l2.Ether() / l3_pkt)[:14]
+
+
+class SenderError(ValueError):
+    """Error with the configuration of a sender."""
+
+
+def new_sender(backend='raw', iface=None, qdisc_bypass=False):
+    """Builds a new sender.
+
+    Args:
+        backend: The name of the send backend ('raw' or 'txring'). Default is
+            'raw'.
+        iface: The interface to send the frames on (only for 'txring').
+            Default is 'None' which means Scapy's default interface.
+        qdisc_bypass: Bypass the qdisc layer of the interface (only for
+            'txring'). Default is 'False'.
+
+    Raises:
+        SenderError: The backend does not exist.
+    """
+    if backend == 'raw':
+        return RawSender()
+    if backend == 'txring':
+        return TxRingSender(iface, qdisc_bypass=qdisc_bypass)
+    raise SenderError("Unknown send backend '{}', should be one of {}"
+                      .format(backend, ', '.join(SENDERS)))
+
+
+def thread_sender():
+    """Returns the `RawSender` of the calling thread, created the first time.
+
+    It sends the packets for which no sender is given, so they do not open a
+    new socket each time.
+    """
+    sender = getattr(_THREAD_SENDERS, 'sender', None)
+    if sender is None:
+        sender = RawSender()
+        _THREAD_SENDERS.sender = sender
+    return sender
+
+
+def _send_by_batches(packetlist, to_frame, send_batch):
+    """Sends the packets of `packetlist` with `send_batch`, in batches of
+    consecutive packets with no delay. Each packet is turned into the bytes
+    to send with `to_frame`."""
+    batch = []
+    for pkt in packetlist:
+        # Only sleep if above the min limit
+        if pkt.delay > fragscapy.packetlist.MIN_TIME_DELAY:
+            if batch:
+                send_batch(batch)
+                batch = []
+            time.sleep(pkt.delay)
+        batch.append(to_frame(pkt))
+    if batch:
+        send_batch(batch)
+
+
+class RawSender(object):
+    """Sends raw IPv4/IPv6 packets on a persistent `AF_PACKET` socket.
+
+    The socket is only opened when the first packet is sent, so a
+    `RawSender` can be created before a fork. The packets of a `PacketList`
+    are sent by batches: all the consecutive packets that are not delayed
+    are sent at once, without going back to the caller.
+
+    Python does not expose `sendmmsg(2)`, so a batch is a plain loop of
+    `sendto(2)` on the same socket. The packets skip the IP stack of the
+    kernel: the interface and the link-layer address of each destination are
+    resolved by Scapy the first time and the socket address built from them
+    is kept. The frames written on an `AF_PACKET` socket never reach the
+    loopback interface, so the packets routed to it are sent on a raw IP
+    socket of their family instead, like Scapy does.
+
+    Attributes:
+        stats: The `SenderStats` of this sender.
+
+    Examples:
+        >>> sender = RawSender()
+        >>> pl = PacketList()
+        >>> pl.add_packet(IP(dst="192.168.0.1")/TCP()/"PLOP")
+        >>> pl.add_packet(IP(dst="192.168.0.1")/TCP()/"PLIP")
+        >>> sender.send_packetlist(pl)
+        >>> print(sender.stats)
+        2 packets (88 bytes) sent in 1 batches, 0 errors
+        >>> sender.close()
+    """
+    def __init__(self):
+        self._sockets = {}
+        self._addresses = {}
+        self.stats = SenderStats()
+
+    def _socket(self, family):
+        """Returns the socket of `family` (`AF_PACKET`, or `AF_INET` and
+        `AF_INET6` for the loopback interface), opening it if needed."""
+        sock = self._sockets.get(family)
+        if sock is None:
+            if family == socket.AF_PACKET:
+                # A datagram socket: the kernel builds the link-layer
+                # header. Protocol 0: the socket is only used for sending
+                sock = socket.socket(family, socket.SOCK_DGRAM, 0)
+            else:
+                # With IPPROTO_RAW, the kernel expects the IP header to be
+                # included in the data
+                sock = socket.socket(family, socket.SOCK_RAW,
+                                     socket.IPPROTO_RAW)
+            self._sockets[family] = sock
+        return sock
+
+    def _sendto_args(self, raw):
+        """Returns the socket and the socket address to give to `sendto` to
+        send `raw`. The address of each destination is only resolved
+        once."""
+        family, dst = _destination(raw)
+        entry = self._addresses.get(dst)
+        if entry is None:
+            if len(self._addresses) >= MAX_CACHED_DESTINATIONS:
+                self._addresses.clear()
+            iface, header = _resolve_link(family, dst)
+            if iface == scapy.config.conf.loopback_name:
+                entry = (family, (socket.inet_ntop(family, dst), 0))
+            else:
+                # (interface, EtherType, packet type, hardware type, address)
+                entry = (socket.AF_PACKET,
+                         (iface, struct.unpack('!H', header[12:14])[0], 0, 0,
+                          header[:6]))
+            self._addresses[dst] = entry
+        sock_family, addr = entry
+        return self._socket(sock_family), addr
+
+    def send_batch(self, raws):
+        """Sends a batch of raw packets, without any delay.
+
+        A packet the kernel refuses to send (e.g. too big for the interface)
+        is counted in the errors and the rest of the batch is still sent.
+
+        Args:
+            raws: The raw packets (bytes-like objects) to send.
+        """
+        stats = self.stats
+        stats.batches += 1
+        for raw in raws:
+            sock, addr = self._sendto_args(raw)
+            try:
+                stats.bytes += sock.sendto(raw, addr)
+            except OSError:
+                stats.errors += 1
+            else:
+                stats.packets += 1
+
+    def send_raws(self, raws):
+        """Sends a batch of Layer-3 packets (same as `.send_batch()`)."""
+        self.send_batch(raws)
+
+    def send(self, raw):
+        """Sends a single raw packet."""
+        self.send_batch((raw,))
+
+    def send_packetlist(self, packetlist):
+        """Sends all the packets of a `PacketList` as Layer-3 packets.
+
+        The delay of each packet is respected: the packets are sent in
+        batches of consecutive packets with no delay.
+
+        Args:
+            packetlist: The `PacketList` to send.
+        """
+        _send_by_batches(packetlist, lambda pkt: pkt.raw, self.send_batch)
+
+    def close(self):
+        """Closes the sockets. They are re-opened if the sender is used
+        again."""
+        for sock in self._sockets.values():
+            sock.close()
+        self._sockets.clear()
+        self._addresses.clear()
+
+    def __repr__(self):
+        return "RawSender(sockets={}, destinations={}, stats={!r})".format(
+            len(self._sockets), len(self._addresses), self.stats
+        )
+
+
+# pylint: disable=too-many-instance-attributes
+class TxRingSender(object):
+    """Sends Layer-2 frames through the `PACKET_TX_RING` of an interface.
+
+    The frames are copied in the slots of a ring shared with the kernel and
+    the whole ring is flushed with a single `send()`, so a batch of frames
+    costs one syscall whatever its size. The socket and the ring are only
+    set up when the first frame is sent, so a `TxRingSender` can be created
+    before a fork.
+
+    Layer-3 packets (see `.send_packetlist()`) are prefixed with an Ethernet
+    header resolved by Scapy (route and neighbour) once per destination.
+
+    Args:
+        iface: The name of the interface to send the frames on. Default is
+            'None' which means Scapy's default interface.
+        frame_size: The size of a slot of the ring (header included). A frame
+            bigger than `frame_size - 32` bytes can not be sent. Default is
+            `DEFAULT_FRAME_SIZE`.
+        frame_nr: The number of slots of the ring. Default is
+            `DEFAULT_FRAME_NR`.
+        qdisc_bypass: Set `PACKET_QDISC_BYPASS` on the socket so the frames
+            are given directly to the driver. Default is 'False'.
+
+    Attributes:
+        iface: The name of the interface the frames are sent on.
+        stats: The `SenderStats` of this sender.
+
+    Raises:
+        SenderError: `frame_size` or `frame_nr` are invalid.
+
+    Examples:
+        >>> sender = TxRingSender("eth0")
+        >>> pl = PacketList()
+        >>> pl.add_packet(Ether()/IP(dst="192.168.0.1")/TCP()/"PLOP")
+        >>> pl.add_packet(Ether()/IP(dst="192.168.0.1")/TCP()/"PLIP")
+        >>> sender.sendp_packetlist(pl)
+        >>> print(sender.stats)
+        2 packets (116 bytes) sent in 1 batches, 0 errors
+        >>> sender.close()
+    """
+    def __init__(self, iface=None, frame_size=DEFAULT_FRAME_SIZE,
+                 frame_nr=DEFAULT_FRAME_NR, qdisc_bypass=False):
+        if frame_size <= _TPACKET2_DATA_OFFSET or frame_size % 16:
+            raise SenderError("frame_size should be a multiple of 16 bigger "
+                              "than {}".format(_TPACKET2_DATA_OFFSET))
+        if frame_nr < 1:
+            raise SenderError("frame_nr should be at least 1")
+        if iface is None:
+            iface = scapy.config.conf.iface
+        self.iface = str(iface)
+        self.stats = SenderStats()
+        self._qdisc_bypass = qdisc_bypass
+
+        # The blocks of the ring are a whole number of pages and frames
+        block_size = mmap.PAGESIZE
+        while block_size % frame_size:
+            block_size += mmap.PAGESIZE
+        frames_per_block = block_size // frame_size
+        block_nr = -(-frame_nr // frames_per_block)
+        self._frame_size = frame_size
+        self._req = _TPACKET_REQ.pack(block_size, block_nr, frame_size,
+                                      block_nr * frames_per_block)
+        self._ring_size = block_size * block_nr
+        self._nb_frames = block_nr * frames_per_block
+
+        self._sock = None
+        self._ring = None
+        self._index = 0    # The next slot to fill
+        self._queued = 0   # The number of slots filled but not sent yet
+        self._headers = {}
+
+    def _open(self):
+        """Opens the socket and maps its TX ring."""
+        # Protocol 0: the socket is only used for sending
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        try:
+            sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V2)
+            sock.setsockopt(SOL_PACKET, PACKET_TX_RING, self._req)
+            if self._qdisc_bypass:
+                sock.setsockopt(SOL_PACKET, PACKET_QDISC_BYPASS, 1)
+            sock.bind((self.iface, 0))
+            self._ring = mmap.mmap(sock.fileno(), self._ring_size,
+                                   mmap.MAP_SHARED,
+                                   mmap.PROT_READ | mmap.PROT_WRITE)
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+        self._index = 0
+        self._queued = 0
+
+    def _l2_header(self, raw):
+        """Returns the Ethernet header to prepend to the Layer-3 packet
+        `raw`."""
+        family, dst = _destination(raw)
+        header = self._headers.get(dst)
+        if header is None:
+            if len(self._headers) >= MAX_CACHED_DESTINATIONS:
+                self._headers.clear()
+            header = _resolve_link(family, dst)[1]
+            self._headers[dst] = header
+        return header
+
+    def _flush(self):
+        """Hands all the filled slots to the kernel and waits until they are
+        sent."""
+        if not self._queued:
+            return
+        try:
+            # Blocking: returns once all the frames have been sent
+            self._sock.send(b'')
+        except OSError:
+            # The kernel stops at the first frame it refuses: free the slots
+            # so the ring can be reused
+            self.stats.errors += 1
+            for i in range(self._nb_frames):
+                _TPACKET2_HDR.pack_into(self._ring, i * self._frame_size,
+                                        TP_STATUS_AVAILABLE, 0, 0)
+        self._queued = 0
+
+    def send_batch(self, frames):
+        """Sends a batch of Layer-2 frames.
+
+        The frames are written in the ring and the ring is flushed when it
+        is full and at the end of the batch. A frame too big for a slot is
+        counted in the errors and the rest of the batch is still sent.
+
+        Args:
+            frames: The frames (bytes-like objects) to send.
+        """
+        if self._sock is None:
+            self._open()
+        stats = self.stats
+        stats.batches += 1
+        max_len = self._frame_size - _TPACKET2_DATA_OFFSET
+        for frame in frames:
+            length = len(frame)
+            if length > max_len:
+                stats.errors += 1
+                continue
+            if self._queued == self._nb_frames:
+                self._flush()
+            offset = self._index * self._frame_size
+            data = offset + _TPACKET2_DATA_OFFSET
+            self._ring[data:data + length] = frame
+            # The status is written last: the slot then belongs to the kernel
+            _TPACKET2_HDR.pack_into(self._ring, offset,
+                                    TP_STATUS_SEND_REQUEST, length, length)
+            self._index = (self._index + 1) % self._nb_frames
+            self._queued += 1
+            stats.packets += 1
+            stats.bytes += length
+        self._flush()
+
+    def send_raws(self, raws):
+        """Sends a batch of Layer-3 packets (an Ethernet header is added to
+        each packet)."""
+        self.send_batch([self._l2_header(raw) + raw for raw in raws])
+
+    def send(self, raw):
+        """Sends a single Layer-3 packet."""
+        self.send_raws((raw,))
+
+    def send_packetlist(self, packetlist):
+        """Sends all the packets of a `PacketList` as Layer-3 packets (an
+        Ethernet header is added to each packet).
+
+        The delay of each packet is respected: the packets are sent in
+        batches of consecutive packets with no delay.
+
+        Args:
+            packetlist: The `PacketList` to send.
+        """
+        def to_frame(pkt):
+            raw = pkt.raw
+            return self._l2_header(raw) + raw
+        _send_by_batches(packetlist, to_frame, self.send_batch)
+
+    def sendp_packetlist(self, packetlist):
+        """Sends all the packets of a `PacketList` as Layer-2 packets (the
+        packets already start with their Layer-2 header).
+
+        The delay of each packet is respected: the packets are sent in
+        batches of consecutive packets with no delay.
+
+        Args:
+            packetlist: The `PacketList` to send.
+        """
+        _send_by_batches(packetlist, lambda pkt: bytes(pkt.pkt),
+                         self.send_batch)
+
+    def close(self):
+        """Closes the socket and unmaps the ring. They are set up again if the
+        sender is used again."""
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self._headers.clear()
+
+    def __repr__(self):
+        return "TxRingSender(iface={}, frames={}, stats={!r})".format(
+            self.iface, self._nb_frames, self.stats
+        )
@@ -25,6 +25,7 @@ Schema of the hierarchy of test objects::
 """
 
 
+import asyncio
 import glob
 import os
 import string
@@ -245,6 +246,12 @@ class TestCase(object):
         test_id: The number of this test a.k.a. `j`.
         result: The `ProcessCompleted` returned by the subprocess or 'None' if
             not run yet.
+        drops: The number of packets dropped by the queues (kernel drops and
+            netlink overruns) while the test was running.
+        bypassed: The number of packets accepted unmodified by the engine
+            because it was overloaded while the test was running.
+        incidents: The incidents of the engine (e.g. a thread restarted by
+            the watchdog) while the test was running.
     """
 
     def __init__(self, **kwargs):
@@ -255,6 +262,9 @@ class TestCase(object):
         self.remote_pcap = kwargs.pop("remote_pcap", None)
         self.test_id = kwargs.pop("test_id")
         self.result = None
+        self.drops = 0
+        self.bypassed = 0
+        self.incidents = list()
 
     def run(self):
         """Executes the user command in a sub-process. Redirect stdout and
@@ -262,6 +272,27 @@ class TestCase(object):
         self.result = subprocess.run(self.cmd, stdout=self.stdout,
                                      stderr=self.stderr, shell=True)
 
+    async def run_async(self):
+        """Executes the user command in a sub-process, like `.run()`, but
+        without blocking the asyncio event loop running this coroutine. If
+        it is cancelled, the sub-process is killed and the test is left not
+        done."""
+        process = await asyncio.create_subprocess_shell(
+            self.cmd, stdout=self.stdout, stderr=self.stderr
+        )
+        try:
+            stdout, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass  # Already finished
+            await process.wait()
+            raise
+        self.result = subprocess.CompletedProcess(
+            self.cmd, process.returncode, stdout, stderr
+        )
+
     def is_done(self):
         """Returns 'True' if the command has been run at least once."""
         return self.result is not None
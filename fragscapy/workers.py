@@ -0,0 +1,921 @@
+"""Workers applying the modifications outside of the engine threads.
+
+By default, the modifications are applied by the `EngineThread` itself, i.e.
+by Python threads that share a single GIL. With a `WorkerPool`, the engine
+threads only read the packets from NFQUEUE (and send back the verdicts) while
+a pool of worker processes apply the `ModList` to them. A `ThreadWorkerPool`
+does the same with threads: on a free-threaded (no-GIL) build of CPython,
+they apply the modlists in parallel without the cost of the exchanges
+between processes (see `gil_enabled()`).
+
+The packets are exchanged through a `PacketRing` per worker: a ring buffer
+of fixed-size slots in a shared memory mapping. The engine writes the raw
+payload of a packet in a slot, the worker parses it, applies the modlist,
+sends the resulting packets (OUTPUT chain) and writes back the verdict and
+the new payload (INPUT chain) in the same slot. The slots are used in order
+so the packets of a worker are verdicted in the order they were received.
+All the packets of a flow (both directions) are always given to the same
+worker so they are not reordered.
+
+The modlists are sent to the workers as numbered snapshots. Each packet is
+stamped with the number of the snapshot current when it was submitted and
+the workers always process it with this exact snapshot, so a change of
+modlists reaches all the workers at once: no packet submitted after the
+change is processed with the old modlists.
+
+Schema of the exchanges for one worker::
+
+    EngineThread --(payload)--> PacketRing --(payload)--> PacketWorker
+         ^                                                     |
+    collector <--(verdict/new payload)-- PacketRing <----------+
+
+The worker threads share the modlists instead of receiving copies: the mods
+are applied concurrently to the `PacketList` of different packets, which is
+safe as long as they only modify the packet list they are given (see
+`Mod.is_reentrant()`). The modlists containing a mod that is not reentrant
+are applied by one thread at a time. Each worker thread has its own sender
+and `DelayScheduler` and sends the verdicts of its packets itself. Like the
+processes, a thread processes the packets of its flows in order.
+"""
+
+import collections
+import mmap
+import multiprocessing
+import queue
+import signal
+import struct
+import sys
+import threading
+import traceback
+
+import scapy.layers.inet
+import scapy.layers.inet6
+
+from fragscapy.affinity import pin
+from fragscapy.gso import DEFAULT_MTU, segment
+from fragscapy.netfilter import SKB_CSUMNOTREADY, SKB_GSO
+from fragscapy.packetlist import MIN_TIME_DELAY, PacketList
+from fragscapy.pcapsink import PcapSink
+from fragscapy.scheduler import DelayScheduler
+from fragscapy.sender import RawSender
+
+
+# The multiprocessing context: the rings are anonymous shared mappings so
+# they must be inherited by the workers with a fork
+_CTX = multiprocessing.get_context('fork')
+
+# The default number of slots in each ring
+DEFAULT_NB_SLOTS = 64
+# The default size of a slot (header included)
+DEFAULT_SLOT_SIZE = 128 * 1024
+# The time (in seconds) to wait before checking again if the pool is stopped
+WAIT_TIMEOUT = 0.1
+
+# The counters of the ring: head (next slot to fill), done (next slot to
+# process) and tail (next slot to free). Padded to a cache line.
+_RING_HEADER = struct.Struct('<QQQ')
+_RING_HEADER_SIZE = 64
+# The header of a slot: generation, arrival time, flags, verdict, nb of
+# records, length
+_SLOT_HEADER = struct.Struct('<QdBBHI')
+# The header of each packet written back by a worker: delay, length
+_RECORD_HEADER = struct.Struct('<dI')
+# The minimal size of a slot so any IP packet fits in a request, and in the
+# first record of a result (the payload of a MANGLE verdict)
+MIN_SLOT_SIZE = _SLOT_HEADER.size + _RECORD_HEADER.size + 0xFFFF
+
+# The flags of a slot
+FLAG_INPUT = 1 << 0      # The packet comes from the INPUT chain
+FLAG_RECORDS = 1 << 1    # The resulting packets must be written back
+FLAG_TRUNCATED = 1 << 2  # Not all the resulting packets could be written
+FLAG_SEGMENT = 1 << 3    # The packet is a GSO packet to segment first
+
+# The verdicts written back by a worker
+VERDICT_DROP = 0
+VERDICT_ACCEPT = 1
+VERDICT_MANGLE = 2
+
+# The IP protocols with ports to include in the flow key
+_PORT_PROTOS = (6, 17, 132)  # TCP, UDP, SCTP
+
+
+class WorkerError(ValueError):
+    """An Error during the execution of the workers."""
+
+
+def gil_enabled():
+    """Is the GIL enabled (i.e. the threads can't run Python code in
+    parallel) ? It is always the case before CPython 3.13 and on the default
+    builds."""
+    # pylint: disable=protected-access
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    return is_gil_enabled is None or is_gil_enabled()
+
+
+def l3_layer(payload):
+    """Returns the scapy L3 layer (`IP` or `IPv6`) of a raw packet."""
+    if payload and payload[0] >> 4 == 6:
+        return scapy.layers.inet6.IPv6
+    return scapy.layers.inet.IP
+
+
+def flow_key(payload):
+    """Returns a key identifying the flow of a raw IP packet.
+
+    The key is the same for both directions of the flow: it is built from
+    the addresses and the ports (if any) of the 2 ends, sorted.
+    """
+    if len(payload) >= 40 and payload[0] >> 4 == 6:
+        src, dst = payload[8:24], payload[24:40]
+        proto, l4_offset = payload[6], 40
+        # Only the packets without extension headers have reachable ports
+    elif len(payload) >= 20:
+        src, dst = payload[12:16], payload[16:20]
+        proto, l4_offset = payload[9], (payload[0] & 0x0F) * 4
+        if int.from_bytes(payload[6:8], 'big') & 0x1FFF:
+            proto = None  # Non-first fragments have no L4 header
+    else:
+        return bytes(payload)
+    if proto in _PORT_PROTOS and len(payload) >= l4_offset + 4:
+        src += payload[l4_offset:l4_offset+2]
+        dst += payload[l4_offset+2:l4_offset+4]
+    return bytes(min(src, dst) + max(src, dst))
+
+
+# pylint: disable=too-many-arguments
+def _apply_modlists(modlists, arrival, flags, payload, mtu, scheduler,
+                    sender):
+    """Applies the modlists `(input_modlist, output_modlist)` to a raw packet.
+    The resulting packets of the OUTPUT chain are sent with `sender` (or
+    scheduled with `scheduler` if delayed).
+
+    Returns:
+        A 2-tuple `(verdict, records)` where records is the list of the
+        `(delay, payload)` of the resulting packets.
+    """
+    input_modlist, output_modlist = modlists
+    packetlist = PacketList()
+    # Only dissected if a mod needs it
+    if flags & FLAG_SEGMENT:
+        for raw in segment(bytes(payload), mtu):
+            packetlist.add_raw_packet(raw, l3_layer(payload))
+    else:
+        packetlist.add_raw_packet(payload, l3_layer(payload))
+
+    if flags & FLAG_INPUT:
+        packetlist = input_modlist.apply(packetlist)
+        if not packetlist:
+            return VERDICT_DROP, []
+        if not packetlist[0].is_dissected():
+            return VERDICT_ACCEPT, [(0, payload)]
+        # Only the first packet can be reinserted in the NFQUEUE
+        raw = packetlist[0].raw
+        if raw == payload:
+            # Dissected but not modified
+            return VERDICT_ACCEPT, [(0, payload)]
+        return VERDICT_MANGLE, [(0, raw)]
+
+    packetlist = output_modlist.apply(packetlist)
+    if (len(packetlist) == 1 and not packetlist[0].is_dissected()
+            and packetlist[0].delay <= MIN_TIME_DELAY):
+        # Still the original packet, let it through as is
+        return VERDICT_ACCEPT, [(0, payload)]
+    scheduler.dispatch(packetlist, arrival, sender)
+    if flags & FLAG_RECORDS:
+        return VERDICT_DROP, [(pkt.delay, pkt.raw) for pkt in packetlist]
+    return VERDICT_DROP, []
+
+
+def _request_flags(packet, local_pcap, remote_pcap, pcap_sink):
+    """Returns the flags of the request of a packet submitted to a pool, and
+    the pcap file of the resulting packets. The packet is dumped in its pcap
+    file first."""
+    payload = packet.fnfqueue_pkt.payload
+    if packet.is_input:
+        flags = FLAG_INPUT
+        pcap_before, pcap_after = remote_pcap, local_pcap
+    else:
+        flags = 0
+        pcap_before, pcap_after = local_pcap, remote_pcap
+        if packet.skb_info & (SKB_GSO | SKB_CSUMNOTREADY):
+            flags |= FLAG_SEGMENT
+    if pcap_before is not None:
+        pcap_sink.dump(pcap_before, [bytes(payload)])
+    if pcap_after is not None:
+        flags |= FLAG_RECORDS
+    return flags, pcap_after
+
+
+def _send_verdict(packet, verdict, records):
+    """Sends the verdict of a packet processed by a worker.
+
+    A MANGLE verdict without the new payload (a truncated result) accepts
+    the packet unmodified. If the verdict can't be sent, the error is
+    printed and the packet is accepted unmodified (if it still can be), so
+    the caller goes on with the next packets.
+    """
+    fnfqueue_pkt = packet.fnfqueue_pkt
+    try:
+        if verdict == VERDICT_MANGLE and records:
+            fnfqueue_pkt.payload = bytes(records[0][1])
+            fnfqueue_pkt.mangle()
+        elif verdict in (VERDICT_MANGLE, VERDICT_ACCEPT):
+            fnfqueue_pkt.accept()
+        else:
+            fnfqueue_pkt.drop()
+    except Exception:  # pylint: disable=broad-except
+        traceback.print_exc()
+        _accept_unmodified(packet)
+
+
+def _accept_unmodified(packet):
+    """Accepts a packet unmodified, ignoring the errors (e.g. it already
+    has a verdict)."""
+    try:
+        packet.fnfqueue_pkt.accept()
+    except Exception:  # pylint: disable=broad-except
+        pass
+
+
+class PacketRing(object):
+    """A ring buffer of packets in a shared memory mapping.
+
+    There is exactly one producer (the engine, through `WorkerPool`) and one
+    consumer (a `PacketWorker`). The ring is made of `nb_slots` slots of
+    `slot_size` bytes each and of 3 counters: `head` is the next slot the
+    engine fills, `done` the next slot the worker processes and `tail` the
+    next slot whose result the engine reads (and then frees).
+
+    Each counter is only written by one side. The `filled` semaphore counts
+    the slots waiting to be processed and is used to wake up the worker.
+
+    Args:
+        nb_slots: The number of slots. Default is `DEFAULT_NB_SLOTS`.
+        slot_size: The size of a slot in bytes. It must be at least
+            `MIN_SLOT_SIZE`. Default is `DEFAULT_SLOT_SIZE`.
+
+    Attributes:
+        nb_slots: The number of slots.
+        slot_size: The size of a slot in bytes.
+        filled: The semaphore counting the slots waiting to be processed.
+
+    Raises:
+        ValueError: The size of a slot is too small.
+    """
+    def __init__(self, nb_slots=DEFAULT_NB_SLOTS, slot_size=DEFAULT_SLOT_SIZE):
+        if nb_slots < 1:
+            raise ValueError("nb_slots should be at least 1")
+        if slot_size < MIN_SLOT_SIZE:
+            raise ValueError(
+                "slot_size should be at least {}".format(MIN_SLOT_SIZE)
+            )
+        self.nb_slots = nb_slots
+        self.slot_size = slot_size
+        self.filled = _CTX.Semaphore(0)
+        # An anonymous mapping is shared with the processes forked later
+        self._mem = mmap.mmap(-1, _RING_HEADER_SIZE + nb_slots * slot_size)
+
+    def _get_counter(self, i):
+        return _RING_HEADER.unpack_from(self._mem, 0)[i]
+
+    def _set_counter(self, i, value):
+        struct.pack_into('<Q', self._mem, 8 * i, value)
+
+    head = property(lambda self: self._get_counter(0),
+                    lambda self, v: self._set_counter(0, v),
+                    doc="The counter of the next slot to fill.")
+    done = property(lambda self: self._get_counter(1),
+                    lambda self, v: self._set_counter(1, v),
+                    doc="The counter of the next slot to process.")
+    tail = property(lambda self: self._get_counter(2),
+                    lambda self, v: self._set_counter(2, v),
+                    doc="The counter of the next slot to free.")
+
+    def is_full(self):
+        """Are all the slots in use ?"""
+        return self.head - self.tail >= self.nb_slots
+
+    def _offset(self, counter):
+        """The offset of the slot used by `counter` in the mapping."""
+        return _RING_HEADER_SIZE + (counter % self.nb_slots) * self.slot_size
+
+    def put_request(self, generation, arrival, flags, payload):
+        """Writes a packet in the next free slot and makes it available to
+        the worker. The ring must not be full.
+
+        Args:
+            generation: The number of the modlists snapshot to use.
+            arrival: The time (`time.monotonic()`) the packet arrived.
+            flags: The flags of the request (`FLAG_INPUT`, `FLAG_RECORDS`,
+                `FLAG_SEGMENT`).
+            payload: The raw IP packet.
+        """
+        head = self.head
+        offset = self._offset(head)
+        _SLOT_HEADER.pack_into(self._mem, offset, generation, arrival, flags,
+                               0, 0, len(payload))
+        start = offset + _SLOT_HEADER.size
+        self._mem[start:start+len(payload)] = payload
+        self.head = head + 1
+        self.filled.release()
+
+    def get_request(self, counter):
+        """Reads the packet in the slot of `counter`.
+
+        Returns:
+            A 4-tuple `(generation, arrival, flags, payload)`.
+        """
+        offset = self._offset(counter)
+        generation, arrival, flags, _, _, length = _SLOT_HEADER.unpack_from(
+            self._mem, offset
+        )
+        start = offset + _SLOT_HEADER.size
+        return generation, arrival, flags, self._mem[start:start+length]
+
+    def put_result(self, counter, verdict, records):
+        """Writes the result of the processing in the slot of `counter`.
+
+        The records that do not fit in the slot are not written and the
+        `FLAG_TRUNCATED` flag is set instead.
+
+        Args:
+            counter: The counter of the slot.
+            verdict: `VERDICT_DROP`, `VERDICT_ACCEPT` or `VERDICT_MANGLE`.
+            records: A list of `(delay, payload)` of the resulting packets.
+        """
+        offset = self._offset(counter)
+        generation, arrival, flags, _, _, length = _SLOT_HEADER.unpack_from(
+            self._mem, offset
+        )
+        pos = offset + _SLOT_HEADER.size
+        end = offset + self.slot_size
+        nb_records = 0
+        for delay, payload in records:
+            size = _RECORD_HEADER.size + len(payload)
+            if pos + size > end or nb_records == 0xFFFF:
+                flags |= FLAG_TRUNCATED
+                break
+            _RECORD_HEADER.pack_into(self._mem, pos, delay, len(payload))
+            pos += _RECORD_HEADER.size
+            self._mem[pos:pos+len(payload)] = payload
+            pos += len(payload)
+            nb_records += 1
+        _SLOT_HEADER.pack_into(self._mem, offset, generation, arrival, flags,
+                               verdict, nb_records, length)
+
+    def get_result(self, counter):
+        """Reads the result written in the slot of `counter`.
+
+        Returns:
+            A 3-tuple `(verdict, flags, records)` where records is a list of
+            `(delay, payload)`.
+        """
+        offset = self._offset(counter)
+        _, _, flags, verdict, nb_records, _ = _SLOT_HEADER.unpack_from(
+            self._mem, offset
+        )
+        pos = offset + _SLOT_HEADER.size
+        records = list()
+        for _ in range(nb_records):
+            delay, length = _RECORD_HEADER.unpack_from(self._mem, pos)
+            pos += _RECORD_HEADER.size
+            records.append((delay, self._mem[pos:pos+length]))
+            pos += length
+        return verdict, flags, records
+
+    def close(self):
+        """Releases the shared memory mapping."""
+        self._mem.close()
+
+
+class PacketWorker(_CTX.Process):
+    """A process applying the modlists to the packets of a `PacketRing`.
+
+    The worker processes the slots of its ring in order. The packets of the
+    OUTPUT chain are modified and sent by the worker itself and the original
+    packet is dropped. The packets of the INPUT chain are modified and the
+    new payload is written back to be mangled by the engine.
+
+    The modlists snapshots are received on `conn` as 3-tuples
+    `(generation, input_modlist, output_modlist)`.
+
+    Args:
+        ring: The `PacketRing` to process.
+        conn: The read end of the `Pipe` on which the snapshots are sent.
+        completed: The semaphore to release each time a slot is processed.
+        stop_event: The event set when the worker should stop.
+        sender_factory: The callable building the sender of the worker (see
+            `fragscapy.sender`). Default is `RawSender`.
+        mtu: The size the GSO packets are segmented to. Default is
+            `DEFAULT_MTU`.
+        cpus: The CPUs the worker is pinned to. Default is 'None' (not
+            pinned).
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, ring, conn, completed, stop_event,
+                 sender_factory=RawSender, mtu=DEFAULT_MTU, cpus=None):
+        super(PacketWorker, self).__init__(daemon=True)
+        self._mtu = mtu
+        self._cpus = cpus
+        self._sender_factory = sender_factory
+        self._sender = None
+        self._scheduler = None
+        self._ring = ring
+        self._conn = conn
+        self._completed = completed
+        self._stop_event = stop_event
+        self._snapshots = dict()
+
+    def _receive_snapshot(self):
+        """Receives the next modlists snapshot."""
+        generation, input_modlist, output_modlist = self._conn.recv()
+        self._snapshots[generation] = (input_modlist, output_modlist)
+
+    def _get_modlists(self, generation):
+        """Returns the modlists of the snapshot `generation`, waiting for it
+        if it has not been received yet."""
+        while generation not in self._snapshots:
+            self._receive_snapshot()
+        # The slots come in order, older snapshots won't be used anymore
+        for old in [g for g in self._snapshots if g < generation]:
+            del self._snapshots[old]
+        return self._snapshots[generation]
+
+    def _receive_idle(self):
+        """Receives the pending snapshots while there is nothing to process.
+
+        When the ring is empty after receiving the last snapshot, the next
+        packets can only be stamped with this snapshot (or a later one) so
+        the older ones can be forgotten. It prevents the snapshots from
+        piling up when the modlists change often without any traffic.
+        """
+        while self._conn.poll():
+            self._receive_snapshot()
+        if self._snapshots and self._ring.head == self._ring.done:
+            last = max(self._snapshots)
+            self._snapshots = {last: self._snapshots[last]}
+
+    def _process(self, modlists, arrival, flags, payload):
+        """Applies the modlists to a raw packet. The resulting packets of the
+        OUTPUT chain are sent (or scheduled if delayed) by the worker.
+
+        Returns:
+            A 2-tuple `(verdict, records)` to write back in the slot.
+        """
+        return _apply_modlists(modlists, arrival, flags, payload, self._mtu,
+                               self._scheduler, self._sender)
+
+    def run(self):
+        """Processes the slots of the ring until the worker is stopped."""
+        # The interruptions are handled by the engine (main process)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        pin(self._cpus)
+        # The sockets (and the scheduler thread) are created in the worker
+        # process itself
+        self._sender = self._sender_factory()
+        self._scheduler = DelayScheduler(self._sender_factory())
+        self._scheduler.start()
+        while not self._stop_event.is_set():
+            if not self._ring.filled.acquire(timeout=WAIT_TIMEOUT):
+                self._receive_idle()
+                continue
+            counter = self._ring.done
+            generation, arrival, flags, payload = self._ring.get_request(
+                counter
+            )
+            try:
+                verdict, records = self._process(
+                    self._get_modlists(generation), arrival, flags, payload
+                )
+            except Exception:  # pylint: disable=broad-except
+                # Let the packet through rather than blocking the ring
+                traceback.print_exc()
+                verdict, records = VERDICT_ACCEPT, []
+            self._ring.put_result(counter, verdict, records)
+            self._ring.done = counter + 1
+            self._completed.release()
+        self._scheduler.stop()
+        self._scheduler.join()
+        self._sender.close()
+
+
+# pylint: disable=too-many-instance-attributes
+class WorkerPool(object):
+    """A pool of `PacketWorker` processes applying the modlists.
+
+    The engine threads submit the packets read from NFQUEUE with `.submit()`
+    and a collector thread sends the verdicts once the workers are done with
+    them. The modlists are changed for all the workers at once with
+    `.set_modlists()`.
+
+    Args:
+        nb_workers: The number of worker processes.
+        nb_slots: The number of slots of the ring of each worker. Default is
+            `DEFAULT_NB_SLOTS`.
+        slot_size: The size of each slot in bytes. Default is
+            `DEFAULT_SLOT_SIZE`.
+        sender_factory: The callable building the sender of each worker (see
+            `fragscapy.sender`). Default is `RawSender`.
+        pcap_sink: The `PcapSink` writing the pcap files. It should be
+            started (and stopped) by the caller. Default is a new `PcapSink`
+            started and stopped with the pool.
+        mtu: The size the GSO packets of the OUTPUT chain are segmented to
+            (see `fragscapy.gso`). Default is `DEFAULT_MTU`.
+        cpus: The CPUs each worker is pinned to (one set per worker).
+            Default is 'None' (not pinned).
+
+    Attributes:
+        local_pcap: A pcap file where the packets of the local side should be
+            dumped to. 'None' means the packets are not dumped.
+        remote_pcap: A pcap file where the packets of the remote side should
+            be dumped to. 'None' means the packets are not dumped.
+        processed: The number of packets processed by each worker.
+
+    Examples:
+        >>> pool = WorkerPool(4)
+        >>> pool.start()
+        >>> pool.set_modlists(input_modlist, output_modlist)
+        >>> pool.submit(packet)   # A packet from a `NFQueue`
+        >>> pool.stop()
+        >>> pool.join()
+    """
+    def __init__(self, nb_workers, nb_slots=DEFAULT_NB_SLOTS,
+                 slot_size=DEFAULT_SLOT_SIZE, sender_factory=RawSender,
+                 pcap_sink=None, mtu=DEFAULT_MTU, cpus=None):
+        if nb_workers < 1:
+            raise ValueError("nb_workers should be at least 1")
+        if cpus is None:
+            cpus = [None] * nb_workers
+        self.local_pcap = None
+        self.remote_pcap = None
+        self.processed = [0] * nb_workers
+        # Without a sink given, the pool starts and stops its own
+        self._own_pcap_sink = pcap_sink is None
+        self._pcap_sink = PcapSink() if self._own_pcap_sink else pcap_sink
+
+        self._generation = 0  # 0 means no modlists set yet
+        self._cond = threading.Condition()
+        self._completed = _CTX.Semaphore(0)
+        self._stop_event = _CTX.Event()
+        self._rings = list()
+        self._pending = list()
+        self._pipes = list()
+        self._workers = list()
+        for worker_cpus in cpus:
+            ring = PacketRing(nb_slots, slot_size)
+            recv_conn, send_conn = _CTX.Pipe(duplex=False)
+            self._rings.append(ring)
+            self._pending.append(collections.deque())
+            self._pipes.append(send_conn)
+            self._workers.append(PacketWorker(
+                ring, recv_conn, self._completed, self._stop_event,
+                sender_factory, mtu, worker_cpus
+            ))
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+
+    def __len__(self):
+        return len(self._workers)
+
+    def set_modlists(self, input_modlist, output_modlist):
+        """Replaces the modlists used by all the workers.
+
+        Every packet submitted after this call is processed with the new
+        modlists, every packet submitted before with the old ones.
+        """
+        with self._cond:
+            generation = self._generation + 1
+            for pipe in self._pipes:
+                pipe.send((generation, input_modlist, output_modlist))
+            self._generation = generation
+
+    def submit(self, packet):
+        """Gives a packet to the worker of its flow. Blocks if the ring of
+        this worker is full (the packet is accepted unmodified if the pool
+        is stopped meanwhile).
+
+        Args:
+            packet: The `PacketWrapper` read from the `NFQueue`. Its verdict
+                is sent once the worker is done with it.
+
+        Raises:
+            WorkerError: No modlists have been set.
+        """
+        payload = packet.fnfqueue_pkt.payload
+        index = hash(flow_key(payload)) % len(self._rings)
+        ring = self._rings[index]
+
+        # Dump the packet before anything else
+        flags, _ = _request_flags(packet, self.local_pcap, self.remote_pcap,
+                                  self._pcap_sink)
+
+        with self._cond:
+            if not self._generation:
+                raise WorkerError("Can't run the workers with no modlists")
+            while ring.is_full():
+                if self._stop_event.is_set():
+                    # The workers won't free the ring anymore
+                    packet.accept()
+                    return
+                self._cond.wait(WAIT_TIMEOUT)
+            # Pending before the slot is published: the collector may pop
+            # it as soon as the worker is done
+            self._pending[index].append(packet)
+            ring.put_request(self._generation, packet.arrival, flags, payload)
+
+    def _collect(self):
+        """Sends the verdicts of the packets processed by the workers. Runs
+        in the collector thread until the pool is stopped."""
+        while not self._stop_event.is_set():
+            if not self._completed.acquire(timeout=WAIT_TIMEOUT):
+                continue
+            for index, ring in enumerate(self._rings):
+                self._collect_ring(index, ring)
+
+    def _collect_ring(self, index, ring):
+        """Sends the verdicts of all the packets processed in `ring`."""
+        tail, done = ring.tail, ring.done
+        while tail < done:
+            verdict, flags, records = ring.get_result(tail)
+            packet = self._pending[index].popleft()
+            pcap_after = (self.local_pcap if flags & FLAG_INPUT
+                          else self.remote_pcap)
+            _send_verdict(packet, verdict, records)
+            if pcap_after is not None:
+                try:
+                    # Copied out of the slot before it is freed
+                    self._pcap_sink.dump(
+                        pcap_after, [bytes(payload) for _, payload in records]
+                    )
+                except Exception:  # pylint: disable=broad-except
+                    traceback.print_exc()
+            self.processed[index] += 1
+            tail += 1
+            with self._cond:
+                ring.tail = tail
+                self._cond.notify_all()
+
+    def start(self):
+        """Starts the workers and the collector thread."""
+        for worker in self._workers:
+            worker.start()
+        if self._own_pcap_sink:
+            self._pcap_sink.start()
+        self._collector.start()
+
+    def stop(self):
+        """Sends the signal to stop the workers and the collector thread.
+        The packets they did not process are accepted unmodified by
+        `.join()`."""
+        self._stop_event.set()
+
+    def join(self):
+        """Waits for the workers and the collector thread to stop, then
+        sends the verdicts of the packets processed meanwhile and accepts
+        unmodified the ones left in the rings. The packets must not be
+        submitted anymore."""
+        for worker in self._workers:
+            if worker.pid is not None:
+                worker.join()
+        if self._collector.ident is not None:
+            self._collector.join()
+        for index, ring in enumerate(self._rings):
+            self._collect_ring(index, ring)
+            while self._pending[index]:
+                _accept_unmodified(self._pending[index].popleft())
+        if self._own_pcap_sink and self._pcap_sink.ident is not None:
+            self._pcap_sink.stop()
+            self._pcap_sink.join()
+        for ring in self._rings:
+            ring.close()
+
+
+class ThreadWorker(threading.Thread):
+    """A thread applying the modlists to the packets of its queue.
+
+    The packets are processed in order, with the modlists snapshot they were
+    submitted with. The resulting packets of the OUTPUT chain are sent (or
+    scheduled) by the worker and the verdict of each packet is sent as soon
+    as it is processed.
+
+    Args:
+        requests: The `queue.Queue` of the packets to process.
+        stop_event: The event set when the worker should stop.
+        lock: The lock held while applying the modlists that are not
+            reentrant (shared by all the workers of the pool).
+        pcap_sink: The `PcapSink` writing the resulting packets.
+        sender_factory: The callable building the sender of the worker (see
+            `fragscapy.sender`). Default is `RawSender`.
+        mtu: The size the GSO packets are segmented to. Default is
+            `DEFAULT_MTU`.
+        cpus: The CPUs the worker (and its scheduler) is pinned to. Default
+            is 'None' (not pinned).
+
+    Attributes:
+        processed: The number of packets processed by the worker.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, requests, stop_event, lock, pcap_sink,
+                 sender_factory=RawSender, mtu=DEFAULT_MTU, cpus=None):
+        super(ThreadWorker, self).__init__(daemon=True)
+        self.processed = 0
+        self._cpus = cpus
+        self._requests = requests
+        self._stop_event = stop_event
+        self._lock = lock
+        self._pcap_sink = pcap_sink
+        self._mtu = mtu
+        # Created (and closed) by the thread itself
+        self._sender_factory = sender_factory
+        self._sender = None
+        self._scheduler = None
+
+    def _process(self, snapshot, flags, pcap_after, packet):
+        """Applies the modlists of `snapshot` to a packet and sends its
+        verdict."""
+        _, input_modlist, output_modlist, reentrant = snapshot
+        payload = packet.fnfqueue_pkt.payload
+        try:
+            if reentrant:
+                verdict, records = _apply_modlists(
+                    (input_modlist, output_modlist), packet.arrival, flags,
+                    payload, self._mtu, self._scheduler, self._sender
+                )
+            else:
+                with self._lock:
+                    verdict, records = _apply_modlists(
+                        (input_modlist, output_modlist), packet.arrival,
+                        flags, payload, self._mtu, self._scheduler,
+                        self._sender
+                    )
+        except Exception:  # pylint: disable=broad-except
+            # Let the packet through rather than losing it
+            traceback.print_exc()
+            verdict, records = VERDICT_ACCEPT, []
+        _send_verdict(packet, verdict, records)
+        if pcap_after is not None:
+            try:
+                self._pcap_sink.dump(
+                    pcap_after, [bytes(raw) for _, raw in records]
+                )
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc()
+        self.processed += 1
+
+    def run(self):
+        """Processes the packets of the queue until the worker is stopped.
+        The packets left are then accepted unmodified."""
+        pin(self._cpus)
+        self._sender = self._sender_factory()
+        self._scheduler = DelayScheduler(self._sender_factory())
+        self._scheduler.start()
+        while not self._stop_event.is_set():
+            try:
+                request = self._requests.get(timeout=WAIT_TIMEOUT)
+            except queue.Empty:
+                continue
+            self._process(*request)
+        while True:
+            try:
+                request = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            request[-1].fnfqueue_pkt.accept()
+        self._scheduler.stop()
+        self._scheduler.join()
+        self._sender.close()
+
+
+class ThreadWorkerPool(object):
+    """A pool of `ThreadWorker` threads applying the modlists.
+
+    It is used exactly like a `WorkerPool`. The packets are queued to the
+    worker of their flow, with the modlists snapshot current when they are
+    submitted, so a change of modlists reaches all the workers at once. With
+    the GIL enabled (see `gil_enabled()`), only one thread runs the mods at
+    a time: the worker processes of `WorkerPool` should be used instead.
+
+    Args:
+        nb_workers: The number of worker threads.
+        queue_size: The maximum number of packets waiting in the queue of
+            each worker. Default is `DEFAULT_NB_SLOTS`.
+        sender_factory: The callable building the sender of each worker (see
+            `fragscapy.sender`). Default is `RawSender`.
+        pcap_sink: The `PcapSink` writing the pcap files. It should be
+            started (and stopped) by the caller. Default is a new `PcapSink`
+            started and stopped with the pool.
+        mtu: The size the GSO packets of the OUTPUT chain are segmented to
+            (see `fragscapy.gso`). Default is `DEFAULT_MTU`.
+        cpus: The CPUs each worker is pinned to (one set per worker).
+            Default is 'None' (not pinned).
+
+    Attributes:
+        local_pcap: A pcap file where the packets of the local side should be
+            dumped to. 'None' means the packets are not dumped.
+        remote_pcap: A pcap file where the packets of the remote side should
+            be dumped to. 'None' means the packets are not dumped.
+
+    Examples:
+        >>> pool = ThreadWorkerPool(4)
+        >>> pool.start()
+        >>> pool.set_modlists(input_modlist, output_modlist)
+        >>> pool.submit(packet)   # A packet from a `NFQueue`
+        >>> pool.stop()
+        >>> pool.join()
+    """
+    def __init__(self, nb_workers, queue_size=DEFAULT_NB_SLOTS,
+                 sender_factory=RawSender, pcap_sink=None, mtu=DEFAULT_MTU,
+                 cpus=None):
+        if nb_workers < 1:
+            raise ValueError("nb_workers should be at least 1")
+        if cpus is None:
+            cpus = [None] * nb_workers
+        self.local_pcap = None
+        self.remote_pcap = None
+        # Without a sink given, the pool starts and stops its own
+        self._own_pcap_sink = pcap_sink is None
+        self._pcap_sink = PcapSink() if self._own_pcap_sink else pcap_sink
+
+        # The current snapshot: (generation, input_modlist, output_modlist,
+        # reentrant), replaced at once
+        self._snapshot = None
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._queues = [queue.Queue(queue_size) for _ in range(nb_workers)]
+        self._workers = [
+            ThreadWorker(requests, self._stop_event, self._lock,
+                         self._pcap_sink, sender_factory, mtu, worker_cpus)
+            for requests, worker_cpus in zip(self._queues, cpus)
+        ]
+
+    def __len__(self):
+        return len(self._workers)
+
+    @property
+    def processed(self):
+        """The number of packets processed by each worker."""
+        return [worker.processed for worker in self._workers]
+
+    def set_modlists(self, input_modlist, output_modlist):
+        """Replaces the modlists used by all the workers.
+
+        Every packet submitted after this call is processed with the new
+        modlists, every packet submitted before with the old ones.
+        """
+        generation = self._snapshot[0] + 1 if self._snapshot else 1
+        self._snapshot = (
+            generation, input_modlist, output_modlist,
+            input_modlist.is_reentrant() and output_modlist.is_reentrant()
+        )
+
+    def submit(self, packet):
+        """Gives a packet to the worker of its flow. Blocks if the queue of
+        this worker is full (the packet is accepted unmodified if the pool
+        is stopped meanwhile).
+
+        Args:
+            packet: The `PacketWrapper` read from the `NFQueue`. Its verdict
+                is sent once the worker is done with it.
+
+        Raises:
+            WorkerError: No modlists have been set.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            raise WorkerError("Can't run the workers with no modlists")
+        payload = packet.fnfqueue_pkt.payload
+        requests = self._queues[hash(flow_key(payload)) % len(self._queues)]
+        # Dump the packet before anything else
+        flags, pcap_after = _request_flags(
+            packet, self.local_pcap, self.remote_pcap, self._pcap_sink
+        )
+        request = (snapshot, flags, pcap_after, packet)
+        while True:
+            if self._stop_event.is_set():
+                # The workers won't process it anymore
+                packet.accept()
+                return
+            try:
+                requests.put(request, timeout=WAIT_TIMEOUT)
+                return
+            except queue.Full:
+                continue
+
+    def start(self):
+        """Starts the workers."""
+        for worker in self._workers:
+            worker.start()
+        if self._own_pcap_sink:
+            self._pcap_sink.start()
+
+    def stop(self):
+        """Sends the signal to stop the workers."""
+        self._stop_event.set()
+
+    def join(self):
+        """Waits for the workers to stop."""
+        for worker in self._workers:
+            if worker.ident is not None:
+                worker.join()
+        if self._own_pcap_sink and self._pcap_sink.ident is not None:
+            self._pcap_sink.stop()
+            self._pcap_sink.join()
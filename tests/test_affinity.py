@@ -0,0 +1,64 @@
+"""Tests of the CPU lists and of the mapping of the queues and workers to
+the CPUs."""
+
+import unittest
+
+from fragscapy import affinity
+
+
+class TestCpuList(unittest.TestCase):
+    """Tests of `parse_cpu_list()` and `format_cpu_list()`."""
+
+    def test_parse(self):
+        self.assertEqual(affinity.parse_cpu_list("0-3,8"), {0, 1, 2, 3, 8})
+        self.assertEqual(affinity.parse_cpu_list("5\n"), {5})
+        self.assertEqual(affinity.parse_cpu_list(""), set())
+
+    def test_parse_malformed(self):
+        for cpu_list in ("a", "3-1", "-1", "0-b"):
+            with self.assertRaises(affinity.AffinityError):
+                affinity.parse_cpu_list(cpu_list)
+
+    def test_format(self):
+        self.assertEqual(affinity.format_cpu_list({0, 1, 2, 3, 8, 10, 11}),
+                         "0-3,8,10-11")
+        self.assertEqual(affinity.format_cpu_list([4]), "4")
+        self.assertEqual(affinity.format_cpu_list(set()), "")
+
+    def test_round_trip(self):
+        cpus = {0, 2, 3, 4, 7, 9, 10}
+        self.assertEqual(
+            affinity.parse_cpu_list(affinity.format_cpu_list(cpus)), cpus
+        )
+
+
+class TestMapping(unittest.TestCase):
+    """Tests of `fanout_cpus()`, `worker_cpus()` and `usable_cpus()`."""
+
+    def test_fanout(self):
+        self.assertEqual(
+            [affinity.fanout_cpus(i, 4, range(10)) for i in range(4)],
+            [{0, 4, 8}, {1, 5, 9}, {2, 6}, {3, 7}]
+        )
+
+    def test_fanout_less_cpus_than_queues(self):
+        self.assertEqual(affinity.fanout_cpus(1, 2, {0}), {0})
+
+    def test_workers(self):
+        self.assertEqual(affinity.worker_cpus(3, {5, 4}), [{4}, {5}, {4}])
+
+    def test_usable(self):
+        allowed = affinity.allowed_cpus()
+        self.assertEqual(affinity.usable_cpus(), allowed)
+        cpu = min(allowed)
+        self.assertEqual(affinity.usable_cpus(str(cpu)), {cpu})
+        self.assertEqual(affinity.usable_cpus({cpu}), {cpu})
+
+    def test_usable_none_left(self):
+        unknown = max(affinity.allowed_cpus()) + 1
+        with self.assertRaises(affinity.AffinityError):
+            affinity.usable_cpus(str(unknown))
+
+
+if __name__ == '__main__':
+    unittest.main()
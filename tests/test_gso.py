@@ -0,0 +1,86 @@
+"""Tests of the segmentation of the GSO packets."""
+
+import unittest
+
+from scapy.layers.inet import ICMP, IP, TCP, UDP
+from scapy.layers.inet6 import IPv6
+from scapy.packet import Raw
+
+from fragscapy import gso
+
+
+def _without_chksums(pkt):
+    """Returns a copy of `pkt` whose checksums are computed again by Scapy."""
+    pkt = pkt.copy()
+    if IP in pkt:
+        del pkt[IP].chksum
+    del pkt[TCP].chksum
+    return pkt
+
+
+class TestFixChecksum(unittest.TestCase):
+    """Tests of `fix_checksum()`."""
+
+    def test_tcp(self):
+        raw = bytearray(bytes(IP(dst="192.0.2.1")/TCP()/Raw(b"A" * 10)))
+        expected = bytes(raw)
+        raw[20+16:20+18] = b"\x00\x00"
+        self.assertEqual(gso.fix_checksum(bytes(raw)), expected)
+
+    def test_udp_ipv6(self):
+        raw = bytearray(bytes(IPv6(dst="2001:db8::1")/UDP()/Raw(b"A" * 10)))
+        expected = bytes(raw)
+        raw[40+6:40+8] = b"\x00\x00"
+        self.assertEqual(gso.fix_checksum(bytes(raw)), expected)
+
+    def test_other(self):
+        raw = bytes(IP(dst="192.0.2.1")/ICMP())
+        self.assertIs(gso.fix_checksum(raw), raw)
+
+
+class TestSegment(unittest.TestCase):
+    """Tests of `segment()`."""
+
+    def test_segment(self):
+        original = IP(dst="192.0.2.1", id=10)/TCP(seq=1000, flags="FPA")
+        original /= Raw(bytes(range(256)) * 16)
+        raws = gso.segment(bytes(original), mtu=1500)
+        self.assertEqual([len(raw) for raw in raws], [1500, 1500, 1216])
+
+        segments = [IP(raw) for raw in raws]
+        payload = b"".join(bytes(seg[TCP].payload) for seg in segments)
+        self.assertEqual(payload, bytes(original[Raw]))
+        self.assertEqual([seg[TCP].seq for seg in segments],
+                         [1000, 2460, 3920])
+        self.assertEqual([seg[IP].id for seg in segments], [10, 11, 12])
+        self.assertEqual([str(seg[TCP].flags) for seg in segments],
+                         ["A", "A", "FPA"])
+        for seg in segments:
+            self.assertEqual(seg[IP].len, len(seg))
+            self.assertEqual(seg[IP].chksum,
+                             IP(bytes(_without_chksums(seg)))[IP].chksum)
+            self.assertEqual(seg[TCP].chksum,
+                             IP(bytes(_without_chksums(seg)))[TCP].chksum)
+
+    def test_segment_ipv6(self):
+        original = IPv6(dst="2001:db8::1")/TCP(seq=0)/Raw(b"A" * 3000)
+        raws = gso.segment(bytes(original), mtu=1280)
+        self.assertTrue(all(len(raw) <= 1280 for raw in raws))
+        segments = [IPv6(raw) for raw in raws]
+        self.assertEqual(sum(len(seg[Raw]) for seg in segments), 3000)
+        for seg in segments:
+            self.assertEqual(seg[IPv6].plen, len(seg) - 40)
+            self.assertEqual(seg[TCP].chksum,
+                             IPv6(bytes(_without_chksums(seg)))[TCP].chksum)
+
+    def test_small_packet(self):
+        raw = bytes(IP(dst="192.0.2.1")/TCP()/Raw(b"A" * 100))
+        self.assertEqual(gso.segment(raw), [raw])
+
+    def test_not_tcp(self):
+        raw = bytes(IP(dst="192.0.2.1")/UDP()/Raw(b"A" * 4000))
+        self.assertEqual(gso.segment(raw, mtu=1500), [raw])
+
+
+if __name__ == '__main__':
+    unittest.main()
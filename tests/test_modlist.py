@@ -0,0 +1,39 @@
+"""Tests of the index from which a modlist leaves the packets unchanged."""
+
+import math
+import unittest
+
+from fragscapy.modifications.delay import Delay
+from fragscapy.modifications.drop_one import DropOne
+from fragscapy.modifications.duplicate import Duplicate
+from fragscapy.modifications.tcp_segment import TcpSegment
+from fragscapy.modlist import ModList
+
+
+def _modlist(*mods):
+    """Builds a `ModList` of `mods`."""
+    modlist = ModList()
+    for mod in mods:
+        modlist.append(mod)
+    return modlist
+
+
+class TestPassthroughAfter(unittest.TestCase):
+    """Tests of `ModList.passthrough_after()`."""
+
+    def test_empty(self):
+        self.assertEqual(_modlist().passthrough_after(), math.inf)
+
+    def test_fixed_indexes(self):
+        modlist = _modlist(DropOne(3), Duplicate(1), Delay(2, 0.5))
+        self.assertEqual(modlist.passthrough_after(), 1)
+
+    def test_unknown(self):
+        self.assertIsNone(_modlist(Delay('last', 0.5)).passthrough_after())
+        self.assertIsNone(
+            _modlist(DropOne(3), TcpSegment(8)).passthrough_after()
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
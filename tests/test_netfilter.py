@@ -0,0 +1,199 @@
+"""Tests of the scripts inserting and removing the NFQUEUE rules and of the
+batches of verdicts and of the check of the `fnfqueue` internals."""
+
+import socket
+import unittest
+
+import fnfqueue
+
+from fragscapy.netfilter import (
+    NFQueueRule, VerdictBatch, build_nft_script, build_restore_script,
+    check_fnfqueue
+)
+
+
+def _rule(host="192.0.2.1", **kwargs):
+    """Builds a rule queuing the TCP packets to and from `host` port 80."""
+    return NFQueueRule(host=host, host6="2001:db8::1", port=80, qnum=10,
+                       queues=2, **kwargs)
+
+
+class TestRestoreScript(unittest.TestCase):
+    """Tests of `build_restore_script()`."""
+
+    def test_insert(self):
+        self.assertEqual(
+            build_restore_script([_rule()], socket.AF_INET).splitlines(), [
+                "*filter",
+                "-I OUTPUT -d 192.0.2.1 -p tcp --dport 80 -j NFQUEUE "
+                "--queue-balance 10:11 --queue-cpu-fanout",
+                "-I OUTPUT -d 192.0.2.1 -p tcp --dport 80 "
+                "--tcp-flags RST RST -j DROP",
+                "-I INPUT -s 192.0.2.1 -p tcp --sport 80 -j NFQUEUE "
+                "--queue-balance 12:13 --queue-cpu-fanout",
+                "-I OUTPUT -d 192.0.2.1 -p tcp --sport 80 "
+                "--tcp-flags RST RST -j DROP",
+                "COMMIT",
+            ]
+        )
+
+    def test_delete_ipv6(self):
+        script = build_restore_script([_rule()], socket.AF_INET6,
+                                      insert=False)
+        lines = script.splitlines()
+        self.assertTrue(script.endswith("COMMIT\n"))
+        self.assertEqual(lines[0], "*filter")
+        self.assertEqual(len(lines), 6)
+        for line in lines[1:-1]:
+            self.assertTrue(line.startswith("-D "))
+            self.assertIn("2001:db8::1", line)
+
+    def test_family_disabled(self):
+        self.assertIsNone(
+            build_restore_script([_rule(ipv6=False)], socket.AF_INET6)
+        )
+
+
+class TestNftScript(unittest.TestCase):
+    """Tests of `build_nft_script()`."""
+
+    def setUp(self):
+        self.lines = build_nft_script([
+            _rule(), _rule(host="192.0.2.2", ipv6=False)
+        ]).splitlines()
+
+    def test_table(self):
+        self.assertEqual(self.lines[:3], [
+            "table inet fragscapy",
+            "delete table inet fragscapy",
+            "table inet fragscapy {",
+        ])
+        self.assertEqual(self.lines[-1], "}")
+
+    def test_sets(self):
+        sets = [line for line in self.lines if line.startswith("  set ")]
+        self.assertEqual(len(sets), 8)
+        self.assertIn(
+            "type ipv4_addr . inet_service; "
+            "elements = { 192.0.2.1 . 80, 192.0.2.2 . 80 }", sets[0]
+        )
+        self.assertIn(
+            "type ipv6_addr . inet_service; elements = { 2001:db8::1 . 80 }",
+            sets[2]
+        )
+
+    def test_chains(self):
+        output = self.lines.index("  chain output {")
+        input_ = self.lines.index("  chain input {")
+        output_rules = self.lines[output+2:input_-1]
+        input_rules = self.lines[input_+2:-2]
+        # The RST are dropped before the packets are queued
+        self.assertEqual(
+            [rule.split()[-1] for rule in output_rules],
+            ["drop"] * 4 + ["fanout"] * 2
+        )
+        for rule in output_rules[4:]:
+            self.assertTrue(rule.endswith("queue num 10-11 fanout"))
+        self.assertEqual(len(input_rules), 2)
+        for rule in input_rules:
+            self.assertTrue(rule.endswith("queue num 12-13 fanout"))
+
+
+
+class _FakeConnection(object):
+    """The part of a `fnfqueue.Connection` used by the batch verdicts, with
+    no netlink socket."""
+    # pylint: disable=too-few-public-methods
+    def __init__(self):
+        self._conn = None
+        self.recycled = list()
+
+    def _recycle(self, packet):
+        self.recycled.append(packet)
+
+
+class _FakePacket(fnfqueue.Packet):
+    """A `fnfqueue.Packet` recording its verdicts instead of sending them."""
+    # pylint: disable=super-init-not-called
+    def __init__(self, conn, queue_id=0):
+        self.cache = {}
+        self.packet = type('nfq_packet', (), {'queue_id': queue_id})()
+        self._conn = conn
+        self._invalid = False
+        self.verdicts = list()
+
+    def verdict(self, action, mangle=0):
+        self._is_invalid()
+        self.verdicts.append((action, mangle))
+        self._conn._recycle(self.packet)
+        self._invalidate()
+
+
+class TestVerdictBatch(unittest.TestCase):
+    """Tests of `VerdictBatch` with packets verdicted by another thread."""
+
+    def setUp(self):
+        self.conn = _FakeConnection()
+        self.batch = VerdictBatch()
+
+    def test_batch(self):
+        pkts = [_FakePacket(self.conn) for _ in range(3)]
+        nfq_packets = [pkt.packet for pkt in pkts]
+        for pkt in pkts:
+            self.batch.add(pkt, fnfqueue.ACCEPT)
+        self.batch.flush()
+        self.assertEqual(len(self.batch), 0)
+        self.assertEqual(self.conn.recycled, nfq_packets)
+        self.assertTrue(all(pkt._invalid for pkt in pkts))
+
+    def test_verdicted_meanwhile(self):
+        pkts = [_FakePacket(self.conn) for _ in range(4)]
+        for pkt in pkts:
+            self.batch.add(pkt, fnfqueue.ACCEPT)
+        # Verdicted by another thread once recorded in the batch
+        pkts[1].verdict(fnfqueue.DROP)
+        pkts[3].verdict(fnfqueue.DROP)
+        self.batch.flush()
+        self.assertTrue(all(pkt._invalid for pkt in pkts))
+        self.assertEqual(len(self.conn.recycled), 4)
+        self.assertEqual(pkts[1].verdicts, [(fnfqueue.DROP, 0)])
+
+    def test_single_verdicted_meanwhile(self):
+        pkt = _FakePacket(self.conn)
+        self.batch.add(pkt, fnfqueue.ACCEPT)
+        self.batch.add(pkt, fnfqueue.DROP)
+        self.batch.flush()
+        self.assertEqual(pkt.verdicts, [(fnfqueue.ACCEPT, 0)])
+
+    def test_fail_open(self):
+        pkts = [_FakePacket(self.conn) for _ in range(3)]
+        self.batch.add(pkts[0], fnfqueue.DROP)
+        pkts[2].verdict(fnfqueue.DROP)
+        self.batch.fail_open(pkts)
+        self.assertEqual(pkts[0].verdicts, [(fnfqueue.DROP, 0)])
+        self.assertEqual(pkts[1].verdicts, [(fnfqueue.ACCEPT, 0)])
+        self.assertEqual(pkts[2].verdicts, [(fnfqueue.DROP, 0)])
+
+
+class TestCheckFnfqueue(unittest.TestCase):
+    """Tests of the check of the private internals of `fnfqueue`."""
+
+    def test_installed(self):
+        check_fnfqueue()
+
+    def test_missing(self):
+        recycle = fnfqueue.Connection._recycle
+        del fnfqueue.Connection._recycle
+        try:
+            with self.assertRaisesRegex(ImportError, '_recycle'):
+                check_fnfqueue()
+        finally:
+            fnfqueue.Connection._recycle = recycle
+
+    def test_connection(self):
+        with self.assertRaisesRegex(ImportError, '_received'):
+            check_fnfqueue(_FakeConnection())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""Tests of the translation of the modlists in kernel plans."""
+
+import unittest
+
+from fragscapy.modifications.delay import Delay
+from fragscapy.modifications.drop_proba import DropProba
+from fragscapy.modifications.duplicate import Duplicate
+from fragscapy.modifications.reorder import Reorder
+from fragscapy.modifications.tcp_segment import TcpSegment
+from fragscapy.modlist import ModList
+from fragscapy.planner import (
+    IDENTITY_PLAN, KernelPlan, is_verdict_only, needs_netem, plan_modlist
+)
+
+
+def _modlist(*mods):
+    """Builds a `ModList` of `mods`."""
+    modlist = ModList()
+    for mod in mods:
+        modlist.append(mod)
+    return modlist
+
+
+class TestPlanModlist(unittest.TestCase):
+    """Tests of `plan_modlist()`."""
+
+    def test_empty(self):
+        self.assertEqual(plan_modlist(_modlist()), IDENTITY_PLAN)
+
+    def test_drop_proba(self):
+        plan = plan_modlist(_modlist(DropProba(0.5), DropProba(0.5)))
+        self.assertEqual(plan, KernelPlan(0.75, 0.0, False))
+        self.assertTrue(is_verdict_only(plan))
+
+    def test_delay(self):
+        plan = plan_modlist(_modlist(DropProba(0.25), Delay('first', 0.5)))
+        self.assertEqual(plan, KernelPlan(0.25, 0.5, False))
+        self.assertTrue(needs_netem(plan))
+        self.assertFalse(is_verdict_only(plan))
+
+    def test_duplicate(self):
+        plan = plan_modlist(_modlist(Duplicate('first'), Reorder('reverse')))
+        self.assertEqual(plan, KernelPlan(0.0, 0.0, True))
+
+    def test_unsupported(self):
+        # Not a kernel mod
+        self.assertIsNone(plan_modlist(_modlist(TcpSegment(8))))
+        # Each copy would be dropped independently
+        self.assertIsNone(
+            plan_modlist(_modlist(Duplicate('first'), DropProba(0.5)))
+        )
+        # netem only sends 2 copies
+        self.assertIsNone(
+            plan_modlist(_modlist(Duplicate('first'), Duplicate('first')))
+        )
+        # The copies would be sent at different times
+        self.assertIsNone(
+            plan_modlist(_modlist(Delay('first', 0.5), Duplicate('last')))
+        )
+        self.assertFalse(is_verdict_only(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+"""Tests of the grouping of the delayed packets."""
+
+import unittest
+
+from scapy.layers.inet import IP, UDP
+
+from fragscapy.packetlist import PacketList
+from fragscapy.scheduler import split_by_deadline
+
+
+def _packetlist(*delays):
+    """Builds a `PacketList` of UDP packets (with sport 0, 1, ...) delayed by
+    `delays`."""
+    packetlist = PacketList()
+    for i, delay in enumerate(delays):
+        packetlist.add_packet(IP(dst="192.0.2.1")/UDP(sport=i), delay)
+    return packetlist
+
+
+class TestSplitByDeadline(unittest.TestCase):
+    """Tests of `split_by_deadline()`."""
+
+    def test_no_delay(self):
+        packetlist = _packetlist(0, 0, 0.001)
+        self.assertEqual(split_by_deadline(packetlist, 100.0),
+                         [(100.0, [pkt.raw for pkt in packetlist])])
+
+    def test_delays(self):
+        packetlist = _packetlist(0.5, 0, 1, 2)
+        raws = [pkt.raw for pkt in packetlist]
+        self.assertEqual(split_by_deadline(packetlist, 100.0), [
+            (100.5, raws[0:2]),
+            (101.5, raws[2:3]),
+            (103.5, raws[3:4]),
+        ])
+
+    def test_empty(self):
+        self.assertEqual(split_by_deadline(PacketList(), 100.0), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""Tests of the ring buffer shared with the worker processes."""
+
+import unittest
+
+from fragscapy.workers import (
+    FLAG_INPUT, FLAG_RECORDS, FLAG_TRUNCATED, MIN_SLOT_SIZE, PacketRing,
+    VERDICT_ACCEPT, VERDICT_MANGLE
+)
+
+
+class TestPacketRing(unittest.TestCase):
+    """Tests of `PacketRing`."""
+
+    def setUp(self):
+        self.ring = PacketRing(nb_slots=2, slot_size=MIN_SLOT_SIZE)
+
+    def tearDown(self):
+        self.ring.close()
+
+    def test_slot_size(self):
+        with self.assertRaises(ValueError):
+            PacketRing(nb_slots=2, slot_size=MIN_SLOT_SIZE - 1)
+        with self.assertRaises(ValueError):
+            PacketRing(nb_slots=0)
+
+    def test_request(self):
+        self.ring.put_request(3, 12.5, FLAG_INPUT | FLAG_RECORDS, b"abc")
+        self.assertEqual(self.ring.head, 1)
+        self.assertTrue(self.ring.filled.acquire(False))
+        generation, arrival, flags, payload = self.ring.get_request(0)
+        self.assertEqual((generation, arrival, flags, bytes(payload)),
+                         (3, 12.5, FLAG_INPUT | FLAG_RECORDS, b"abc"))
+
+    def test_result(self):
+        self.ring.put_request(1, 0.0, FLAG_RECORDS, b"abc")
+        self.ring.put_result(0, VERDICT_MANGLE, [(0.0, b"ab"), (0.5, b"c")])
+        verdict, flags, records = self.ring.get_result(0)
+        self.assertEqual(verdict, VERDICT_MANGLE)
+        self.assertEqual(flags, FLAG_RECORDS)
+        self.assertEqual([(delay, bytes(payload))
+                          for delay, payload in records],
+                         [(0.0, b"ab"), (0.5, b"c")])
+
+    def test_truncated(self):
+        self.ring.put_request(1, 0.0, FLAG_RECORDS, b"abc")
+        big = b"A" * 0xFFFF
+        self.ring.put_result(0, VERDICT_MANGLE, [(0.0, big), (0.0, big)])
+        verdict, flags, records = self.ring.get_result(0)
+        self.assertEqual(verdict, VERDICT_MANGLE)
+        self.assertTrue(flags & FLAG_TRUNCATED)
+        self.assertEqual([bytes(payload) for _, payload in records], [big])
+
+    def test_wrap_around(self):
+        for i in range(5):
+            self.assertFalse(self.ring.is_full())
+            self.ring.put_request(i, 0.0, 0, bytes([i]))
+            self.ring.put_result(i, VERDICT_ACCEPT, [])
+            self.assertEqual(self.ring.get_request(i)[0], i)
+            self.assertEqual(bytes(self.ring.get_request(i)[3]), bytes([i]))
+            self.assertEqual(self.ring.get_result(i), (VERDICT_ACCEPT, 0, []))
+            self.ring.done = self.ring.tail = i + 1
+
+    def test_full(self):
+        self.ring.put_request(0, 0.0, 0, b"a")
+        self.ring.put_request(1, 0.0, 0, b"b")
+        self.assertTrue(self.ring.is_full())
+        self.ring.tail = 1
+        self.assertFalse(self.ring.is_full())
+
+
+if __name__ == '__main__':
+    unittest.main()